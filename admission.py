@@ -0,0 +1,102 @@
+import time
+import threading as td
+from collections import deque
+import tracing
+
+# Admission control of a trader's requests.
+# The RPC server still reads each connection in its own thread, but the lookups, which hold the trader's
+# state and make blocking calls to the buyer, the sellers and the DB, run on `workers` threads. The
+# requests wait for a worker in a FIFO queue of at most `max_queue` requests. When the queue is full
+# the request is refused at once, and a request that waited longer than `max_wait` seconds is dropped
+# without being run, since its buyer is better off elsewhere by then. Both get BUSY as their reply:
+# the buyer keeps the items and backs off from that trader.
+
+BUSY = "busy"
+
+
+class Job:
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.enqueued = time.perf_counter()
+        self.context = tracing.current() # The worker runs the job in the caller's trace.
+        self.done = td.Event()
+        self.result = None
+        self.error = None
+
+
+# AdmissionQueue : Bounded executor with an admission queue. workers=0 runs every call in its caller's
+# thread, as without admission control. wait_histogram records the seconds every request queued.
+class AdmissionQueue:
+    def __init__(self, workers=8, max_queue=64, max_wait=0.5, wait_histogram=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.wait_histogram = wait_histogram
+        self.queue = deque()
+        self.condition = td.Condition()
+        self.threads = []
+        self.running = 0
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0 # Refused, the queue was full.
+        self.shed = 0     # Dropped, queued longer than max_wait.
+
+    # gate : function run through the queue, with the same arguments and result, or BUSY.
+    def gate(self, function):
+        if not self.workers:
+            return function
+        def gated_function(*args):
+            return self.submit(function, *args)
+        return gated_function
+
+    def submit(self, function, *args):
+        job = Job(function, args)
+        with self.condition:
+            if len(self.queue) >= self.max_queue:
+                self.rejected += 1
+                return BUSY
+            if len(self.threads) < self.workers: # Started on demand, as the load needs them.
+                thread = td.Thread(target=self.work, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.queue.append(job)
+            self.admitted += 1
+            self.condition.notify()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.queue.popleft()
+                self.running += 1
+            waited = time.perf_counter() - job.enqueued
+            if self.wait_histogram is not None:
+                self.wait_histogram.record(waited)
+            if waited > self.max_wait:
+                self.shed += 1
+                job.result = BUSY
+            else:
+                try:
+                    job.result = tracing.run_in(job.context, job.function, *job.args)
+                except Exception as e:
+                    job.error = e
+            with self.condition:
+                self.running -= 1
+            job.done.set()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'workers': self.workers,
+                'queued': len(self.queue),
+                'running': self.running,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'shed': self.shed,
+            }
@@ -0,0 +1,258 @@
+import os
+import re
+import csv
+import sys
+import json
+import glob
+import logging
+import argparse
+import numpy as np
+
+# Columnar store of the trades of the traders' transaction logs, for analytics.
+# Every "opened" record of a log (see data_ops.py) becomes a row of a NumPy structured array, kept in
+# `<store>/trades.bin` and memory-mapped to be read; its "completed" record fills in the row later.
+# A row is 44 bytes, against about 250 for the JSON line, and a query is a few vectorized passes
+# over the columns it needs instead of a JSON parse of every line.
+# ingest() reads a log from the offset it had reached, so only the records written since are parsed.
+# `<store>/meta.json`, rewritten after the rows, holds the offsets, the rows of the trades that are
+# not completed yet and the product names; rows past its row count (a crash in between) are dropped.
+# The logs written by log_transaction before the journal, one JSON object per line written out a
+# character per CSV field, are read too; they have no times.
+#   python3 analytics.py ingest transactions_*.csv
+#   python3 analytics.py volume --by product --per 60
+#   python3 analytics.py wait --by trader
+
+TRADE = np.dtype([
+    ('ts', '<i8'),         # Lamport timestamp of the trade, unique per trader.
+    ('trader', '<i4'),     # peer_id of the trader, from the name of the log.
+    ('product', '<u2'),    # Code of the product name, see TradeStore.products.
+    ('buyer', '<i4'),
+    ('seller', '<i4'),
+    ('quantity', '<i4'),
+    ('replay', 'u1'),      # A failed trader's trade, replayed (see recovery.py).
+    ('done', 'u1'),        # The trade is completed.
+    ('opened', '<f8'),     # Unix times in seconds, NaN if unknown.
+    ('completed', '<f8'),
+])
+
+GROUPS = ('product', 'seller', 'buyer', 'trader')
+LOG_NAME = re.compile(r'transactions_(\d+)\.csv$')
+
+
+# legacy_record : {ts: tx} of a line of the logs of log_transaction before the journal, None if it is not one.
+def legacy_record(line):
+    try:
+        text = line.decode()
+        if text.startswith('{ '):
+            text = ''.join(next(csv.reader([text], delimiter=' ')))
+        record = json.loads(text)
+    except (UnicodeDecodeError, ValueError, StopIteration, csv.Error):
+        return None
+    if not isinstance(record, dict) or len(record) != 1:
+        return None
+    return record
+
+
+# TradeStore : The columnar store in directory `path`, created on first use.
+class TradeStore:
+    def __init__(self, path):
+        self.path = path
+        self.data_file = os.path.join(path, 'trades.bin')
+        self.meta_file = os.path.join(path, 'meta.json')
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(self.meta_file) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {'rows': 0, 'products': [], 'sources': {}}
+        self.rows = meta['rows']
+        self.products = meta['products'] # Product name by code.
+        self.product_codes = {name: code for code, name in enumerate(self.products)}
+        self.sources = meta['sources']   # Log path -> {'trader', 'offset', 'open': {ts: row}}
+        if os.path.isfile(self.data_file) and os.path.getsize(self.data_file) != self.rows * TRADE.itemsize:
+            with open(self.data_file, 'r+b') as f: # Rows written after the last meta.json.
+                f.truncate(self.rows * TRADE.itemsize)
+
+    # trades : The rows, memory-mapped and read-only.
+    def trades(self):
+        if self.rows == 0:
+            return np.zeros(0, TRADE)
+        return np.memmap(self.data_file, TRADE, mode='r', shape=(self.rows,))
+
+    def product_code(self, name):
+        code = self.product_codes.get(name)
+        if code is None:
+            code = self.product_codes[name] = len(self.products)
+            self.products.append(name)
+        return code
+
+    # ingest : Add the records written to a log since the last call. trader_peer_id defaults to the
+    # number in the name of the log. Returns the number of new trades.
+    def ingest(self, filename, trader_peer_id=None):
+        key = os.path.abspath(filename)
+        source = self.sources.get(key)
+        if source is None:
+            if trader_peer_id is None:
+                match = LOG_NAME.search(filename)
+                trader_peer_id = int(match.group(1)) if match else -1
+            source = self.sources[key] = {'trader': trader_peer_id, 'offset': 0, 'open': {}}
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < source['offset']:
+                logging.warning("{} is shorter than when it was ingested, read again from the start".format(filename))
+                source['offset'] = 0
+            f.seek(source['offset'])
+            data = f.read()
+        end = data.rfind(b'\n') + 1 # A last line without its newline is still being written.
+        rows, completions = self.parse(data[:end].splitlines(), source)
+        self.append(rows, completions)
+        source['offset'] += end
+        self.save_meta()
+        return len(rows)
+
+    # parse : The new rows and the (row, time) completions of earlier rows, from the lines of a log.
+    def parse(self, lines, source):
+        trader = source['trader']
+        open_rows = source['open']
+        rows = []
+        completions = []
+        pending = {} # ts -> index in rows, of the trades opened in these lines
+        for line in lines:
+            try:
+                record = json.loads(line)
+                op = record.get('op')
+            except (ValueError, AttributeError):
+                op = None
+            if op is None:
+                record = legacy_record(line)
+                if record is None: # Not a record, a torn write.
+                    continue
+            if op == 'opened':
+                tx = record['tx']
+                pending[record['ts']] = len(rows)
+                rows.append([int(record['ts']), trader, self.product_code(tx['product_name']), tx['buyer_id']['peer_id'],
+                             tx['seller_id']['peer_id'], tx.get('quantity', 1), 'key' in tx, False, record.get('time', np.nan) / 1000, np.nan])
+            elif op == 'completed':
+                ts = record['ts']
+                completed = record.get('time', np.nan) / 1000
+                if ts in pending:
+                    row = rows[pending.pop(ts)]
+                    row[7] = True
+                    row[9] = completed
+                elif ts in open_rows:
+                    completions.append((open_rows.pop(ts), completed))
+            elif op is None: # Legacy {ts: tx}.
+                (ts, tx), = record.items()
+                try:
+                    rows.append([int(ts), trader, self.product_code(tx['product_name']), tx['buyer_id']['peer_id'],
+                                 tx['seller_id']['peer_id'], tx.get('quantity', 1), False, bool(tx.get('completed')), np.nan, np.nan])
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    continue
+        for ts, index in pending.items():
+            open_rows[ts] = self.rows + index
+        return rows, completions
+
+    def append(self, rows, completions):
+        if rows:
+            array = np.array([tuple(row) for row in rows], dtype=TRADE)
+            with open(self.data_file, 'ab') as f:
+                f.write(array.tobytes())
+            self.rows += len(rows)
+        if completions:
+            trades = np.memmap(self.data_file, TRADE, mode='r+', shape=(self.rows,))
+            indices = np.array([row for row, _ in completions], dtype=np.int64)
+            trades['done'][indices] = 1
+            trades['completed'][indices] = np.array([completed for _, completed in completions], dtype=np.float64)
+            trades.flush()
+            del trades
+
+    def save_meta(self):
+        tmp_name = self.meta_file + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump({'rows': self.rows, 'products': self.products, 'sources': self.sources}, f)
+        os.replace(tmp_name, self.meta_file)
+
+    # names : The keys of a grouping as shown, product names or peer ids.
+    def names(self, by, codes):
+        if by == 'product':
+            return [self.products[code] for code in codes]
+        return [int(code) for code in codes]
+
+    # volume : Units traded by product, seller, buyer or trader. With `per` seconds, per time slot as well:
+    # {(key, slot start time): units}; trades without a time are left out then.
+    def volume(self, by='product', per=None, count=False):
+        if by not in GROUPS:
+            raise ValueError("Unknown grouping: {}".format(by))
+        trades = self.trades()
+        weights = None if count else trades['quantity']
+        keys, key_index = np.unique(trades[by], return_inverse=True)
+        if per is None:
+            totals = np.bincount(key_index, weights, minlength=len(keys))
+            return dict(zip(self.names(by, keys), totals.astype(np.int64).tolist()))
+        opened = trades['opened']
+        timed = ~np.isnan(opened)
+        slots = np.floor(opened[timed] / per).astype(np.int64)
+        if len(slots) == 0:
+            return {}
+        first = slots.min()
+        width = slots.max() - first + 1
+        cells = key_index[timed] * width + (slots - first)
+        totals = np.bincount(cells, None if weights is None else weights[timed], minlength=len(keys) * width)
+        cells = np.flatnonzero(totals)
+        names = self.names(by, keys)
+        return {(names[cell // width], float((first + cell % width) * per)): int(totals[cell]) for cell in cells}
+
+    # wait : Percentiles (0 to 100) of the seconds from a trade being logged to it being completed,
+    # over the completed trades, or by product, seller, buyer or trader: {key: [percentiles]}.
+    def wait(self, percentiles=(50, 99), by=None):
+        trades = self.trades()
+        timed = (trades['done'] == 1) & ~np.isnan(trades['opened']) & ~np.isnan(trades['completed'])
+        waits = trades['completed'][timed] - trades['opened'][timed]
+        if by is None:
+            return np.percentile(waits, percentiles).tolist() if len(waits) else None
+        if by not in GROUPS:
+            raise ValueError("Unknown grouping: {}".format(by))
+        groups = trades[by][timed]
+        order = np.argsort(groups, kind='stable')
+        keys, starts = np.unique(groups[order], return_index=True)
+        names = self.names(by, keys)
+        return {name: np.percentile(group, percentiles).tolist() for name, group in zip(names, np.split(waits[order], starts[1:]))}
+
+    # summary : Trades, units, share completed and time span of the store.
+    def summary(self):
+        trades = self.trades()
+        opened = trades['opened'][~np.isnan(trades['opened'])]
+        return {
+            'trades': int(len(trades)),
+            'units': int(trades['quantity'].sum()),
+            'completed': float(trades['done'].mean()) if len(trades) else None,
+            'replayed': int(trades['replay'].sum()),
+            'first': float(opened.min()) if len(opened) else None,
+            'last': float(opened.max()) if len(opened) else None,
+            'bytes': os.path.getsize(self.data_file) if os.path.isfile(self.data_file) else 0,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Columnar analytics of the traders' transaction logs.")
+    parser.add_argument('command', choices=['ingest', 'summary', 'volume', 'trades', 'wait'])
+    parser.add_argument('logs', nargs='*', help="logs to ingest, transactions_*.csv by default")
+    parser.add_argument('--store', default='trades.cols', help="directory of the columnar store")
+    parser.add_argument('--by', choices=GROUPS, default=None)
+    parser.add_argument('--per', type=float, default=None, help="seconds per time slot")
+    args = parser.parse_args()
+    store = TradeStore(args.store)
+    if args.command == 'ingest':
+        for filename in args.logs or sorted(glob.glob('transactions_*.csv')):
+            print("{}: {} new trades".format(filename, store.ingest(filename)))
+        result = store.summary()
+    elif args.command == 'summary':
+        result = store.summary()
+    elif args.command == 'wait':
+        result = store.wait(by=args.by)
+    else:
+        result = store.volume(args.by or 'product', args.per, count=args.command == 'trades')
+        if args.per is not None:
+            result = [[key, slot, value] for (key, slot), value in sorted(result.items(), key=lambda item: (item[0][1], str(item[0][0])))]
+    json.dump(result, sys.stdout, indent=1)
+    print()
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import time
+import socket
+import xmlrpc.client
+import threading as td
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from market import peer
+from rpc_pool import CONNECTION_ERRORS
+import tracing
+
+# Optional asyncio runtime for a peer.
+# The server and the client speak the same XML-RPC over HTTP/1.1 as AsyncXMLRPCServer and the
+# connection pool, with the same method names, so async and threaded peers can share a cluster.
+# Inbound requests are handled on one event loop; the peer methods, which block, run on a bounded
+# executor instead of a thread per request. Fan-out to neighbors is done with asyncio.gather and a
+# semaphore instead of a thread per neighbor.
+
+
+# AsyncRPCServer : XML-RPC server on an asyncio event loop.
+# Coroutine functions are awaited on the loop, plain functions run on the executor.
+class AsyncRPCServer:
+    def __init__(self, functions, executor=None, idle_timeout=30.0):
+        self.functions = dict(functions)
+        self.executor = executor
+        self.idle_timeout = idle_timeout
+        self.servers = []
+        self.writers = set() # Open connections.
+
+    async def start(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        self.servers.append(server)
+        return server
+
+    # close : Stop listening and drop the open connections. Must run on the event loop.
+    def close(self):
+        for server in self.servers:
+            server.close()
+        for writer in list(self.writers):
+            writer.close()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not request_line:
+                    break
+                headers = await read_headers(reader)
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                response = await self.dispatch(body, tracing.decode(headers.get(tracing.HEADER.lower())))
+                keep_alive = request_line.rstrip().endswith(b'HTTP/1.1') and headers.get('connection', '').lower() != 'close'
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\nContent-Length: %d\r\n%s\r\n'
+                             % (len(response), b'' if keep_alive else b'Connection: close\r\n') + response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    # dispatch : The response to a request, run in the trace context of its caller if it has one.
+    async def dispatch(self, body, context=None):
+        try:
+            params, method = xmlrpc.client.loads(body)
+            function = self.functions.get(method)
+            if function is None:
+                raise Exception('method "{}" is not supported'.format(method))
+            if asyncio.iscoroutinefunction(function):
+                result = await function(*params)
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(self.executor, tracing.run_in, context, function, *params)
+            response = xmlrpc.client.dumps((result,), methodresponse=True, allow_none=True)
+        except Exception as e: # Reported to the caller as a Fault, like SimpleXMLRPCServer does.
+            response = xmlrpc.client.dumps(xmlrpc.client.Fault(1, "{}:{}".format(type(e), e)), allow_none=True)
+        return response.encode()
+
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+# AsyncRPCClient : XML-RPC client with keep-alive connections per peer address.
+class AsyncRPCClient:
+    def __init__(self, connect_timeout=2.0, read_timeout=10.0, max_idle=8):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.idle = {} # host_addr -> list of (reader, writer)
+
+    # call : One call; context is the trace context that goes with it, in the X-Trace header as with KeepAliveTransport.
+    async def call(self, host_addr, method, *args, context=None):
+        body = xmlrpc.client.dumps(args, method, allow_none=True).encode()
+        trace_header = b'' if context is None else ('%s: %s\r\n' % (tracing.HEADER, tracing.encode(context))).encode()
+        request = (b'POST /RPC2 HTTP/1.1\r\nHost: %s\r\nContent-Type: text/xml\r\nContent-Length: %d\r\n%s\r\n'
+                   % (host_addr.encode(), len(body), trace_header) + body)
+        idle = self.idle.get(host_addr)
+        while True:
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                host, port = host_addr.split(':')
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), self.connect_timeout)
+                writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                writer.write(request)
+                await writer.drain()
+                response = await asyncio.wait_for(self.read_response(reader), self.read_timeout)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused: # A reused connection may have been closed by the server while idle, retry.
+                    raise
+            except BaseException:
+                writer.close()
+                raise
+        idle = self.idle.setdefault(host_addr, [])
+        if len(idle) < self.max_idle:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return xmlrpc.client.loads(response)[0][0]
+
+    async def read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by peer")
+        headers = await read_headers(reader)
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        status = int(status_line.split()[1])
+        if status != 200:
+            raise xmlrpc.client.ProtocolError('', status, status_line.decode().strip(), headers)
+        return body
+
+    def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+# AsyncPeer : The peer with the asyncio runtime. Enabled with "Runtime": "asyncio" in the peer's db.
+# Extra db settings: "Workers" bounds the executor running the peer methods, "FanOutLimit" bounds the
+# number of concurrent calls of a multicast.
+class AsyncPeer(peer):
+    def __init__(self, host_addr, peer_id, neighbors, db):
+        super().__init__(host_addr, peer_id, neighbors, db)
+        self.executor = ThreadPoolExecutor(max_workers=db.get('Workers', 32))
+        self.client = AsyncRPCClient(self.rpc_pool.connect_timeout, self.rpc_pool.read_timeout)
+        self.fan_out_semaphore = asyncio.Semaphore(db.get('FanOutLimit', 64))
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = td.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+
+    # The following method is used to start the server process, it blocks like the threaded one.
+    def startServer(self):
+        host_ip = socket.gethostbyname(socket.gethostname())
+        self.start_services(host_ip)
+        try:
+            asyncio.run_coroutine_threadsafe(self.serve(host_ip, int(self.host_addr.split(':')[1])), self.loop).result()
+        except concurrent.futures.CancelledError: # Stopped.
+            pass
+
+    async def serve(self, host, port):
+        self.rpc_server = AsyncRPCServer(self.rpc_functions(), self.executor)
+        server = await self.rpc_server.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    # stop : Take the peer off the network.
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.rpc_server.close)
+        self.loop.call_soon_threadsafe(self.client.close)
+        self.failure_detector.stop()
+        self.rpc_pool.close()
+        self.events.flush()
+
+    # multicast : Call an RPC method on several neighbors concurrently from the event loop. The calls go
+    # in the trace context of the calling thread, the event loop's thread has its own.
+    def multicast(self, neighbors, method, *args):
+        host_addrs = [neighbor['host_addr'] for neighbor in neighbors]
+        asyncio.run_coroutine_threadsafe(self.fan_out(host_addrs, method, *args, context=tracing.current()), self.loop)
+
+    # request_all : Like the threaded one, on_reply is called from the event loop.
+    def request_all(self, neighbors, method, args, on_reply):
+        context = tracing.current()
+        async def request(neighbor):
+            start = time.monotonic()
+            try:
+                reply = await self.call(neighbor['host_addr'], method, *args, context=context)
+            except xmlrpc.client.Fault:
+                reply = None
+            on_reply(neighbor, reply, time.monotonic() - start)
+        async def request_all():
+            await asyncio.gather(*(request(neighbor) for neighbor in neighbors))
+        asyncio.run_coroutine_threadsafe(request_all(), self.loop)
+
+    # fan_out : Send the call to every host, with at most FanOutLimit calls in flight.
+    async def fan_out(self, host_addrs, method, *args, context=None):
+        return await asyncio.gather(*(self.call(host_addr, method, *args, context=context) for host_addr in host_addrs), return_exceptions=True)
+
+    # call : One call from the event loop. Unreachable peers are marked down in the connection pool,
+    # as for the threaded calls, and the call returns None.
+    async def call(self, host_addr, method, *args, context=None):
+        if not self.rpc_pool.is_alive(host_addr):
+            return None
+        async with self.fan_out_semaphore:
+            try:
+                result = await self.client.call(host_addr, method, *args, context=context)
+            except xmlrpc.client.Fault:
+                self.rpc_pool.mark_alive(host_addr)
+                raise
+            except CONNECTION_ERRORS + (asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self.rpc_pool.mark_down(host_addr)
+                logging.warning("Call {} to {} failed: {}".format(method, host_addr, e))
+                return None
+        self.rpc_pool.mark_alive(host_addr)
+        return result
@@ -0,0 +1,1123 @@
+import os
+import sys
+import time
+import random
+import socket
+import tempfile
+import xmlrpc.client
+import threading as td
+import data_ops
+from order_book import OrderBook, offer_key
+from rpc_pool import ConnectionPool, KeepAliveRequestHandler
+
+# Microbenchmarks for the trading components. Run as:
+#   python3 benchmark.py <name> [<name> ...]
+# With no name, every benchmark is run.
+
+PRODUCTS = ['Fish','Salt','Boar']
+
+
+def seller_info(peer_id, product_name, product_count, price=0):
+    return {'seller_id': {'peer_id':peer_id,'host_addr':'127.0.0.1:' + str(20090 + peer_id)},
+            'product_name':product_name,'product_count':product_count,'price':price}
+
+
+# order_book : Lookup latency of the trader's order book as the number of sellers grows.
+# Every match takes one unit; exhausted sellers re-register so the book size stays constant.
+def bench_order_book(sizes=(1000, 10000, 100000), lookups=50000):
+    for priority in ("fifo", "price"):
+        for size in sizes:
+            book = OrderBook(priority)
+            for peer_id in range(size):
+                book.upsert(seller_info(peer_id, PRODUCTS[peer_id % 3], 3, random.randint(1, 100)))
+            wanted = [PRODUCTS[i % 3] for i in range(lookups)]
+            start = time.perf_counter()
+            for product_name in wanted:
+                reservation = book.reserve(product_name, 1)
+                book.commit(reservation)
+                for seller, _ in reservation.fills:
+                    if seller['product_count'] == 0:
+                        book.restock(seller, 3)
+            elapsed = time.perf_counter() - start
+            print("order_book priority={:5} sellers={:>6}: {:.2f} us/lookup".format(priority, size, elapsed / lookups * 1e6))
+    bench_order_book_stress()
+
+
+# order_book_stress : Buyer threads reserve units of the same offers while a seller thread restocks them;
+# a reservation is committed, or released as if its trade had failed. Raises if a unit was sold twice
+# (an offer below zero, more units sold than there were) or lost (the units sold and left do not add up).
+def bench_order_book_stress(threads=8, orders=100000, sellers=20, units=10000):
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6) # Switch threads as often as possible, inside the locked sections too.
+    for priority in ("fifo", "price"):
+        book = OrderBook(priority)
+        offers = [seller_info(peer_id, 'Fish', units, random.randint(1, 100)) for peer_id in range(sellers)]
+        for offer in offers:
+            book.upsert(offer)
+        sold = [0] * threads
+        restocked = [0]
+        oversold = []
+        def buyer(i):
+            rng = random.Random(i)
+            for _ in range(orders // threads):
+                reservation = book.reserve('Fish', rng.randint(1, 3))
+                if any(offer['product_count'] < 0 for offer, _ in reservation.fills):
+                    oversold.append(reservation)
+                if rng.random() < 0.1:
+                    book.release(reservation)
+                else:
+                    book.commit(reservation)
+                    sold[i] += reservation.units()
+        def seller():
+            rng = random.Random(threads)
+            for _ in range(orders // 10):
+                book.restock(rng.choice(offers), 1)
+                restocked[0] += 1
+        workers = [td.Thread(target=buyer, args=(i,)) for i in range(threads)] + [td.Thread(target=seller)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        left = sum(offer['product_count'] for offer in offers)
+        lost = sellers * units + restocked[0] - sum(sold) - left
+        print("order_book stress priority={:5}: {} orders on {} threads in {:.2f} s, {} units sold, {} left, {} oversold, {} lost, {} reserved".format(
+            priority, orders, threads, elapsed, sum(sold), left, len(oversold), lost, book.reserved()))
+        if oversold or lost or book.reserved() or min(offer['product_count'] for offer in offers) < 0:
+            sys.setswitchinterval(switch_interval)
+            raise RuntimeError("order_book priority={}: oversold or lost units".format(priority))
+    sys.setswitchinterval(switch_interval)
+
+
+# journal : Open and complete transactions in the trader's journal, then recover the unserved tail.
+def bench_journal(count=1000000, unserved=1000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "transactions_1.csv")
+        journal = data_ops.TransactionJournal(file_name)
+        tx = {'product_name':'Fish','buyer_id':{'peer_id':1,'host_addr':'127.0.0.1:20090'},
+              'seller_id':{'peer_id':2,'host_addr':'127.0.0.1:20091'}}
+        start = time.perf_counter()
+        for ts in range(count):
+            journal.log_opened(ts, tx, durable=False)
+            if ts < count - unserved:
+                journal.log_completed(ts)
+        journal.close()
+        elapsed = time.perf_counter() - start
+        print("journal: {} transactions in {:.2f} s, {:.0f} tx/s, log size {:.1f} MB".format(
+            count, elapsed, count / elapsed, os.path.getsize(file_name) / 1e6))
+
+        start = time.perf_counter()
+        requests = data_ops.get_unserved_requests(file_name)
+        print("journal: recovered {} unserved requests in {:.2f} ms".format(len(requests), (time.perf_counter() - start) * 1e3))
+
+        journal = data_ops.TransactionJournal(file_name)
+        start = time.perf_counter()
+        for ts in range(count, count + 10000):
+            journal.log_opened(ts, tx)
+            journal.log_completed(ts)
+        elapsed = time.perf_counter() - start
+        journal.close()
+        print("journal: durable open + complete on a {}-entry log: {:.1f} us/tx".format(count, elapsed / 10000 * 1e6))
+
+
+# analytics : Ingest of a trader's log into the columnar store (see analytics.py), then volume per
+# product per minute and wait percentiles by seller, against parsing the JSON lines for the same
+# answer, and the ingest of the records appended since.
+def bench_analytics(count=500000, appended=10000, unserved=1000):
+    import json
+    import numpy as np
+    from analytics import TradeStore
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "transactions_1.csv")
+        journal = data_ops.TransactionJournal(file_name)
+        def write(first, last):
+            for ts in range(first, last):
+                tx = {'product_name': PRODUCTS[ts % 3], 'buyer_id': {'peer_id': 100 + ts % 50, 'host_addr': '127.0.0.1:20090'},
+                      'seller_id': {'peer_id': 2 + ts % 30, 'host_addr': '127.0.0.1:20091'}, 'quantity': 1 + ts % 4}
+                journal.log_opened(ts, tx, durable=False)
+                if ts < last - unserved:
+                    journal.log_completed(ts)
+            journal.flush()
+        write(0, count)
+        store = TradeStore(os.path.join(tmp_dir, 'store'))
+        start = time.perf_counter()
+        store.ingest(file_name)
+        ingest = time.perf_counter() - start
+        print("analytics: ingest of {} trades in {:.2f} s, {:.0f} trades/s, log {:.1f} MB -> store {:.1f} MB".format(
+            count, ingest, count / ingest, os.path.getsize(file_name) / 1e6, store.summary()['bytes'] / 1e6))
+
+        start = time.perf_counter()
+        volume = store.volume('product', per=60)
+        waits = store.wait((50, 99), by='seller')
+        query = time.perf_counter() - start
+        start = time.perf_counter()
+        parsed = {}
+        opened = {}
+        seller_waits = {}
+        with open(file_name) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['op'] == 'opened':
+                    tx = record['tx']
+                    slot = (tx['product_name'], float(record['time'] / 1000 // 60 * 60))
+                    parsed[slot] = parsed.get(slot, 0) + tx['quantity']
+                    opened[record['ts']] = (tx['seller_id']['peer_id'], record['time'])
+                else:
+                    seller, opened_at = opened.pop(record['ts'])
+                    seller_waits.setdefault(seller, []).append(record['time'] / 1000 - opened_at / 1000)
+        parsed_waits = {seller: np.percentile(values, (50, 99)).tolist() for seller, values in seller_waits.items()}
+        scan = time.perf_counter() - start
+        print("analytics: volume per product per minute + wait p50/p99 by seller: {:.1f} ms vectorized, {:.0f} ms parsing the log "
+              "({:.0f}x), same answers: {}".format(query * 1e3, scan * 1e3, scan / query, volume == parsed and waits == parsed_waits))
+
+        write(count, count + appended)
+        journal.close()
+        start = time.perf_counter()
+        added = store.ingest(file_name)
+        incremental = time.perf_counter() - start
+        summary = store.summary()
+        print("analytics: incremental ingest of {} new trades in {:.1f} ms ({:.2f} us/trade), {} trades, {:.1%} completed".format(
+            added, incremental * 1e3, incremental / max(added, 1) * 1e6, summary['trades'], summary['completed']))
+
+
+# Proxy of a peer the way get_rpc built it before the connection pool: a new ServerProxy and a probe call.
+def legacy_get_rpc(host_addr):
+    a = xmlrpc.client.ServerProxy('http://' + str(host_addr) + '/')
+    try:
+        a.test()
+    except xmlrpc.client.Fault:
+        pass
+    except socket.error:
+        return False, None
+    return True, a
+
+def start_rpc_server(functions, handler=KeepAliveRequestHandler):
+    from market import AsyncXMLRPCServer
+    server = AsyncXMLRPCServer(('127.0.0.1', 0), allow_none=True, logRequests=False, requestHandler=handler)
+    server.daemon_threads = True
+    for name, function in functions.items():
+        server.register_function(function, name)
+    td.Thread(target=server.serve_forever, daemon=True).start()
+    return server, '127.0.0.1:' + str(server.server_address[1])
+
+# rpc : Trades per second with the RPC pattern of the run.sh setup, 3 buyers buying through one trader.
+# Each trade is a buyer lookup plus the trader's three calls (DB, buyer and seller).
+def bench_rpc(duration=5.0, buyers=3):
+    from xmlrpc.server import SimpleXMLRPCRequestHandler
+    for mode in ("legacy", "pooled"):
+        pool = ConnectionPool()
+        get_rpc = legacy_get_rpc if mode == "legacy" else (lambda host_addr: (True, pool.proxy(host_addr)))
+        handler = SimpleXMLRPCRequestHandler if mode == "legacy" else KeepAliveRequestHandler
+        peer_server, peer_addr = start_rpc_server({'transaction': lambda *args: True}, handler)
+        def lookup(buyer_id, product_name, buyer_clock):
+            seller = seller_info(2, product_name, 3)
+            for _ in range(3):
+                connected, proxy = get_rpc(peer_addr)
+                if connected:
+                    proxy.transaction(product_name, seller['seller_id'], buyer_id, 1)
+            return True
+        trader_server, trader_addr = start_rpc_server({'lookup': lookup}, handler)
+        trades = [0] * buyers
+        stop = time.perf_counter() + duration
+        def buyer(i):
+            while time.perf_counter() < stop:
+                connected, proxy = get_rpc(trader_addr)
+                if connected:
+                    proxy.lookup({'peer_id':i,'host_addr':peer_addr}, 'Fish', i)
+                    trades[i] += 1
+        threads = [td.Thread(target=buyer, args=(i,)) for i in range(buyers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print("rpc {:6}: {:.0f} trades/s".format(mode, sum(trades) / duration))
+        pool.close()
+        trader_server.shutdown()
+        peer_server.shutdown()
+
+
+# Trader, buyer and sellers as in-process peers on localhost, servers started. Returns the peers.
+def start_peers(roles, base_port=21090, **db):
+    from market import peer
+    peers = []
+    neighbors = [{'peer_id': i + 1, 'host_addr': '127.0.0.1:' + str(base_port + i), 'role': role} for i, role in enumerate(roles)]
+    for i, role in enumerate(roles):
+        peer_db = {'Role': role, 'Inv': {}, 'shop': []}
+        peer_db.update(db)
+        peers.append(peer(neighbors[i]['host_addr'], i + 1, [n for n in neighbors if n['peer_id'] != i + 1], peer_db))
+    for p in peers:
+        td.Thread(target=p.startServer, daemon=True).start()
+    time.sleep(0.5)
+    traders = [{'peer_id': p.peer_id, 'host_addr': p.host_addr, 'status': 1} for p in peers if p.db['Role'] == 'Trader']
+    for p in peers:
+        for trader in traders:
+            p.add_trader(dict(trader))
+    return peers
+
+# lookup_batch : Trades per second through one trader as the buyer's batch size grows.
+def bench_lookup_batch(batch_sizes=(1, 4, 16, 64), units=512):
+    import logging
+    logging.disable(logging.INFO)
+    for i, batch_size in enumerate(batch_sizes):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            trader, buyer, *sellers = start_peers(['Trader', 'Buyer', 'Seller', 'Seller', 'Seller'], 21090 + i * 10)
+            for j, seller in enumerate(sellers):
+                seller.db['Inv'] = {PRODUCTS[j]: 10 * units}
+                trader.register_products({'seller_id': {'peer_id': seller.peer_id, 'host_addr': seller.host_addr},
+                                          'product_name': PRODUCTS[j], 'product_count': 10 * units})
+            buyer_id = {'peer_id': buyer.peer_id, 'host_addr': buyer.host_addr}
+            _, proxy = buyer.get_rpc(trader.host_addr)
+            start = time.perf_counter()
+            for k in range(0, units, batch_size):
+                if batch_size == 1:
+                    proxy.lookup(buyer_id, PRODUCTS[k % 3], k)
+                else:
+                    proxy.lookup_batch(buyer_id, [[PRODUCTS[(k + n) % 3], 1, k + n] for n in range(batch_size)])
+            elapsed = time.perf_counter() - start
+            os.chdir(cwd)
+            print("lookup_batch batch_size={:>3}: {:.0f} trades/s".format(batch_size, buyer.shipment_count / elapsed))
+    logging.disable(logging.NOTSET)
+
+
+# recovery : A trader failed with N trades in flight. Time for its successor to replay them to the
+# buyer and the sellers, one RPC per receiver and trade in log order, then with the recovery pipeline.
+# A third of the trades had already reached the buyer before the failure and must not be served twice.
+def bench_recovery(sizes=(10000, 50000)):
+    import logging
+    import recovery
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        trader, buyer, *sellers = start_peers(['Trader', 'Buyer', 'Seller', 'Seller', 'Seller'], 21190)
+        for seller in sellers:
+            seller.db['Inv'] = {product: 10 ** 9 for product in PRODUCTS}
+        buyer_id = {'peer_id': buyer.peer_id, 'host_addr': buyer.host_addr}
+        for i, size in enumerate(sizes):
+            for mode in ("serial", "pipeline"):
+                failed_id = 100 + 2 * i + (mode == "pipeline")
+                journal = data_ops.TransactionJournal("transactions_" + str(failed_id) + ".csv")
+                for ts in range(1, size + 1):
+                    seller = sellers[ts % len(sellers)]
+                    journal.log_opened(ts, {'product_name': PRODUCTS[ts % 3], 'buyer_id': buyer_id, 'quantity': 1,
+                                            'seller_id': {'peer_id': seller.peer_id, 'host_addr': seller.host_addr}}, durable=False)
+                    if ts % 3 == 0: # Delivered to the buyer before the failure.
+                        buyer.transaction(PRODUCTS[ts % 3], seller.peer_info(), buyer_id, failed_id, 1, "{}:{}".format(failed_id, ts))
+                journal.close()
+                shipped = buyer.shipment_count
+                start = time.perf_counter()
+                if mode == "serial":
+                    trades = recovery.pending_trades("transactions_" + str(failed_id) + ".csv", failed_id)
+                    recovery.replay(trades, trader.deliver_replay, workers=1, batch_size=1)
+                else:
+                    trader.recover_trader({'peer_id': failed_id})
+                elapsed = time.perf_counter() - start
+                print("recovery {:8} pending={:>6}: {:.2f} s, {:.0f} requests/s, buyer served {} of {} missing".format(
+                    mode, size, elapsed, size / elapsed, buyer.shipment_count - shipped, size - size // 3))
+        for p in [trader, buyer] + sellers:
+            p.stop()
+        os.chdir(cwd)
+    logging.disable(logging.NOTSET)
+
+
+# db : Trades per second through one trader with the DB server on the critical path of every trade
+# ("DBWriteBehind": false) and with the write-behind cache, then the consistency of the DB with the
+# trader's cache and the restart time of the DB from its snapshot and WAL.
+def bench_db(units=2000):
+    import logging
+    from db_server import InventoryDB, DBServer
+    from admission import BUSY
+    logging.disable(logging.WARNING)
+    for i, write_behind in enumerate((False, True)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            inventory = InventoryDB(tmp_dir, snapshot_every=1000)
+            db_server = DBServer(('127.0.0.1', 21290 + i), inventory)
+            td.Thread(target=db_server.serve_forever, daemon=True).start()
+            trader, buyer, *sellers = start_peers(['Trader', 'Buyer', 'Seller', 'Seller', 'Seller'], 21300 + i * 10,
+                                                  DBServer='127.0.0.1:' + str(21290 + i), DBWriteBehind=write_behind, DBMaxPending=units // 2)
+            for j, seller in enumerate(sellers):
+                seller.db['Inv'] = {PRODUCTS[j]: 10 * units}
+                trader.register_products({'seller_id': {'peer_id': seller.peer_id, 'host_addr': seller.host_addr},
+                                          'product_name': PRODUCTS[j], 'product_count': 10 * units})
+            buyer_id = {'peer_id': buyer.peer_id, 'host_addr': buyer.host_addr}
+            _, proxy = buyer.get_rpc(trader.host_addr)
+            start = time.perf_counter()
+            for k in range(units):
+                proxy.lookup(buyer_id, PRODUCTS[k % 3], k)
+            elapsed = time.perf_counter() - start
+            trader.check_cache()
+            trader.check_cache()
+            db_counts = {seller_peer_id: seller['product_count'] for seller_peer_id, seller in inventory.get_inventory().items()}
+            cache_counts = {seller_peer_id: seller['product_count'] for seller_peer_id, seller in trader.trade_list.items()}
+            stats = trader.cache_stats()
+            print("db write_behind={!s:5}: {:.0f} trades/s, {} batches to the DB, max lag {:.0f} ms, DB consistent with the cache: {}, repairs {}".format(
+                write_behind, buyer.shipment_count / elapsed, stats['batches_flushed'], stats['max_lag'] * 1e3,
+                db_counts == cache_counts, stats['repairs']))
+            db_server.shutdown()
+            db_server.server_close()
+            if write_behind: # The DB is down: the queue stops growing at DBMaxPending, the lookups get busy.
+                trader.rpc_pool.close() # Its keep-alive connection to the DB would still be served.
+                replies = [proxy.lookup(buyer_id, PRODUCTS[k % 3], units + k) for k in range(units)]
+                print("db down: {} of {} lookups busy, {} updates queued, DBMaxPending {}".format(
+                    replies.count(BUSY), units, trader.db_cache.stats()['pending'], trader.db_cache.max_pending))
+            inventory.wal.close()
+            start = time.perf_counter()
+            restarted = InventoryDB(tmp_dir)
+            print("db restart from snapshot + {} WAL records: {:.1f} ms, same state: {}".format(
+                restarted.records, (time.perf_counter() - start) * 1e3, restarted.get_inventory() == inventory.get_inventory()))
+            restarted.close()
+            for p in [trader, buyer] + sellers:
+                p.stop()
+            os.chdir(cwd)
+    logging.disable(logging.NOTSET)
+
+
+# replication : Two traders sell their shards of N sellers to a buyer; each replicates its sellers
+# to the other. Reports the replication lag, the deltas and bytes sent per trade, and whether the
+# replicas match the owners' caches, after a lost update (gap) and after a trader fails.
+def bench_replication(sellers=60, trades=3000):
+    import logging
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        peers = start_peers(['Trader', 'Trader', 'Buyer'] + ['Seller'] * sellers, 21500)
+        traders, buyer = peers[:2], peers[2]
+        for j, seller in enumerate(peers[3:]):
+            seller.db['Inv'] = {PRODUCTS[j % 3]: 10 ** 6}
+            info = {'seller_id': {'peer_id': seller.peer_id, 'host_addr': seller.host_addr}, 'product_name': PRODUCTS[j % 3], 'product_count': 10 ** 6}
+            owner = next(t for t in traders if t.peer_id == buyer.get_trader(PRODUCTS[j % 3], seller.peer_id)['peer_id'])
+            owner.register_products(info)
+        buyer_id = {'peer_id': buyer.peer_id, 'host_addr': buyer.host_addr}
+
+        def consistent():
+            for owner, replica in ((traders[0], traders[1]), (traders[1], traders[0])):
+                for seller_peer_id, seller_info in owner.trade_list.items():
+                    copy = replica.replication.replicas.get(seller_peer_id)
+                    if copy is None or copy['seller_info']['product_count'] != seller_info['product_count']:
+                        return False
+            return True
+
+        def settle(timeout=10.0):
+            deadline = time.perf_counter() + timeout
+            while not consistent() and time.perf_counter() < deadline:
+                time.sleep(0.01)
+            return consistent()
+
+        settle()
+        before = [t.replication_stats() for t in traders]
+        start = time.perf_counter()
+        for k in range(trades):
+            j = k % sellers # An offer of the j-th seller, at the trader in charge of it.
+            owner_id = buyer.get_trader(PRODUCTS[j % 3], peers[3 + j].peer_id)['peer_id']
+            _, proxy = buyer.get_rpc(traders[owner_id - 1].host_addr)
+            proxy.lookup_batch(buyer_id, [[PRODUCTS[j % 3], 1, k]])
+        elapsed = time.perf_counter() - start
+        synced = settle()
+        after = [t.replication_stats() for t in traders]
+        deltas = sum(a['deltas_sent'] - b['deltas_sent'] for a, b in zip(after, before))
+        sent = sum(a['payload_bytes'] - b['payload_bytes'] for a, b in zip(after, before))
+        lag = max(a['lag_max'] for a in after)
+        print("replication sellers={} trades={}: {:.0f} trades/s, {:.2f} deltas/trade, {:.0f} bytes/trade, lag max {:.0f} ms, replicas consistent: {}".format(
+            sellers, trades, trades / elapsed, deltas / trades, sent / trades, lag * 1e3, synced))
+
+        lost = next(iter(traders[0].trade_list)) # Trader 2 loses its replica of a seller, the next delta has a gap.
+        traders[1].replication.replicas.pop(lost, None)
+        traders[0].replication.publish(traders[0].trade_list[lost])
+        synced = settle()
+        print("replication after a gap: {} gaps, replicas consistent: {}".format(sum(t.replication_stats()['gaps'] for t in traders), synced))
+
+        owned = dict(traders[0].trade_list)
+        traders[0].stop()
+        start = time.perf_counter()
+        traders[1].trader_status_update(False, traders[0].peer_info())
+        took_over = all(traders[1].trade_list.get(seller_peer_id, {}).get('product_count') == seller_info['product_count']
+                        for seller_peer_id, seller_info in owned.items())
+        print("replication failover: {} sellers taken over in {:.1f} ms with their counts: {}".format(
+            len(owned), (time.perf_counter() - start) * 1e3, took_over))
+        for p in peers[1:]:
+            p.stop()
+        os.chdir(cwd)
+    bench_replication_claims()
+    logging.disable(logging.NOTSET)
+
+
+# replication_claims : Two traders claim an offer, with vector clocks. Trader 1 takes the offer of trader 2 over,
+# at a lower Lamport stamp than trader 2's last state, then gets that state again, late: by the Lamport stamps
+# the offer would go back to trader 2, the vector clocks keep the later state. Then both traders change
+# another offer without knowing of each other, a concurrent claim.
+def bench_replication_claims():
+    from replication import ReplicationChannel
+    from clocks import VectorClock
+    lamport = {1: 0, 2: 0}
+    channels = {}
+    sent = []
+    def send(other, deltas):
+        sent.append(deltas)
+        return channels[other].receive(deltas)
+    for peer_id in (1, 2):
+        channels[peer_id] = ReplicationChannel(peer_id, lambda peer_id=peer_id: [3 - peer_id], send, lambda peer_id=peer_id: lamport[peer_id],
+                                               lambda key: None, vector_clock=VectorClock(peer_id))
+    taken, shared = ({'seller_id': {'peer_id': seller, 'host_addr': ''}, 'product_name': 'Fish', 'product_count': 10} for seller in (10, 11))
+    lamport[2] = 5
+    channels[2].publish(taken)
+    channels[2].flush()
+    lamport[1] = 3
+    channels[1].adopt(offer_key(taken)) # Trader 2 was suspected.
+    channels[1].receive(sent[0]) # Its last state, delivered again.
+    later_kept = offer_key(taken) in channels[1].owned
+    channels[1].publish(shared)
+    channels[2].publish(dict(shared, product_count=9))
+    channels[1].flush()
+    channels[2].flush()
+    print("replication claims with vector clocks: later state kept over a higher Lamport stamp: {}, concurrent claims detected: {}".format(
+        later_kept, sum(channel.stats()['concurrent'] for channel in channels.values())))
+
+
+# clocks : Clock messages per trade with N peers (half buyers, half sellers), with the clock broadcast
+# at every request, and with gossip (one round every `trades_per_round` trades). The peers are not
+# started, their multicast calls the receivers directly and counts the messages. A trade itself takes
+# 3 messages (lookup and the buyer and seller notifications) that carry the clock already. Reports how
+# many more gossip rounds it takes for every peer to know the highest clock.
+def bench_clocks(sizes=(10, 100, 500), trades=200, trades_per_round=10):
+    import logging
+    from market import peer
+    logging.disable(logging.INFO)
+    for size in sizes:
+        for mode in ("broadcast", "gossip"):
+            addrs = ['127.0.0.1:' + str(23000 + j) for j in range(size)]
+            roles = ['Buyer' if j % 2 == 0 else 'Seller' for j in range(size)]
+            neighbors = [{'peer_id': j + 1, 'host_addr': addrs[j], 'role': roles[j]} for j in range(size)]
+            peers = [peer(addrs[j], j + 1, [n for n in neighbors if n['peer_id'] != j + 1],
+                          {'Role': roles[j], 'Inv': {}, 'shop': [], 'ClockPropagation': mode}) for j in range(size)]
+            by_addr = {p.host_addr: p for p in peers}
+            messages = [0]
+
+            def in_memory_multicast(neighbors, method, *args):
+                for neighbor in neighbors:
+                    messages[0] += 1
+                    getattr(by_addr[neighbor['host_addr']], method)(*args)
+            for p in peers:
+                p.multicast = in_memory_multicast
+
+            buyers = [p for p in peers if p.db['Role'] == 'Buyer']
+            for k in range(trades):
+                buyers[k % len(buyers)].stamp_requests(['Fish'])
+                if mode == "gossip" and k % trades_per_round == trades_per_round - 1:
+                    for p in peers:
+                        p.clock_gossip.tick()
+            clock_messages = messages[0]
+            rounds = 0
+            highest = max(p.lamport_clock.value for p in peers)
+            while any(p.lamport_clock.value < highest for p in peers) and rounds < 100:
+                for p in peers:
+                    p.clock_gossip.tick()
+                rounds += 1
+            print("clocks peers={:>3} {:9}: {:7.1f} clock messages/trade, {:7.1f} messages/trade in all, all clocks up to date after {} more rounds".format(
+                size, mode, clock_messages / trades, clock_messages / trades + 3, rounds if mode == "gossip" else 0))
+    logging.disable(logging.NOTSET)
+
+
+# async_fanout : One buyer broadcasts its Lamport clock to N neighbors, with the threaded and the
+# asyncio runtime. Reports the peak thread count, the peak Python memory allocated during the
+# broadcast and the time until every neighbor has received the clock.
+def bench_async_fanout(sizes=(50, 200, 1000)):
+    import asyncio
+    import tracemalloc
+    from market import peer
+    from async_runtime import AsyncPeer, AsyncRPCServer
+    received = {'count': 0, 'expected': 0}
+    done = td.Event()
+    async def adjust_buyer_clock(other):
+        received['count'] += 1
+        if received['count'] == received['expected']:
+            done.set()
+        return None
+    sink_loop = asyncio.new_event_loop()
+    td.Thread(target=sink_loop.run_forever, daemon=True).start()
+    sink = AsyncRPCServer({'adjust_buyer_clock': adjust_buyer_clock})
+    for i, size in enumerate(sizes):
+        servers = [asyncio.run_coroutine_threadsafe(sink.start('127.0.0.1', 0), sink_loop).result() for _ in range(size)]
+        neighbors = [{'peer_id': j + 2, 'host_addr': '127.0.0.1:' + str(server.sockets[0].getsockname()[1]), 'role': 'Seller'}
+                     for j, server in enumerate(servers)]
+        for mode, peer_class in (("thread", peer), ("asyncio", AsyncPeer)):
+            buyer = peer_class('127.0.0.1:0', 1, neighbors, {'Role': 'Buyer', 'Inv': {}, 'shop': []})
+            latencies = []
+            for run in range(3): # The first broadcast opens the connections.
+                received['count'], received['expected'] = 0, size
+                done.clear()
+                tracemalloc.start()
+                base_threads = td.active_count()
+                peak_threads = base_threads
+                start = time.perf_counter()
+                buyer.broadcast_lamport_clock()
+                while not done.wait(0.001):
+                    peak_threads = max(peak_threads, td.active_count())
+                latencies.append(time.perf_counter() - start)
+                _, peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            print("async_fanout peers={:>4} runtime={:7}: +{:>4} threads, {:>7.0f} KB, {:7.1f} ms broadcast".format(
+                size, mode, peak_threads - base_threads, peak_memory / 1024, min(latencies[1:]) * 1e3))
+            buyer.rpc_pool.close()
+        for server in servers:
+            sink_loop.call_soon_threadsafe(server.close)
+
+
+# wire : Encode + decode cost and size of the lookup and transaction messages, XML-RPC vs the binary protocol.
+def bench_wire(rounds=20000):
+    import wire
+    buyer_id = {'peer_id': 1, 'host_addr': '127.0.0.1:20090'}
+    seller = seller_info(2, 'Fish', 3)
+    messages = {
+        'lookup': ('lookup', (buyer_id, 'Fish', 42)),
+        'transaction': ('transaction', ('Fish', seller['seller_id'], buyer_id, 6, 1)),
+        'lookup_batch(16)': ('lookup_batch', (buyer_id, [[PRODUCTS[i % 3], 1, 42 + i] for i in range(16)])),
+    }
+    for name, (method, args) in messages.items():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            data = xmlrpc.client.dumps(args, method, allow_none=True).encode()
+            xmlrpc.client.loads(data)
+        xml_time = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            payload = wire.encode([method, list(args)])
+            wire.decode(payload)
+        wire_time = (time.perf_counter() - start) / rounds
+        print("wire {:17}: xmlrpc {:6.1f} us {:5} B | binary {:6.1f} us {:5} B".format(
+            name, xml_time * 1e6, len(data), wire_time * 1e6, len(payload) + 4))
+
+
+# sharding : Requests looked up by every trader of simulated clusters (see simulator.py) with the three
+# products of the market, where a trader takes `service_time` seconds per message. With "ProductShards"
+# 1, a key per product, at most three traders get requests; with sub-shards, all of them. Also the share
+# of the keys that move when a trader fails.
+def bench_sharding(trader_counts=(2, 4, 8, 12), product_shards=(1, 16), buyers=300, sellers=120, rate=10.0, duration=5.0, service_time=0.002):
+    import logging
+    import simulator
+    from sharding import ConsistentHashRing
+    logging.disable(logging.ERROR)
+    for count in trader_counts:
+        for shards in product_shards:
+            result = simulator.simulate_load(buyers, sellers, count, rate, duration, elect=False, service_time=service_time, ProductShards=shards)
+            loads = list(result['lookups'].values())
+            mean = sum(loads) / len(loads)
+            ring = ConsistentHashRing()
+            for peer_id in result['lookups']:
+                ring.add({'peer_id': peer_id, 'host_addr': 'sim:' + str(peer_id), 'status': 1})
+            keys = ["{}#{}".format(product, shard) for product in PRODUCTS for shard in range(shards)]
+            before = {key: ring.owner(key)['peer_id'] for key in keys}
+            ring.remove(max(result['lookups']))
+            moved = sum(1 for key in keys if ring.owner(key)['peer_id'] != before[key])
+            print("sharding traders={:>2} shards={:>2}: {:6.1f} trades/s of {:.0f}, lookups per trader {}, busiest {:.2f}x the mean, "
+                  "{} idle, {:.0f}% of the keys move on failure".format(count, shards, result['throughput'], result['rate'],
+                  loads, max(loads) / mean if mean else 0.0, loads.count(0), moved * 100.0 / len(keys)))
+    logging.disable(logging.NOTSET)
+
+
+# election : Starts N peers on localhost (half buyers, half sellers) and measures the time until every
+# peer knows all the traders, the time to the first trade, and the failover: from a trader crash to every
+# peer routing around it (found by the failure detectors), and to a replacement being elected by every peer.
+def bench_election(sizes=(6, 20, 50), traders=2, sla=1.0):
+    import logging
+    from market import peer
+    logging.disable(logging.INFO)
+    for i, size in enumerate(sizes):
+        addrs = ['127.0.0.1:' + str(22000 + i * 100 + j) for j in range(size)]
+        roles = ['Buyer' if j % 2 == 0 else 'Seller' for j in range(size)]
+        neighbors = [{'peer_id': j + 1, 'host_addr': addrs[j], 'role': roles[j]} for j in range(size)]
+        peers = []
+        for j in range(size):
+            db = {'Role': roles[j], 'Inv': {PRODUCTS[j % 3]: 100}, 'shop': list(PRODUCTS) * 3,
+                  'Traders': traders, 'StartDelay': 0.2, 'DetectionSLA': sla}
+            peers.append(peer(addrs[j], j + 1, [n for n in neighbors if n['peer_id'] != j + 1], db))
+        for p in peers:
+            td.Thread(target=p.startServer, daemon=True).start()
+        time.sleep(0.5)
+
+        def wait_until(condition, timeout=60.0):
+            deadline = time.perf_counter() + timeout
+            while not condition():
+                if time.perf_counter() > deadline:
+                    return None
+                time.sleep(0.001)
+            return time.perf_counter()
+
+        start = time.perf_counter()
+        for p in peers[:2]: # As in market.py, peers 1 and 2 start the election.
+            td.Thread(target=p.start_election, daemon=True).start()
+        elected = wait_until(lambda: all(len(p.active_traders()) == traders for p in peers))
+        first_trade = wait_until(lambda: any(p.shipment_count > 0 for p in peers))
+
+        crashed = max(peers, key=lambda p: p.peer_id if p.db['Role'] == 'Trader' else 0)
+        crashed.stop()
+        alive = [p for p in peers if p is not crashed]
+        failover_start = time.perf_counter()
+        rerouted = wait_until(lambda: all(crashed.peer_id not in [t['peer_id'] for t in p.active_traders()] for p in alive))
+        failover = wait_until(lambda: all(len(p.active_traders()) == traders for p in alive))
+        detection = [p.failover_stats()['detection_latency_max'] for p in alive]
+        detection = [latency for latency in detection if latency is not None]
+        print("election peers={:>3}: all traders known {:6.0f} ms, first trade {:6.0f} ms, failover: all rerouted {:6.0f} ms, "
+              "re-election {:6.0f} ms, detection silence max {:4.0f} ms (SLA {:.0f} ms)".format(
+            size, (elected - start) * 1e3, (first_trade - start) * 1e3, (rerouted - failover_start) * 1e3,
+            (failover - failover_start) * 1e3, max(detection) * 1e3, sla * 1e3))
+        for p in alive:
+            p.stop()
+    logging.disable(logging.NOTSET)
+
+
+# overload_clients : `clients` buyers sending a lookup to a trader every `interval` seconds until `stop`
+# (wall clock), backing off for `backoff` seconds after a busy reply. Puts the exported latency
+# histogram and the counts on `results`.
+def overload_clients(trader_addr, buyer_id, clients, stop, results, interval=0.2, backoff=1.0):
+    from admission import BUSY
+    from metrics import Histogram
+    from rpc_pool import KeepAliveTransport
+    latency = Histogram()
+    counts = {'served': 0, 'busy': 0}
+    def client(k):
+        proxy = xmlrpc.client.ServerProxy('http://' + trader_addr + '/', transport=KeepAliveTransport(2.0, 30.0), allow_none=True)
+        while time.time() < stop:
+            start = time.perf_counter()
+            try:
+                reply = proxy.lookup(buyer_id, PRODUCTS[k % 3], k)
+            except (OSError, xmlrpc.client.Error):
+                continue
+            if reply == BUSY:
+                counts['busy'] += 1
+                time.sleep(backoff * random.uniform(0.5, 1.5))
+            else:
+                latency.record(time.perf_counter() - start)
+                counts['served'] += 1
+                time.sleep(max(interval - (time.perf_counter() - start), 0))
+    threads = [td.Thread(target=client, args=(k,), daemon=True) for k in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((latency.export(), counts))
+
+# overload : A burst of buyers on one trader, 5 lookups per second each, more than it can serve, with
+# one thread per request (TraderWorkers 0) and with bounded worker pools. Every peer runs in its own process (see
+# launcher.py) and the buyers in 4 more. Reports the lookups served per second, their latency, the
+# busy replies and the longest wait in the trader's admission queue.
+def bench_overload(clients=200, duration=5.0, worker_counts=(0, 8, 32), processes=4):
+    import multiprocessing
+    import launcher
+    from metrics import Histogram
+    context = multiprocessing.get_context('fork')
+    for i, workers in enumerate(worker_counts):
+        spec = launcher.cluster_spec(1, 3, traders=1, units=1000000, StartDelay=0.5, TraderWorkers=workers,
+                                     TraderQueue=64, TraderQueueTimeout=0.5)
+        cluster = launcher.Cluster(spec, 24600 + i * 10, 9263 + i)
+        try:
+            cluster.start()
+            trader_id, = cluster.wait_for_traders(1)
+            time.sleep(1.0) # The sellers register their products.
+            buyer_id = {'peer_id': 1, 'host_addr': cluster.host_addr(1)}
+            results = context.Queue()
+            stop = time.time() + duration
+            children = [context.Process(target=overload_clients, args=(cluster.host_addr(trader_id), buyer_id, clients // processes, stop, results))
+                        for _ in range(processes)]
+            for child in children:
+                child.start()
+            latency = Histogram()
+            counts = {'served': 0, 'busy': 0}
+            for _ in children:
+                exported, child_counts = results.get()
+                latency.merge(exported)
+                for name in counts:
+                    counts[name] += child_counts[name]
+            for child in children:
+                child.join()
+            queue_wait = cluster.proxy(trader_id).stats()['histograms'].get('admission.wait', {}).get('max', 0.0)
+        finally:
+            cluster.stop()
+        print("overload clients={} workers={:>3}: {:6.0f} lookups/s served, p50 {:6.1f} ms, p99 {:7.1f} ms, {:5} busy replies, queue wait max {:4.0f} ms".format(
+            clients, workers or 'off', counts['served'] / duration, latency.percentile(0.5) * 1e3, latency.percentile(0.99) * 1e3,
+            counts['busy'], queue_wait * 1e3))
+
+
+# concurrency : Stress of the trader's state with thousands of concurrent buyers.
+# 1) The order book alone: `buyers` threads reserve units of 3 products while the sellers re-register
+#    new offers, one reservation in 10 is released as if its log write had failed. Every offer must
+#    end with the units it was registered with less the units committed from it, none below zero.
+# 2) A whole trader: `buyers` threads call its lookup at once for fewer units than they want, the
+#    sellers restock as they sell out. The units the sellers gave up must be the trades the trader
+#    matched and the units the buyer received, no oversold count and no lost update.
+def bench_concurrency(buyers=2000, orders=20, sellers=30, units=50):
+    import logging
+    book = OrderBook()
+    registered = [] # Every offer ever registered, with its units.
+    committed = {}  # id(offer) -> units committed from it
+    accounting = td.Lock()
+    def register(peer_id):
+        offer = seller_info(peer_id, PRODUCTS[peer_id % 3], units)
+        with accounting:
+            registered.append((offer, units))
+        book.upsert(offer)
+    for peer_id in range(sellers):
+        register(peer_id)
+    stop = td.Event()
+    def restock():
+        while not stop.is_set():
+            register(random.randrange(sellers))
+            time.sleep(0.001)
+    def buyer(seed):
+        rng = random.Random(seed)
+        for _ in range(orders):
+            reservation = book.reserve(rng.choice(PRODUCTS), rng.randint(1, 3))
+            if rng.random() < 0.1:
+                book.release(reservation)
+                continue
+            book.commit(reservation)
+            with accounting:
+                for offer, sold in reservation.fills:
+                    committed[id(offer)] = committed.get(id(offer), 0) + sold
+    restocker = td.Thread(target=restock)
+    threads = [td.Thread(target=buyer, args=(i,)) for i in range(buyers)]
+    start = time.perf_counter()
+    restocker.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    restocker.join()
+    oversold = sum(1 for offer, _ in registered if offer['product_count'] < 0)
+    lost = sum(1 for offer, count in registered if offer['product_count'] != count - committed.get(id(offer), 0))
+    print("concurrency order_book buyers={} reservations={}: {:.0f} reservations/s, {} offers, {} oversold, {} lost updates, {} units still reserved".format(
+        buyers, buyers * orders, buyers * orders / elapsed, len(registered), oversold, lost, book.reserved()))
+
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        trader, buyer_peer, *seller_peers = start_peers(['Trader', 'Buyer', 'Seller', 'Seller', 'Seller'], 21700, ReadTimeout=120.0)
+        for j, seller in enumerate(seller_peers):
+            seller.db['Inv'] = {PRODUCTS[j]: units}
+            seller.offers[PRODUCTS[j]] = {'seller_id': {'peer_id': seller.peer_id, 'host_addr': seller.host_addr}, 'product_name': PRODUCTS[j], 'product_count': units}
+            trader.register_products(dict(seller.offers[PRODUCTS[j]]))
+        buyer_id = {'peer_id': buyer_peer.peer_id, 'host_addr': buyer_peer.host_addr}
+        barrier = td.Barrier(buyers)
+        def lookup(i):
+            barrier.wait()
+            trader.lookup(buyer_id, PRODUCTS[i % 3], i)
+        threads = [td.Thread(target=lookup, args=(i,)) for i in range(buyers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        matched = trader.metrics.snapshot()['counters'].get('matched', 0)
+        given_up = sum(units + 3 * seller.metrics.snapshot()['counters'].get('restocks', 0) - sum(seller.db['Inv'].values())
+                       for seller in seller_peers)
+        oversold = sum(1 for seller in seller_peers for count in seller.db['Inv'].values() if count < 0)
+        for p in [trader, buyer_peer] + seller_peers:
+            p.stop()
+        os.chdir(cwd)
+    logging.disable(logging.NOTSET)
+    print("concurrency trader buyers={}: {:.0f} lookups/s, {} matched, {} units sold by the sellers, {} received by the buyer, {} oversold counts".format(
+        buyers, buyers / elapsed, matched, given_up, buyer_peer.shipment_count, oversold))
+
+
+# restock : Restock traffic from the sellers to the trader as the stock turns over faster.
+# 1) Every seller gets `sales` sale notifications from 4 threads, as fast as they come, and restocks
+#    one unit at every sale: restock messages per second with a message per restock (RestockBatch 1)
+#    and with the restocks coalesced. The trader must end with every unit restocked on offer.
+# 2) `buyers` threads order 1 to 5 units at a time through the trader, filled from as many sellers as
+#    it takes, the sellers restock 3 units as they sell out. The trader's offers must then match the
+#    sellers' inventories.
+def bench_restock(batches=(1, 512), sellers=4, sales=2000, buyers=8, duration=3.0):
+    import logging
+    logging.disable(logging.WARNING)
+    for i, batch in enumerate(batches + (None,)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            trader, buyer, *seller_peers = start_peers(['Trader', 'Buyer'] + ['Seller'] * sellers, 21800 + i * 20,
+                                                       RestockUnits=1 if batch else 3, RestockBatch=batch or 512, ClockPropagation='piggyback')
+            for seller in seller_peers:
+                seller.db['Inv'] = {product_name: 3 for product_name in PRODUCTS}
+                seller.begin_trading()
+            buyer_id = {'peer_id': buyer.peer_id, 'host_addr': buyer.host_addr}
+            if batch:
+                def sell(seller, n):
+                    seller_id = {'peer_id': seller.peer_id, 'host_addr': seller.host_addr}
+                    for k in range(n):
+                        product_name = PRODUCTS[k % 3]
+                        seller.inventory_semaphore.acquire()
+                        seller.db['Inv'][product_name] = max(seller.db['Inv'][product_name], 1) # Always one to sell.
+                        seller.inventory_semaphore.release()
+                        seller.transaction(product_name, seller_id, buyer_id, trader.peer_id, 1)
+                threads = [td.Thread(target=sell, args=(seller, sales // 4)) for seller in seller_peers for _ in range(4)]
+            else:
+                deadline = time.perf_counter() + duration
+                def order(k):
+                    rng = random.Random(k)
+                    _, proxy = buyer.get_rpc(trader.host_addr)
+                    while time.perf_counter() < deadline:
+                        proxy.lookup(buyer_id, rng.choice(PRODUCTS), 0, rng.randint(1, 5))
+                threads = [td.Thread(target=order, args=(k,)) for k in range(buyers)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            while any(seller.restocks.stats()['pending'] for seller in seller_peers): # The last restocks.
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            time.sleep(0.1)
+            restocks = sum(seller.metrics.snapshot()['counters'].get('restocks', 0) for seller in seller_peers)
+            messages = trader.metrics.histogram('rpc.restock').count
+            offered = sum(offer['product_count'] for offer in trader.trade_list.values())
+            if batch:
+                print("restock batch={:>3}: {:6.0f} restocks/s, {:5.0f} restock messages/s, {:.1f} restocks per message, all on offer: {}".format(
+                    batch, restocks / elapsed, messages / elapsed, restocks / max(messages, 1), offered == 3 * 3 * sellers + restocks))
+            else:
+                consistent = all(trader.trade_list.get('{}:{}'.format(seller.peer_id, product_name), {}).get('product_count', 0) == count
+                                 for seller in seller_peers for product_name, count in seller.db['Inv'].items())
+                print("restock orders of 1-5 units: {:.0f} units sold/s, {:.0f} restocks/s, {:.0f} restock messages/s, offers match the sellers: {}".format(
+                    buyer.shipment_count / elapsed, restocks / elapsed, messages / elapsed, consistent))
+            for p in [trader, buyer] + seller_peers:
+                p.stop()
+            os.chdir(cwd)
+    logging.disable(logging.NOTSET)
+
+
+# metrics : Cost of the instrumentation. Recording a value and timing a call, against the time of a
+# lookup through a trader, then the size and time of a snapshot fetched with GET /stats.
+def bench_metrics(count=200000, lookups=2000):
+    import json
+    import logging
+    import urllib.request
+    from metrics import Histogram, Metrics
+    histogram = Histogram()
+    start = time.perf_counter()
+    for i in range(count):
+        histogram.record(1e-4 * (i % 100 + 1))
+    record = (time.perf_counter() - start) / count
+    metrics = Metrics()
+    function = lambda *args: None
+    timed = metrics.timed('function', function)
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    bare = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(count):
+        timed()
+    overhead = (time.perf_counter() - start - bare) / count
+
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        trader, buyer, seller = start_peers(['Trader', 'Buyer', 'Seller'], 21190)
+        seller.db['Inv'] = {'Fish': lookups}
+        trader.register_products({'seller_id': {'peer_id': seller.peer_id, 'host_addr': seller.host_addr},
+                                  'product_name': 'Fish', 'product_count': lookups})
+        _, proxy = buyer.get_rpc(trader.host_addr)
+        for k in range(lookups):
+            proxy.lookup({'peer_id': buyer.peer_id, 'host_addr': buyer.host_addr}, 'Fish', k)
+        start = time.perf_counter()
+        body = urllib.request.urlopen('http://' + trader.host_addr + '/stats').read()
+        fetch = time.perf_counter() - start
+        lookup = json.loads(body)['histograms']['rpc.lookup']
+        os.chdir(cwd)
+    logging.disable(logging.NOTSET)
+    print("metrics: record {:.2f} us, timed call overhead {:.2f} us = {:.2f}% of a lookup (p50 {:.0f} us over {} lookups)".format(
+        record * 1e6, overhead * 1e6, overhead / lookup['p50'] * 100, lookup['p50'] * 1e6, lookup['count']))
+    print("metrics: GET /stats of the trader {:.1f} ms, {:.1f} KB".format(fetch * 1e3, len(body) / 1024))
+
+
+# tracing : Cost of the request tracing (see tracing.py): a call outside of a trace and a span, then the
+# latency of a buyer's requests through a trader with tracing off and on, and the report rebuilt from
+# the dumps of the peers and the DB server.
+def bench_tracing(count=200000, lookups=2000):
+    import logging
+    import tracing
+    from db_server import InventoryDB, DBServer
+    tracer = tracing.Tracer(1, capacity=count)
+    function = lambda *args: None
+    traced = tracer.traced('function', function)
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    bare = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(count):
+        traced()
+    untraced = (time.perf_counter() - start - bare) / count
+    with tracer.trace('bench', '1:0'):
+        start = time.perf_counter()
+        for _ in range(count):
+            with tracer.span('span'):
+                pass
+        span = (time.perf_counter() - start) / count
+    print("tracing: call outside of a trace {:.2f} us, span {:.2f} us".format(untraced * 1e6, span * 1e6))
+
+    logging.disable(logging.WARNING)
+    for i, enabled in enumerate((False, True)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            inventory = InventoryDB(tmp_dir)
+            db_server = DBServer(('127.0.0.1', 21990 + i), inventory)
+            td.Thread(target=db_server.serve_forever, daemon=True).start()
+            peers = start_peers(['Trader', 'Buyer', 'Seller'], 21900 + i * 10, DBServer='127.0.0.1:' + str(21990 + i), Tracing=enabled)
+            trader, buyer, seller = peers
+            seller.db['Inv'] = {'Fish': lookups}
+            trader.register_products({'seller_id': {'peer_id': seller.peer_id, 'host_addr': seller.host_addr},
+                                      'product_name': 'Fish', 'product_count': lookups})
+            for _ in range(lookups):
+                buyer.send_requests(buyer.stamp_requests(['Fish']))
+            latency = buyer.metrics.histogram('request')
+            print("tracing {:3}: {} requests, p50 {:.0f} us, p99 {:.0f} us".format(
+                'on' if enabled else 'off', latency.count, latency.percentile(0.50) * 1e6, latency.percentile(0.99) * 1e6))
+            if enabled:
+                trader.db_cache.flush() # The last trades are completed.
+                dumps = [p.tracer.dump() for p in peers] + [db_server.tracer.dump()]
+                traces = tracing.merge([dict(zip(tracing.FIELDS, span)) for dump in dumps for span in dump])
+                print(tracing.report(traces, slowest=1))
+            for p in peers:
+                p.stop()
+            db_server.shutdown()
+            db_server.server_close()
+            inventory.close()
+            os.chdir(cwd)
+    logging.disable(logging.NOTSET)
+
+
+# logging : Cost of the peers' logging (see event_log.py). A purchase logged the way it was, formatted
+# with the time and written to the log file by the caller, against an event queued for the writer
+# thread; then the latency of a buyer's requests through a trader with the events off, as text lines
+# in the log and as JSON lines.
+def bench_logging(count=100000, lookups=2000):
+    import atexit
+    import logging
+    import datetime
+    from event_log import EventLog, configure_logging
+    root = logging.getLogger()
+    level = root.level
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        handler = logging.FileHandler('eager.log')
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+        start = time.perf_counter()
+        for k in range(count):
+            logging.info("[{}][Peer {}] has purchased {} x {} from Peer {} through {}".format(datetime.datetime.now(), 1, 1, 'Fish', 2, 3))
+        eager = (time.perf_counter() - start) / count
+        root.removeHandler(handler)
+        handler.close()
+        events = EventLog(1, target='events.jsonl', max_queue=count)
+        start = time.perf_counter()
+        for k in range(count):
+            events.log('purchase', quantity=1, product='Fish', seller=2, trader=3)
+        queued = (time.perf_counter() - start) / count
+        events.flush(60.0)
+        print("logging: eager format and write {:.2f} us per message, event queued {:.2f} us, written by the thread in {:.2f} us, {:.0f} bytes".format(
+            eager * 1e6, queued * 1e6, (time.perf_counter() - start) / count * 1e6, os.path.getsize('events.jsonl') / count))
+
+        stream = open('peers.log', 'w')
+        listener = configure_logging(logging.INFO, stream)
+        queue_handler = root.handlers[-1]
+        logging.getLogger('rpc_pool').setLevel(logging.ERROR)
+        for i, (name, settings) in enumerate([('off', dict(EventLog=False)), ('text', {}),
+                                              ('jsonl', dict(EventLog='events_{peer_id}.jsonl'))]):
+            peers = start_peers(['Trader', 'Buyer', 'Seller'], 22000 + i * 10, **settings)
+            trader, buyer, seller = peers
+            seller.db['Inv'] = {'Fish': lookups}
+            trader.register_products({'seller_id': {'peer_id': seller.peer_id, 'host_addr': seller.host_addr},
+                                      'product_name': 'Fish', 'product_count': lookups})
+            for _ in range(lookups):
+                buyer.send_requests(buyer.stamp_requests(['Fish']))
+            latency = buyer.metrics.histogram('request')
+            lookup = trader.metrics.histogram('rpc.lookup')
+            for p in peers:
+                p.stop()
+            logged = sum(p.events.logged for p in peers)
+            print("logging {:5}: {} requests, p50 {:.0f} us, p99 {:.0f} us, trader lookup p50 {:.0f} us, {} events".format(
+                name, latency.count, latency.percentile(0.50) * 1e6, latency.percentile(0.99) * 1e6, lookup.percentile(0.50) * 1e6, logged))
+        root.removeHandler(queue_handler)
+        listener.stop()
+        atexit.unregister(listener.stop)
+        stream.close()
+        logging.getLogger('rpc_pool').setLevel(logging.NOTSET)
+        root.setLevel(level)
+        os.chdir(cwd)
+
+
+# simulator : Elections, trading and failover of simulated clusters (see simulator.py), in virtual time,
+# up to `large` peers. Every scenario elects its traders and crashes one of them; a cluster that does not
+# agree on its traders, or does not replace the crashed one, fails the benchmark. The first scenario is
+# run twice, a simulation must take the same course for the same seed.
+def bench_simulator(sizes=(100, 500), large=10000, lossy=0.01):
+    import logging
+    import simulator
+    logging.disable(logging.ERROR)
+    scenarios = [("peers={}, trader crash".format(size), dict(buyers=size // 2, sellers=size // 2, rate=1.0, duration=10.0, fail_at=4.0))
+                 for size in sizes]
+    scenarios.append(("peers={}, {:.0%} lost".format(sizes[0], lossy), dict(buyers=sizes[0] // 2, sellers=sizes[0] // 2, rate=1.0,
+                                                                         duration=10.0, fail_at=4.0, drop=lossy)))
+    scenarios.append(("peers={}, vector clocks".format(sizes[0]), dict(buyers=sizes[0] // 2, sellers=sizes[0] // 2, rate=1.0,
+                                                                   duration=10.0, fail_at=4.0, Clock='vector')))
+    scenarios.append(("peers={}, trader crash".format(large), dict(buyers=large // 2, sellers=large // 2, rate=1.0, duration=6.0, fail_at=3.0)))
+    for i, (name, arguments) in enumerate(scenarios):
+        result = simulator.simulate_load(**arguments)
+        print(simulator.format_simulation(name, result))
+        if result['replaced'] is None:
+            raise RuntimeError("{}: the crashed trader was not replaced".format(name))
+        if arguments.get('Clock') == 'vector':
+            print("simulator: {} concurrent claims of an offer between the traders".format(result['concurrent']))
+        if i == 0:
+            again = simulator.simulate_load(**arguments)
+            same = all(again[key] == result[key] for key in result if key != 'wall')
+            print("simulator: same seed, same run: {}".format(same))
+    logging.disable(logging.NOTSET)
+
+
+# cluster : Throughput, lookup latency and failover of whole clusters, every peer in its own process.
+# The scenarios are the launcher's suite (see launcher.py).
+def bench_cluster():
+    import launcher
+    launcher.run_suite()
+
+
+BENCHMARKS = {
+    'order_book': bench_order_book,
+    'journal': bench_journal,
+    'analytics': bench_analytics,
+    'rpc': bench_rpc,
+    'lookup_batch': bench_lookup_batch,
+    'recovery': bench_recovery,
+    'db': bench_db,
+    'replication': bench_replication,
+    'clocks': bench_clocks,
+    'async_fanout': bench_async_fanout,
+    'wire': bench_wire,
+    'sharding': bench_sharding,
+    'election': bench_election,
+    'overload': bench_overload,
+    'concurrency': bench_concurrency,
+    'restock': bench_restock,
+    'metrics': bench_metrics,
+    'tracing': bench_tracing,
+    'logging': bench_logging,
+    'simulator': bench_simulator,
+    'cluster': bench_cluster,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
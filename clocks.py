@@ -0,0 +1,111 @@
+import random
+import threading as td
+import time
+
+# Logical clocks of the peers and the propagation of the buyers' Lamport clocks.
+# The Lamport clock stamps every request; the buyers and sellers learn the clock values of the others
+# from the trades they take part in (piggybacked on the notifications) and from gossip: every
+# `interval` seconds, a peer whose clock has moved in the last `rounds` rounds sends it to `fanout`
+# random neighbors. A peer that learns a higher value passes it on in turn, so a change reaches almost
+# every peer in O(log peers) rounds, and all the requests made during a round share one message wave.
+# The few peers such a wave misses are caught up by anti-entropy: every `anti_entropy` rounds, a peer
+# also sends its clock, changed or not, to one random neighbor.
+# With "Clock": "vector", the traders also keep a vector clock, with one entry per trader, to order the
+# trades made by different traders: it is carried by the replication deltas and stamped on every trade.
+
+
+class LamportClock:
+    initial_value = 0
+
+    def __init__(self, initial_value=None):
+        if initial_value is None:
+            initial_value = LamportClock.initial_value
+        self.value = initial_value
+
+    def adjust(self, other):
+        self.value = max(self.value, other)
+
+    def forward(self):
+        self.value += 1
+        return self.value
+
+
+# VectorClock : {peer_id (str): counter}, thread-safe. Values are plain dicts, ready for RPCs and logs.
+class VectorClock:
+    def __init__(self, peer_id):
+        self.peer_id = str(peer_id)
+        self.value = {}
+        self.lock = td.Lock()
+
+    # tick : A local event, returns a copy of the new value.
+    def tick(self):
+        with self.lock:
+            self.value[self.peer_id] = self.value.get(self.peer_id, 0) + 1
+            return dict(self.value)
+
+    def merge(self, other):
+        with self.lock:
+            for peer_id, counter in other.items():
+                if counter > self.value.get(peer_id, 0):
+                    self.value[peer_id] = counter
+
+
+# compare_vectors : -1 if a happened before b, 1 if after, 0 if equal, None if they are concurrent.
+def compare_vectors(a, b):
+    before = any(a.get(peer_id, 0) < counter for peer_id, counter in b.items())
+    after = any(counter > b.get(peer_id, 0) for peer_id, counter in a.items())
+    if before and after:
+        return None
+    if before:
+        return -1
+    if after:
+        return 1
+    return 0
+
+
+# ClockGossip : Periodic, coalesced propagation of a peer's Lamport clock.
+# value() is the current clock value, send(neighbors, value) sends it to some neighbors.
+class ClockGossip:
+    def __init__(self, value, send, neighbors, interval=1.0, fanout=3, rounds=2, anti_entropy=10):
+        self.value = value
+        self.send = send
+        self.neighbors = neighbors
+        self.interval = interval
+        self.fanout = fanout
+        self.rounds = rounds
+        self.anti_entropy = anti_entropy
+        self.round = 0
+        self.sent = 0 # Value sent at the last round.
+        self.repeats = rounds # Rounds the value has been sent in.
+        self.thread = None
+        self.messages = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = td.Thread(target=self.loop, daemon=True)
+            self.thread.start()
+
+    def loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.tick()
+
+    # tick : One round, sends the clock if it has moved in the last `rounds` rounds.
+    def tick(self):
+        value = self.value()
+        self.round += 1
+        if value > self.sent:
+            self.sent = value
+            self.repeats = 0
+        if self.repeats < self.rounds:
+            self.repeats += 1
+            fanout = self.fanout
+        elif self.anti_entropy and self.round % self.anti_entropy == 0 and value > 0:
+            fanout = 1
+        else:
+            return
+        neighbors = self.neighbors()
+        targets = random.sample(neighbors, min(fanout, len(neighbors)))
+        if targets:
+            self.messages += len(targets)
+            self.send(targets, value)
@@ -1,46 +1,209 @@
-from tempfile import NamedTemporaryFile
-import shutil
-import csv
+import os
 import json
+import time
+import threading as td
+from collections import OrderedDict
+from metrics import Histogram
+
+# The transaction log of a trader is an append-only journal of JSON lines, one record per event:
+#   {"op": "opened", "ts": "<lamport ts>", "time": <unix time ms>, "tx": {...}}   - the trader accepted a request.
+#   {"op": "completed", "ts": "<lamport ts>", "time": <unix time ms>}             - the request has been served.
+# A request is unserved while it has an "opened" record without a "completed" one.
+# The sidecar file "<log>.idx" holds a checkpoint: the offset before which every request is served,
+# so recovery only has to scan the unresolved tail of the log.
+
+
+# TransactionJournal : Writer side of a trader's log.
+# Records are appended to the file buffer and made durable by a flusher thread with group commit:
+# every record written while an fsync is in progress is committed by the next fsync.
+class TransactionJournal:
+    def __init__(self, filename, group_commit_size=256, group_commit_interval=0.0, checkpoint_bytes=65536):
+        self.filename = filename
+        self.group_commit_size = group_commit_size
+        self.group_commit_interval = group_commit_interval
+        self.checkpoint_bytes = checkpoint_bytes
+
+        self.index = {}                 # ts -> offset of its "opened" record.
+        self.open_requests = OrderedDict() # ts -> offset, in log order, of the unserved requests.
+        self.checkpoint = 0
+
+        self.lock = td.Lock()
+        self.pending_condition = td.Condition(self.lock) # Wakes the flusher.
+        self.commit_condition = td.Condition(self.lock)  # Wakes the writers waiting for durability.
+        self.written_seq = 0            # Records written to the file buffer.
+        self.synced_seq = 0             # Records made durable.
+        self.closed = False
+        self.fsync_times = Histogram() # Seconds per fsync of the flusher.
+        self.records_synced = Histogram() # Records committed per fsync.
+
+        self.checkpoint, tail = read_journal_tail(filename)
+        for ts, (offset, tx) in tail.items():
+            self.index[ts] = offset
+            self.open_requests[ts] = offset
+        self.file = open(filename, 'ab')
+        self.offset = self.file.tell()
+
+        self.flusher = td.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    # Write a record, return its offset and sequence number. Lock must be held.
+    def _append(self, record):
+        offset = self.offset
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode()
+        self.file.write(line)
+        self.offset += len(line)
+        self.written_seq += 1
+        self.pending_condition.notify()
+        return offset, self.written_seq
+
+    # log_opened : Record that a request has been accepted.
+    # With durable=True the call returns once the record is on disk (write-ahead).
+    def log_opened(self, ts, tx, durable=True):
+        ts = str(ts)
+        with self.lock:
+            offset, seq = self._append({'op': 'opened', 'ts': ts, 'time': int(time.time() * 1000), 'tx': tx})
+            self.index[ts] = offset
+            self.open_requests[ts] = offset
+            if durable:
+                self._wait_synced(seq)
+
+    # log_completed : Record that a request has been served. O(1) whatever the size of the log.
+    def log_completed(self, ts, durable=False):
+        ts = str(ts)
+        with self.lock:
+            _, seq = self._append({'op': 'completed', 'ts': ts, 'time': int(time.time() * 1000)})
+            self.open_requests.pop(ts, None)
+            if durable:
+                self._wait_synced(seq)
+
+    def is_open(self, ts):
+        with self.lock:
+            return str(ts) in self.open_requests
+
+    def _wait_synced(self, seq):
+        while self.synced_seq < seq and not self.closed:
+            self.commit_condition.wait()
+
+    # flush : Block until everything written so far is durable.
+    def flush(self):
+        with self.lock:
+            self._wait_synced(self.written_seq)
+
+    # The flusher thread: commits pending records in batches.
+    def flush_loop(self):
+        while True:
+            with self.lock:
+                while self.synced_seq == self.written_seq and not self.closed:
+                    self.pending_condition.wait()
+                if self.closed and self.synced_seq == self.written_seq:
+                    return
+                deadline = time.monotonic() + self.group_commit_interval
+                while self.written_seq - self.synced_seq < self.group_commit_size and not self.closed: # Let the batch grow.
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.pending_condition.wait(remaining)
+                seq = self.written_seq
+                self.file.flush()
+                checkpoint = next(iter(self.open_requests.values()), self.offset)
+            start = time.perf_counter()
+            os.fsync(self.file.fileno()) # Writers keep appending to the buffer meanwhile.
+            self.fsync_times.record(time.perf_counter() - start)
+            self.records_synced.record(seq - self.synced_seq)
+            if checkpoint - self.checkpoint >= self.checkpoint_bytes:
+                write_checkpoint(self.filename, checkpoint)
+                self.checkpoint = checkpoint
+            with self.lock:
+                self.synced_seq = max(self.synced_seq, seq)
+                self.commit_condition.notify_all()
+
+    def stats(self):
+        with self.lock:
+            stats = {'pending': self.written_seq - self.synced_seq, 'open_requests': len(self.open_requests)}
+        stats['fsync'] = self.fsync_times.snapshot()
+        stats['records_per_fsync'] = self.records_synced.snapshot()
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending_condition.notify()
+            self.commit_condition.notify_all()
+        self.flusher.join()
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        write_checkpoint(self.filename, next(iter(self.open_requests.values()), self.offset))
+
+
+def write_checkpoint(filename, offset):
+    tmp_name = filename + '.idx.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump({'checkpoint': offset}, f)
+    os.replace(tmp_name, filename + '.idx')
+
+
+def read_checkpoint(filename):
+    try:
+        with open(filename + '.idx') as f:
+            return json.load(f)['checkpoint']
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+# read_journal_tail : Scan a log from its checkpoint and return (checkpoint, {ts: (offset, tx)})
+# for the requests that are still open. Lines that are not journal records (torn writes, old logs) are skipped.
+def read_journal_tail(filename):
+    checkpoint = read_checkpoint(filename)
+    tail = OrderedDict()
+    if not os.path.isfile(filename):
+        return 0, tail
+    with open(filename, 'rb') as f:
+        if checkpoint > os.fstat(f.fileno()).st_size:
+            checkpoint = 0 # Log has been replaced, scan it all.
+        f.seek(checkpoint)
+        offset = checkpoint
+        for line in f:
+            try:
+                record = json.loads(line)
+                op, ts = record['op'], record['ts']
+            except (ValueError, TypeError, KeyError):
+                offset += len(line)
+                continue
+            if op == 'opened':
+                tail[ts] = (offset, record['tx'])
+            elif op == 'completed':
+                tail.pop(ts, None)
+            offset += len(line)
+    return checkpoint, tail
+
+
+journals = {}
+journals_semaphore = td.BoundedSemaphore(1)
+
+# Return the journal writer of a log, opening it on first use.
+def get_journal(filename):
+    journals_semaphore.acquire()
+    journal = journals.get(filename)
+    if journal is None:
+        journal = TransactionJournal(filename)
+        journals[filename] = journal
+    journals_semaphore.release()
+    return journal
 
 # Logging the transaction that has taken place
 def log_transaction(filename,log):
-    log = json.dumps(log)
-    with open(filename,'a') as csvF:
-        csvWriter = csv.writer(csvF,delimiter = ' ')
-        csvWriter.writerow([log])
-        
-# Marking the transaction as complete once it's been served.     
+    ts,tx = list(log.items())[0]
+    get_journal(filename).log_opened(ts,tx)
+
+# Marking the transaction as complete once it's been served.
 def mark_transaction_complete(filename,transaction,identifier):
-    tempfile = NamedTemporaryFile(delete=False)
-    final_list = []
-    print("Mark transaction complete")
-    with open(filename, 'rt') as csvFile,tempfile:
-        reader = csv.reader(csvFile, delimiter=' ')
-        writer = csv.writer(tempfile, delimiter=' ')
-        for row in reader:
-            row = ''.join(row)
-            row = json.loads(row)
-            k,_ = list(row.items())[0]
-            if k == identifier:
-                row[k]['completed'] = True
-            rowed = json.dumps(row)           
-            final_list.append(rowed)
-    
-    with open(filename, 'w') as tempfile:
-        writer = csv.writer(tempfile, delimiter=' ')
-        writer.writerows(final_list)
-    shutil.move(tempfile.name, filename)  
-    
-# Return any unserved requests.    
+    get_journal(filename).log_completed(identifier)
+
+# Return any unserved requests, as a list of {ts: transaction} in log order.
 def get_unserved_requests(file_name):
-    with open(file_name,'rb') as csvF:
-        transaction_log = csv.reader(csvF,delimiter = ' ')
-        open_requests = []
-        transaction_list = list(transaction_log)
-        last_request = json.loads(transaction_list[len(transaction_list)-1][0])
-        _,v = list(last_request.items())[0]
-        if v['completed'] == False:
-            return last_request
-        else:
-            return None
\ No newline at end of file
+    _,tail = read_journal_tail(file_name)
+    if len(tail) == 0:
+        return None
+    return [{ts: tx} for ts,(_,tx) in tail.items()]
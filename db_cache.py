@@ -0,0 +1,123 @@
+import time
+import logging
+import threading as td
+
+# Write-behind cache of a trader towards the DB server.
+# The trader serves trades from its own trade_list and only queues the changes for the DB: the offers
+# registered with it, the units restocked and the units sold. A flusher thread sends the queue in order,
+# in batches, every `flush_interval` seconds or as soon as `max_batch` updates are waiting. A batch the
+# DB did not take stays at the head of the queue and is sent again, the sales and the restocks carry
+# idempotency keys so a batch applied twice counts once. on_flushed(batch) is called once the DB has a batch, the trader marks the
+# sales as completed in its log only then, so the sales a failed trader had not flushed yet are
+# replayed by the recovery like the requests it had not finished.
+# While the DB is down nothing leaves the queue. Once it holds `max_pending` updates the cache is full():
+# the trader then refuses new trades as busy (see market.py), the queue only takes the updates of the
+# trades already under way and the offers, and the buyers back off until the DB catches up.
+# The sellers queue their restocks for the traders the same way (see market.py).
+
+
+# WriteBehindCache : Queue of updates for the DB. send(updates) returns True once the DB has them.
+# With synchronous=True every update is sent before the call returns, as without a cache. With
+# flush_interval=0 a batch is sent as soon as there is an update, the ones added meanwhile go in the next.
+class WriteBehindCache:
+    def __init__(self, send, flush_interval=0.5, max_batch=512, synchronous=False, on_flushed=None, max_pending=None):
+        self.send = send
+        self.on_flushed = on_flushed
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.synchronous = synchronous
+        self.max_pending = max_pending # None: no bound.
+        self.pending = []
+        self.condition = td.Condition()
+        self.flusher = None
+        self.sending = False
+        # Metrics
+        self.updates_flushed = 0
+        self.batches_flushed = 0
+        self.failed_batches = 0
+        self.oldest_pending = None # Time the oldest queued update was added.
+        self.max_lag = 0.0         # Longest time an update has waited in the queue, seconds.
+
+    # full : The DB is max_pending updates behind, no new work should be queued until it catches up.
+    def full(self):
+        return self.max_pending is not None and len(self.pending) >= self.max_pending
+
+    def offer(self, seller_info):
+        self.add({'op': 'offer', 'seller': seller_info})
+
+    def sold(self, key, seller_info, product_name, quantity):
+        self.add({'op': 'sold', 'key': key, 'seller_peer_id': seller_info['seller_id']['peer_id'],
+                  'product_name': product_name, 'quantity': quantity})
+
+    def restocked(self, key, seller_info, units):
+        self.add({'op': 'restock', 'key': key, 'seller_peer_id': seller_info['seller_id']['peer_id'],
+                  'product_name': seller_info['product_name'], 'units': units})
+
+    def add(self, update):
+        with self.condition:
+            if not self.pending:
+                self.oldest_pending = time.monotonic()
+            self.pending.append(update)
+            if self.flusher is None and not self.synchronous:
+                self.flusher = td.Thread(target=self.flush_loop, daemon=True)
+                self.flusher.start()
+            if len(self.pending) >= self.max_batch or not self.flush_interval:
+                self.condition.notify_all()
+        if self.synchronous:
+            self.flush()
+
+    # flush : Send everything queued so far. Returns False if the DB could not be reached.
+    def flush(self):
+        with self.condition:
+            while self.sending: # Keep the batches in order.
+                self.condition.wait()
+            self.sending = True
+        try:
+            while True:
+                with self.condition:
+                    batch = self.pending[:self.max_batch]
+                    oldest = self.oldest_pending
+                if not batch:
+                    return True
+                if not self.send(batch):
+                    self.failed_batches += 1
+                    return False
+                with self.condition:
+                    del self.pending[:len(batch)]
+                    self.oldest_pending = time.monotonic() if self.pending else None
+                if self.on_flushed is not None:
+                    self.on_flushed(batch)
+                self.max_lag = max(self.max_lag, time.monotonic() - oldest)
+                self.updates_flushed += len(batch)
+                self.batches_flushed += 1
+        finally:
+            with self.condition:
+                self.sending = False
+                self.condition.notify_all()
+
+    def flush_loop(self):
+        while True:
+            with self.condition:
+                if self.flush_interval:
+                    self.condition.wait_for(lambda: len(self.pending) >= self.max_batch, self.flush_interval)
+                else:
+                    self.condition.wait_for(lambda: self.pending)
+                if not self.pending:
+                    continue
+            if not self.flush():
+                logging.warning("Flush failed, {} updates queued".format(len(self.pending)))
+                time.sleep(self.flush_interval or 0.1)
+
+    def stats(self):
+        with self.condition:
+            pending = len(self.pending)
+            lag = time.monotonic() - self.oldest_pending if self.oldest_pending is not None else 0.0
+        return {
+            'pending': pending,
+            'max_pending': self.max_pending,
+            'lag': lag,
+            'max_lag': max(self.max_lag, lag),
+            'updates_flushed': self.updates_flushed,
+            'batches_flushed': self.batches_flushed,
+            'failed_batches': self.failed_batches,
+        }
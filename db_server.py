@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import socket
+import logging
+import socketserver
+import threading as td
+from collections import OrderedDict
+from xmlrpc.server import SimpleXMLRPCServer
+from rpc_pool import KeepAliveRequestHandler
+from order_book import offer_key
+from tracing import Tracer
+from event_log import configure_logging
+
+# The DB server of the market: the reference inventory of the sellers, served over XML-RPC on port 9063.
+# The state is held in memory. Every change is a record appended to a write-ahead log (db_wal.jsonl)
+# and fsynced before the call returns. Every `snapshot_every` records the whole state is written to
+# db_snapshot.json and the log starts over. On start, the snapshot is loaded and the log replayed.
+# The offers are keyed "<seller peer_id>:<product_name>" (see order_book.py), a seller has one per product.
+# Records:
+#   {"op": "trader", "trader": {...}}                          - a trader registered.
+#   {"op": "offer", "seller": seller_info, "trader": peer_id}  - a seller registered an offer through a trader.
+#   {"op": "sold", "key": key, "seller_peer_id": .., "product_name": .., "quantity": n}
+#   {"op": "restock", "key": key, "seller_peer_id": .., "product_name": .., "units": n} - units added to an offer.
+#   {"op": "count", "seller_peer_id": .., "product_name": .., "product_count": n} - a correction from a trader.
+# A sale or a restock is applied once per idempotency key (see recovery.py), and only to an offer the DB has.
+
+DB_PORT = 9063
+
+
+class InventoryDB:
+    def __init__(self, data_dir='.', snapshot_every=10000, max_keys=100000):
+        self.wal_name = os.path.join(data_dir, 'db_wal.jsonl')
+        self.snapshot_name = os.path.join(data_dir, 'db_snapshot.json')
+        self.snapshot_every = snapshot_every
+        self.max_keys = max_keys
+        self.offers = {}    # offer key -> seller_info, with the peer_id of its trader under 'trader'
+        self.traders = {}   # trader peer_id (str) -> trader info
+        self.applied_keys = OrderedDict() # Idempotency keys of the last sales and restocks applied.
+        self.lock = td.Lock()
+        self.records = 0    # Records in the WAL since the last snapshot.
+        self.load()
+        self.wal = open(self.wal_name, 'a')
+
+    # load : Rebuild the state from the snapshot and the WAL.
+    def load(self):
+        if os.path.isfile(self.snapshot_name):
+            with open(self.snapshot_name) as f:
+                snapshot = json.load(f)
+            self.offers = snapshot['offers']
+            self.traders = snapshot['traders']
+            self.applied_keys = OrderedDict((key, True) for key in snapshot['applied_keys'])
+        if os.path.isfile(self.wal_name):
+            with open(self.wal_name) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: # Torn write at the end of the log.
+                        continue
+                    self.apply(record)
+                    self.records += 1
+
+    # apply : Change the state by one record. Returns False if the record had no effect.
+    def apply(self, record):
+        op = record['op']
+        if op == 'trader':
+            self.traders[str(record['trader']['peer_id'])] = record['trader']
+        elif op == 'offer':
+            seller = dict(record['seller'], trader=record['trader'])
+            self.offers[offer_key(seller)] = seller
+        elif op in ('sold', 'restock'):
+            if record['key'] is not None and record['key'] in self.applied_keys:
+                return False
+            seller = self.offers.get(record_key(record))
+            if seller is None:
+                return False # No such offer registered, a retry once it is may still apply.
+            if op == 'sold':
+                seller['product_count'] -= record['quantity']
+            else:
+                seller['product_count'] += record['units']
+            if record['key'] is not None: # Recorded once applied, as the WAL only has the records applied.
+                self.applied_keys[record['key']] = True
+                if len(self.applied_keys) > self.max_keys:
+                    self.applied_keys.popitem(last=False)
+        elif op == 'count':
+            seller = self.offers.get(record_key(record))
+            if seller is None:
+                return False
+            seller['product_count'] = record['product_count']
+        return True
+
+    # commit : Apply records and make them durable.
+    def commit(self, records):
+        with self.lock:
+            for record in records:
+                if self.apply(record):
+                    self.wal.write(json.dumps(record, separators=(',', ':')) + '\n')
+                    self.records += 1
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+            if self.records >= self.snapshot_every:
+                self.snapshot()
+
+    # snapshot : Write the state and start a new WAL. Lock must be held.
+    def snapshot(self):
+        tmp_name = self.snapshot_name + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump({'offers': self.offers, 'traders': self.traders, 'applied_keys': list(self.applied_keys)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, self.snapshot_name)
+        self.wal.close()
+        self.wal = open(self.wal_name, 'w')
+        self.records = 0
+
+    def close(self):
+        with self.lock:
+            self.snapshot()
+            self.wal.close()
+
+    # The RPC functions.
+    def register_traders(self, trader_info):
+        self.commit([{'op': 'trader', 'trader': trader_info}])
+        return True
+
+    def register_products(self, seller_info, trader_info):
+        self.commit([{'op': 'offer', 'seller': seller_info, 'trader': trader_info['peer_id']}])
+        return True
+
+    def transaction(self, product_name, seller_info, key=None):
+        self.commit([sold_record(key, seller_info['seller_id']['peer_id'], product_name, seller_info.get('quantity', 1))])
+        return True
+
+    # transaction_batch : Trades replayed by a recovery, as transaction_batch items.
+    def transaction_batch(self, items, trader_peer_id):
+        self.commit([sold_record(item.get('key'), item['seller_id']['peer_id'], item['product_name'], item['quantity']) for item in items])
+        return True
+
+    # apply_updates : A batch of "offer", "sold" and "restock" records from the write-behind cache of a trader.
+    def apply_updates(self, updates, trader_info):
+        records = []
+        for update in updates:
+            if update['op'] == 'offer':
+                records.append({'op': 'offer', 'seller': update['seller'], 'trader': trader_info['peer_id']})
+            else:
+                records.append(update)
+        self.commit(records)
+        return True
+
+    # check_cache : Compare a trader's cache, {offer key: [product_name, product_count]}, with the DB.
+    # Returns the offers that have been registered with another trader since ("stale") and the offers whose
+    # count differs ("mismatched", {offer key: [product_name, product_count in the DB]}).
+    def check_cache(self, trader_info, cache):
+        stale = []
+        mismatched = {}
+        with self.lock:
+            for key, (product_name, product_count) in cache.items():
+                seller = self.offers.get(key)
+                if seller is None:
+                    continue
+                if seller['trader'] != trader_info['peer_id']:
+                    stale.append(key)
+                elif seller['product_count'] != product_count:
+                    mismatched[key] = [seller['product_name'], seller['product_count']]
+        return {'stale': stale, 'mismatched': mismatched}
+
+    def get_inventory(self):
+        with self.lock:
+            return {key: dict(seller) for key, seller in self.offers.items()}
+
+
+def sold_record(key, seller_peer_id, product_name, quantity):
+    return {'op': 'sold', 'key': key, 'seller_peer_id': seller_peer_id, 'product_name': product_name, 'quantity': quantity}
+
+
+# record_key : Key of the offer a "sold", "restock" or "count" record applies to.
+def record_key(record):
+    return "{}:{}".format(record['seller_peer_id'], record['product_name'])
+
+
+# DBServer : The calls made in a trace (see tracing.py) are traced as "rpc.<method>" spans of peer "db".
+class DBServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, inventory):
+        super().__init__(server_address, allow_none=True, logRequests=False, requestHandler=KeepAliveRequestHandler)
+        self.inventory = inventory
+        self.tracer = Tracer('db')
+        for name in ('register_traders', 'register_products', 'transaction', 'transaction_batch',
+                     'apply_updates', 'check_cache', 'get_inventory'):
+            self.register_function(self.tracer.traced('rpc.' + name, getattr(inventory, name)), name)
+        self.register_function(self.tracer.dump, 'trace_dump')
+
+
+if __name__ == "__main__":
+    configure_logging(logging.INFO)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DB_PORT
+    data_dir = sys.argv[2] if len(sys.argv) > 2 else '.'
+    host_ip = socket.gethostbyname(socket.gethostname())
+    inventory = InventoryDB(data_dir)
+    server = DBServer((host_ip, port), inventory)
+    logging.info("DB server listening on {}:{}, {} offers loaded".format(host_ip, port, len(inventory.offers)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        inventory.close()
@@ -0,0 +1,159 @@
+import json
+import time
+import queue
+import atexit
+import datetime
+import threading as td
+import logging.handlers
+
+# Non-blocking logging of the peers.
+# An event of a peer (a purchase, a trade, an election step) is a structured record: peer id, unix time,
+# Lamport clock of the peer, event name and its fields. EventLog.log() only puts the record in a queue;
+# a writer thread, one per output and process, turns the records into text or JSON and writes them in
+# batches, so the threads that handle the requests never wait on I/O or format a message. The
+# outputs ("EventLog" in the peer's db):
+#   not set                      text lines, formatted by the writer, handed to the "events" logger.
+#   "events_{peer_id}.jsonl"     a compact JSON object per line: {"t", "peer", "clock", "event", fields...}.
+#   false                        no events.
+# High-rate events can be sampled, "LogSample": {"purchase": 0.01} keeps one purchase in 100. When
+# the queue holds "EventQueue" records the new ones are dropped and counted, the requests go on.
+# configure_logging() sends the stdlib logging of a process through a queue as well.
+
+
+# EventWriter : Writer thread of an output, shared by the peers of the process that log to it.
+# target is a file name, or None for the "events" logger.
+class EventWriter:
+    def __init__(self, target=None, batch=1024):
+        self.target = target
+        self.batch = batch
+        self.queue = queue.SimpleQueue()
+        self.logger = logging.getLogger('events')
+        self.file = None if target is None else open(target, 'a')
+        self.written = 0
+        self.thread = td.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            flushes = [record for record in records if isinstance(record, td.Event)] # See flush().
+            self.write([record for record in records if not isinstance(record, td.Event)])
+            for done in flushes:
+                if self.file is not None:
+                    self.file.flush()
+                done.set()
+
+    def write(self, records):
+        if not records:
+            return
+        if self.file is None:
+            for events, peer_id, t, clock, name, fields in records:
+                self.logger.info("[{}][Peer {}] {}".format(datetime.datetime.fromtimestamp(t), peer_id, text(events.get(name), name, fields)))
+        else:
+            self.file.write(''.join(json.dumps(dict(fields, t=round(t, 6), peer=peer_id, clock=clock, event=name), separators=(',', ':')) + '\n'
+                                    for _, peer_id, t, clock, name, fields in records))
+        self.written += len(records)
+
+    # flush : Wait until the records queued before are written, at most `timeout` seconds.
+    def flush(self, timeout=5.0):
+        done = td.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+
+# text : The text of an event, from its template: a format string of the fields or a function of them.
+def text(template, name, fields):
+    if template is None:
+        return "{} {}".format(name, fields)
+    try:
+        return template(**fields) if callable(template) else template.format(**fields)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return "{} {}".format(name, fields)
+
+
+writers = {} # target -> EventWriter
+writers_lock = td.Lock()
+
+
+def get_writer(target=None):
+    with writers_lock:
+        writer = writers.get(target)
+        if writer is None:
+            writer = writers[target] = EventWriter(target)
+            atexit.register(writer.flush)
+    return writer
+
+
+# EventLog : The events of a peer. clock returns its Lamport clock; events is {event name: text template}
+# for the text output; sample is {event name: share of the events kept}.
+class EventLog:
+    def __init__(self, peer_id, clock=None, target=None, events=None, sample=None, max_queue=65536, enabled=True):
+        self.peer_id = peer_id
+        self.clock = clock or (lambda: 0)
+        self.events = events or {}
+        self.sample = dict(sample or {})
+        self.credit = {}
+        self.credit_lock = td.Lock() # log() is called from every thread of the peer.
+        self.max_queue = max_queue
+        self.enabled = enabled
+        self.writer = get_writer(target) if enabled else None
+        self.to_logger = target is None
+        self.logged = 0
+        self.sampled_out = 0
+        self.dropped = 0
+
+    # log : Queue an event, fields are keyword arguments of JSON values. Never blocks.
+    def log(self, name, **fields):
+        if not self.enabled or (self.to_logger and not self.writer.logger.isEnabledFor(logging.INFO)):
+            return
+        rate = self.sample.get(name)
+        if rate is not None: # Keeps one event of every 1/rate, the same ones from run to run.
+            with self.credit_lock:
+                credit = self.credit.get(name, 0.0) + rate
+                keep = credit >= 1.0
+                self.credit[name] = credit - 1.0 if keep else credit
+                if not keep:
+                    self.sampled_out += 1
+            if not keep:
+                return
+        if self.writer.queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            return
+        self.writer.queue.put((self.events, self.peer_id, time.time(), self.clock(), name, fields))
+        self.logged += 1
+
+    def flush(self, timeout=5.0):
+        if self.writer is not None:
+            self.writer.flush(timeout)
+
+    def stats(self):
+        return {'logged': self.logged, 'sampled_out': self.sampled_out, 'dropped': self.dropped,
+                'queued': self.writer.queue.qsize() if self.writer is not None else 0}
+
+
+# LazyQueueHandler : Puts the records in a queue as they are. QueueHandler formats the message in the
+# caller's thread, so it can be pickled to another process; this one leaves it to the listener's thread.
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# configure_logging : The logging of the process, written to stderr (or `stream`) by a listener thread.
+# Replaces logging.basicConfig(), the same format.
+def configure_logging(level=logging.INFO, stream=None):
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    root = logging.getLogger()
+    root.addHandler(LazyQueueHandler(records))
+    root.setLevel(level)
+    return listener
+
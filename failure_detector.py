@@ -0,0 +1,234 @@
+import math
+import time
+import socket
+import logging
+import threading as td
+from collections import deque
+import wire
+
+# Failure detection of the traders.
+# Every trader sends a small UDP heartbeat to all the peers every `interval` seconds, on their
+# XML-RPC port + HEARTBEAT_PORT_OFFSET. Successful RPCs with a trader count as heartbeats too
+# (piggybacking). A failed RPC is reported right away, and `failure_limit` of them in a row, with no
+# sign of life between, get the trader suspected: one timeout under load is not a crash.
+# Each peer judges the traders on its own with a phi-accrual detector: phi grows with the silence
+# relative to the usual gaps between heartbeats and their jitter, and a trader is suspected when phi
+# passes the threshold, or at the latest when the silence reaches the detection SLA.
+
+HEARTBEAT_PORT_OFFSET = 20000
+SQRT2 = math.sqrt(2)
+
+
+def heartbeat_addr(host_addr):
+    host, port = host_addr.split(':')
+    return host, int(port) + HEARTBEAT_PORT_OFFSET
+
+
+# PhiAccrual : Suspicion level of one monitored peer.
+# phi = -log10(P(the next heartbeat comes later than now)), with the heartbeat gaps taken as normally
+# distributed with the mean and deviation of the last `window` gaps. phi 1 means a 10% chance that the
+# suspicion is wrong, phi 8 a 1e-8 chance. The deviation has a floor so a very regular sender is not
+# suspected on the first late heartbeat.
+class PhiAccrual:
+    def __init__(self, expected_interval, now, window=100):
+        self.expected_interval = expected_interval
+        self.min_std = expected_interval / 4
+        self.intervals = deque(maxlen=window)
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.last = now # Monitoring starts with a grace period of one gap.
+
+    def heartbeat(self, now):
+        interval = now - self.last
+        if len(self.intervals) == self.intervals.maxlen:
+            oldest = self.intervals[0]
+            self.total -= oldest
+            self.total_squares -= oldest * oldest
+        self.intervals.append(interval)
+        self.total += interval
+        self.total_squares += interval * interval
+        self.last = now
+
+    def phi(self, now):
+        if self.intervals:
+            mean = self.total / len(self.intervals)
+            std = math.sqrt(max(self.total_squares / len(self.intervals) - mean * mean, 0.0))
+        else:
+            mean, std = self.expected_interval, 0.0
+        std = max(std, self.min_std)
+        p_later = 0.5 * math.erfc((now - self.last - mean) / (std * SQRT2))
+        return -math.log10(p_later) if p_later > 0 else math.inf
+
+
+# FailureDetector : Sends the heartbeats of a trader and watches the traders for a peer.
+# monitored() returns the {'peer_id', 'host_addr'} of the traders to watch, send_targets() the
+# host_addrs to send heartbeats to (empty when the peer is not a trader). on_suspect(trader) and
+# on_recover(trader) are called from the detector thread, on_unknown(host_addr) from the receiver thread
+# for a UDP heartbeat of a peer that is not watched: a trader this peer has not heard of.
+# clock returns the time in seconds, time.monotonic by default. The simulator (see simulator.py) runs it on its
+# virtual clock: it calls tick() and receive() itself and sends the heartbeats with its own send().
+class FailureDetector:
+    def __init__(self, host_addr, monitored, send_targets, on_suspect, on_recover, sla=1.0, interval=None, threshold=8.0, failure_limit=3, clock=None):
+        self.host_addr = host_addr
+        self.monitored = monitored
+        self.send_targets = send_targets
+        self.on_suspect = on_suspect
+        self.on_recover = on_recover
+        self.on_unknown = None
+        self.sla = sla
+        self.interval = interval if interval is not None else sla / 5
+        self.threshold = threshold
+        self.failure_limit = failure_limit
+        self.clock = clock or time.monotonic
+        self.detectors = {}  # host_addr -> PhiAccrual
+        self.failures = {}   # host_addr -> failed RPCs since the last sign of life
+        self.suspected = {}  # host_addr -> time of the suspicion
+        self.lock = td.Lock()
+        self.seq = 0
+        self.running = False
+        # Metrics
+        self.detection_latencies = deque(maxlen=100) # Silence before each suspicion, seconds.
+        self.suspicions = 0
+        self.recoveries = 0
+        self.heartbeats_sent = 0
+        self.heartbeats_received = 0
+
+    def start(self, host_ip):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host_ip, heartbeat_addr(self.host_addr)[1]))
+        self.running = True
+        td.Thread(target=self.receive_loop, daemon=True).start()
+        td.Thread(target=self.tick_loop, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+    # heartbeat : Evidence that a peer is alive, from a UDP heartbeat or a successful RPC. False if the
+    # peer is not watched.
+    def heartbeat(self, host_addr):
+        now = self.clock()
+        with self.lock:
+            self.failures.pop(host_addr, None)
+            detector = self.detectors.get(host_addr)
+            if detector is None:
+                return False
+            detector.heartbeat(now)
+            suspected_at = self.suspected.get(host_addr)
+            if suspected_at is None or now - suspected_at < self.interval: # Not suspected, or sent before the suspicion.
+                return True
+            del self.suspected[host_addr]
+        self.recoveries += 1
+        trader = self.find(host_addr)
+        if trader is not None:
+            self.on_recover(trader)
+        return True
+
+    # report_failure : An RPC to the peer failed. A monitored peer is suspected at the `failure_limit`-th
+    # failure in a row; until then the heartbeats and phi decide.
+    def report_failure(self, host_addr):
+        trader = self.find(host_addr)
+        if trader is None:
+            return
+        with self.lock:
+            failures = self.failures.get(host_addr, 0) + 1
+            self.failures[host_addr] = failures
+        if failures >= self.failure_limit:
+            self.suspect(trader, self.clock())
+
+    def find(self, host_addr):
+        for trader in self.monitored():
+            if trader['host_addr'] == host_addr:
+                return trader
+        return None
+
+    # down : Another peer found the trader down. It is taken as suspected, the next heartbeat brings it back.
+    def down(self, host_addr):
+        with self.lock:
+            self.suspected.setdefault(host_addr, self.clock())
+
+    def suspect(self, trader, now):
+        with self.lock:
+            if trader['host_addr'] in self.suspected:
+                return
+            self.suspected[trader['host_addr']] = now
+            detector = self.detectors.get(trader['host_addr'])
+            silence = now - detector.last if detector is not None else 0.0
+        self.suspicions += 1
+        self.detection_latencies.append(silence)
+        logging.info("Trader {} suspected after {:.3f}s of silence".format(trader['peer_id'], silence))
+        self.on_suspect(trader)
+
+    def receive_loop(self):
+        while self.running:
+            try:
+                data, _ = self.sock.recvfrom(512)
+            except OSError:
+                return
+            self.receive(data)
+
+    # receive : A heartbeat datagram.
+    def receive(self, data):
+        try:
+            host_addr, _ = wire.decode(data)
+        except (ValueError, TypeError, IndexError):
+            return
+        self.heartbeats_received += 1
+        if not self.heartbeat(host_addr) and self.on_unknown is not None:
+            self.on_unknown(host_addr)
+
+    def tick_loop(self):
+        while self.running:
+            self.tick()
+            time.sleep(self.interval)
+
+    # tick : Send the heartbeats of this peer, then judge the traders it watches.
+    def tick(self):
+        self.seq += 1
+        data = wire.encode([self.host_addr, self.seq])
+        for host_addr in self.send_targets():
+            self.send(data, host_addr)
+        now = self.clock()
+        for trader in self.monitored():
+            host_addr = trader['host_addr']
+            if host_addr == self.host_addr:
+                continue
+            with self.lock:
+                detector = self.detectors.get(host_addr)
+                if detector is None:
+                    self.detectors[host_addr] = PhiAccrual(self.interval, now)
+                    continue
+                silence = now - detector.last
+                phi = detector.phi(now)
+            if phi > self.threshold or silence >= self.sla:
+                self.suspect(trader, now)
+
+    def send(self, data, host_addr):
+        try:
+            self.sock.sendto(data, heartbeat_addr(host_addr))
+            self.heartbeats_sent += 1
+        except OSError:
+            pass
+
+    # stats : Failure detector metrics, exported over RPC.
+    def stats(self):
+        now = self.clock()
+        with self.lock:
+            phi = {host_addr: round(detector.phi(now), 3) for host_addr, detector in self.detectors.items()}
+            suspected = list(self.suspected)
+        latencies = list(self.detection_latencies)
+        return {
+            'sla': self.sla,
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'failure_limit': self.failure_limit,
+            'phi': phi,
+            'suspected': suspected,
+            'suspicions': self.suspicions,
+            'recoveries': self.recoveries,
+            'heartbeats_sent': self.heartbeats_sent,
+            'heartbeats_received': self.heartbeats_received,
+            'detection_latency_last': latencies[-1] if latencies else None,
+            'detection_latency_mean': sum(latencies) / len(latencies) if latencies else None,
+            'detection_latency_max': max(latencies) if latencies else None,
+        }
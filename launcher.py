@@ -0,0 +1,275 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import subprocess
+import xmlrpc.client
+from metrics import Histogram
+import tracing
+
+# Local cluster launcher and load generator. Every peer runs as its own market.py process, with a
+# db_server.py process, on this host:
+#   python3 launcher.py run  [options]   start a cluster and keep it running until Ctrl-C (run.sh)
+#   python3 launcher.py load [options]   drive the buyers at a target rate for --duration seconds,
+#                                        optionally crash a trader at --fail-at, and report
+#   python3 launcher.py suite            the benchmark suite, fixed scenarios and seeds
+# The peers are numbered buyers and sellers in turn, the `traders` highest peer ids are left without
+# products since the election makes them the traders, and so are `spares` more below them, which
+# replace a failed trader without taking a buyer or a seller off the market. Each cluster works in its own directory
+# (transaction logs, DB files and the output of every peer in peer_<id>.log).
+
+MARKET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'market.py')
+DB_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_server.py')
+PRODUCTS = ['Fish','Boar','Salt']
+
+
+# cluster_spec : The role and db of every peer, peer_id order. With quantity > 1 a buyer wants 1 to
+# `quantity` units of every product on its shop list.
+def cluster_spec(buyers, sellers, traders=2, spares=0, products=PRODUCTS, units=3, shop=3, quantity=1, seed=0, **db):
+    rng = random.Random(seed)
+    offered = products[:max(sellers, 1)] # The buyers only ask for products some seller has.
+    roles = []
+    while len(roles) < buyers + sellers:
+        if roles.count('Buyer') < buyers and (len(roles) % 2 == 0 or roles.count('Seller') == sellers):
+            roles.append('Buyer')
+        else:
+            roles.append('Seller')
+    roles += ['Buyer'] * (spares + traders) # Elected traders and their replacements.
+    peers = []
+    for i, role in enumerate(roles):
+        peer_db = {'Role': role, 'Inv': {}, 'shop': [], 'Traders': traders}
+        if i < buyers + sellers:
+            if role == 'Buyer':
+                peer_db['shop'] = [rng.choice(offered) for _ in range(shop)]
+                if quantity > 1:
+                    peer_db['shop'] = [[product, rng.randint(1, quantity)] for product in peer_db['shop']]
+            else:
+                peer_db['Inv'] = {product: 0 for product in products}
+                peer_db['Inv'][products[roles[:i].count('Seller') % len(products)]] = units
+        peer_db.update(db)
+        peers.append(peer_db)
+    return peers
+
+
+class Cluster:
+    def __init__(self, spec, base_port=20090, db_port=9063, work_dir=None):
+        self.spec = spec
+        self.base_port = base_port
+        self.db_port = db_port
+        self.host_ip = socket.gethostbyname(socket.gethostname())
+        self.tmp_dir = None
+        if work_dir is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix='cluster_')
+            work_dir = self.tmp_dir.name
+        self.work_dir = work_dir
+        self.processes = {} # peer_id -> Popen, 0 for the DB server
+        self.proxies = {}
+
+    def host_addr(self, peer_id):
+        return self.host_ip + ':' + str(self.base_port + peer_id - 1)
+
+    def spawn(self, name, args):
+        log = open(os.path.join(self.work_dir, name + '.log'), 'w')
+        return subprocess.Popen([sys.executable] + args, cwd=self.work_dir, stdout=log, stderr=subprocess.STDOUT)
+
+    # start : Start the DB server and the peers. Peers 1 and 2 start the election, so they are started
+    # last, once the others are listening.
+    def start(self, timeout=30.0):
+        self.processes[0] = self.spawn('db_server', [DB_SERVER, str(self.db_port), self.work_dir])
+        wait_listening(self.host_ip, self.db_port, timeout)
+        roles = json.dumps([peer_db['Role'] for peer_db in self.spec])
+        order = list(range(3, len(self.spec) + 1)) + [1, 2]
+        for peer_id in order:
+            if peer_id > len(self.spec):
+                continue
+            if peer_id == 1:
+                for other in range(3, len(self.spec) + 1):
+                    wait_listening(self.host_ip, self.base_port + other - 1, timeout)
+            peer_db = dict(self.spec[peer_id - 1], DBServer=self.host_ip + ':' + str(self.db_port))
+            self.processes[peer_id] = self.spawn('peer_' + str(peer_id), [MARKET, str(peer_id), str(self.base_port + peer_id - 1),
+                                                 json.dumps(peer_db), str(len(self.spec)), roles, str(self.base_port)])
+
+    def proxy(self, peer_id):
+        if peer_id not in self.proxies:
+            self.proxies[peer_id] = xmlrpc.client.ServerProxy('http://' + self.host_addr(peer_id) + '/', allow_none=True)
+        return self.proxies[peer_id]
+
+    def alive(self):
+        return [peer_id for peer_id, process in self.processes.items() if peer_id and process.poll() is None]
+
+    # stats : load_stats of every peer alive, None for the peers that do not answer.
+    def stats(self):
+        stats = {}
+        for peer_id in self.alive():
+            try:
+                stats[peer_id] = self.proxy(peer_id).load_stats()
+            except (OSError, xmlrpc.client.Error):
+                stats[peer_id] = None
+        return stats
+
+    # traders : The traders every peer alive agrees on, None while they disagree.
+    def traders(self):
+        views = [tuple(sorted(stats['traders'])) if stats else None for stats in self.stats().values()]
+        if not views or None in views or len(set(views)) != 1:
+            return None
+        return list(views[0])
+
+    def wait_for_traders(self, count, timeout=60.0):
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            traders = self.traders()
+            if traders is not None and len(traders) == count:
+                return traders
+            time.sleep(0.1)
+        raise RuntimeError("no agreement on {} traders after {:.0f} s".format(count, timeout))
+
+    # kill : Crash a peer, no goodbye to the others.
+    def kill(self, peer_id):
+        self.processes[peer_id].kill()
+        self.processes[peer_id].wait()
+        self.proxies.pop(peer_id, None)
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(5.0)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
+
+
+def wait_listening(host_ip, port, timeout):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection((host_ip, port), 0.5).close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise RuntimeError("nothing listening on {}:{} after {:.0f} s".format(host_ip, port, timeout))
+            time.sleep(0.05)
+
+
+# run_load : Start a cluster, let the buyers trade for `duration` seconds at `rate` lookups per second
+# each, crash the trader with the highest peer_id `fail_at` seconds in. Returns the results:
+# trades/s, lookup latency percentiles (seconds), failover time: from the crash until every peer
+# routes around the failed trader ("rerouted") and until a replacement is elected ("replaced").
+# With `trace`, a file name, the requests are traced and the spans of every peer are written to it (see tracing.py).
+def run_load(buyers=3, sellers=3, traders=2, rate=10.0, duration=10.0, fail_at=None, base_port=20090, db_port=9063, seed=0,
+             units=None, work_dir=None, spares=1, quantity=1, trace=None, **db):
+    start_delay = 1.0
+    if trace is not None:
+        db['Tracing'] = True
+    if units is None: # Enough for every request, the load is not limited by the sellers running out.
+        units = int(rate * buyers * duration * quantity) + 1
+    spec = cluster_spec(buyers, sellers, traders, spares, units=units, quantity=quantity, seed=seed,
+                        RequestRate=rate, Duration=duration, StartDelay=start_delay, BatchSize=1, **db)
+    cluster = Cluster(spec, base_port, db_port, work_dir)
+    result = {'peers': len(spec), 'rate': rate * buyers, 'rerouted': None, 'replaced': None}
+    try:
+        cluster.start()
+        elected = cluster.wait_for_traders(traders)
+        time.sleep(start_delay)
+        start = time.perf_counter()
+        if fail_at is not None:
+            time.sleep(fail_at)
+            crashed = max(elected)
+            crash_time = time.perf_counter()
+            cluster.kill(crashed)
+            while result['replaced'] is None and time.perf_counter() - start < duration:
+                views = [peer_stats['traders'] for peer_stats in cluster.stats().values() if peer_stats]
+                elapsed = time.perf_counter() - crash_time
+                if result['rerouted'] is None and all(crashed not in view for view in views):
+                    result['rerouted'] = elapsed
+                if result['rerouted'] is not None and all(len(view) == traders for view in views):
+                    result['replaced'] = elapsed
+                time.sleep(0.01)
+        time.sleep(max(duration - (time.perf_counter() - start), 0) + 1.0) # The last replies.
+        stats = [peer_stats for peer_stats in cluster.stats().values() if peer_stats]
+        if trace is not None:
+            host_addrs = [cluster.host_addr(peer_id) for peer_id in cluster.alive()] + [cluster.host_ip + ':' + str(db_port)]
+            tracing.write_spans(trace, tracing.collect(host_addrs))
+    finally:
+        cluster.stop()
+    latency = Histogram() # Of the requests of every buyer.
+    for peer_stats in stats:
+        latency.merge(peer_stats['latency'])
+    result['requests'] = sum(peer_stats['requests'] for peer_stats in stats)
+    result['throughput'] = sum(peer_stats['shipments'] for peer_stats in stats) / duration
+    result['p50'] = latency.percentile(0.50)
+    result['p99'] = latency.percentile(0.99)
+    return result
+
+
+def format_result(name, result):
+    def ms(seconds):
+        return "{:7.1f} ms".format(seconds * 1e3) if seconds is not None else "      -   "
+    return ("{:24} peers={:>3} offered {:6.0f} req/s: {:7.1f} trades/s, lookup p50 {}, p99 {}, failover: rerouted {}, replaced {}".format(
+        name, result['peers'], result['rate'], result['throughput'], ms(result['p50']), ms(result['p99']),
+        ms(result['rerouted']), ms(result['replaced'])))
+
+
+# The benchmark suite: (name, run_load arguments). Fixed seeds, one port range per scenario.
+SUITE = [
+    ('small, steady', dict(buyers=2, sellers=2, rate=20.0, duration=10.0)),
+    ('small, trader crash', dict(buyers=2, sellers=2, rate=20.0, duration=10.0, fail_at=4.0)),
+    ('medium, steady', dict(buyers=9, sellers=9, rate=10.0, duration=10.0)),
+    ('medium, trader crash', dict(buyers=9, sellers=9, rate=10.0, duration=10.0, fail_at=4.0)),
+    ('medium, binary', dict(buyers=9, sellers=9, rate=10.0, duration=10.0, Transport='binary')),
+]
+
+def run_suite(suite=SUITE, base_port=24000, db_port=9163):
+    for i, (name, arguments) in enumerate(suite):
+        result = run_load(base_port=base_port + i * 100, db_port=db_port + i, **arguments)
+        print(format_result(name, result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start a local market cluster and generate load.")
+    parser.add_argument('command', choices=['run', 'load', 'suite'])
+    parser.add_argument('--buyers', type=int, default=3)
+    parser.add_argument('--sellers', type=int, default=3)
+    parser.add_argument('--traders', type=int, default=2)
+    parser.add_argument('--spares', type=int, default=None, help="idle peers to replace failed traders (0 for run, 1 for load)")
+    parser.add_argument('--units', type=int, default=None, help="units of the product of every seller (3, or enough for the load)")
+    parser.add_argument('--quantity', type=int, default=1, help="most units a buyer wants of a product")
+    parser.add_argument('--rate', type=float, default=None, help="lookups per second per buyer")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of load")
+    parser.add_argument('--fail-at', type=float, default=None, help="crash a trader after this many seconds of load")
+    parser.add_argument('--base-port', type=int, default=20090)
+    parser.add_argument('--db-port', type=int, default=9063)
+    parser.add_argument('--work-dir', default=None, help="directory of the logs, a temporary one by default")
+    parser.add_argument('--db', default='{}', help="JSON settings added to the db of every peer")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', default=None, help="trace the requests and write the spans to this file (load)")
+    args = parser.parse_args()
+    db = json.loads(args.db)
+    if args.command == 'run':
+        if args.rate:
+            db['RequestRate'] = args.rate
+        cluster = Cluster(cluster_spec(args.buyers, args.sellers, args.traders, args.spares or 0, units=args.units or 3,
+                                       quantity=args.quantity, seed=args.seed, **db),
+                          args.base_port, args.db_port, args.work_dir or '.')
+        cluster.start()
+        try:
+            while cluster.alive():
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            cluster.stop()
+    elif args.command == 'load':
+        result = run_load(args.buyers, args.sellers, args.traders, args.rate or 10.0, args.duration, args.fail_at,
+                          args.base_port, args.db_port, args.seed, args.units, args.work_dir,
+                          1 if args.spares is None else args.spares, args.quantity, args.trace, **db)
+        print(format_result('load', result))
+    else:
+        run_suite()
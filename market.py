@@ -4,40 +4,76 @@ import time
 import threading as td
 import socket,socketserver
 import random
-import numpy as np
 import sys
 import json
-import csv
-from tempfile import NamedTemporaryFile
-import shutil
+import functools
 import data_ops
+import recovery
+from order_book import OrderBook, offer_key
+from rpc_pool import ConnectionPool, KeepAliveRequestHandler
+from wire import BinaryRPCServer, wire_addr
+from sharding import ConsistentHashRing, sub_shard
+from failure_detector import FailureDetector
+from db_cache import WriteBehindCache
+from replication import ReplicationChannel
+from clocks import LamportClock, VectorClock, ClockGossip
+from metrics import Metrics
+from tracing import Tracer
+from event_log import EventLog, configure_logging
+from admission import AdmissionQueue, BUSY
 import os.path
 import logging
-import time, datetime
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
-logging.info("Starting Bazaar")
+
+# The text of the peer's events when they go to the log (see event_log.py), by event name.
+EVENTS = {
+    'election_started': "Election proceedings have started.",
+    'elected': "Election completed. I am the new coordinator.",
+    'trader_announced': "Won the election and message has been received from Peer {trader}",
+    'stepped_down': "Stepped down, one trader too many. The traders in charge serve my products.",
+    'trading_started': "Trading begins now!",
+    'request': lambda items: "Requesting " + ", ".join("{} x {}".format(quantity,product_name) for product_name,quantity,_ in items),
+    'trade': "Sold {quantity} x {product} of Peer {seller} to Peer {buyer}, request {ts}",
+    'purchase': "has purchased {quantity} x {product} from Peer {seller} through {trader}",
+}
 
 
 # Using ThreadingMixIn to allow multiple connections
-class AsyncXMLRPCServer(socketserver.ThreadingMixIn,SimpleXMLRPCServer): pass
+class AsyncXMLRPCServer(socketserver.ThreadingMixIn,SimpleXMLRPCServer):
+    daemon_threads = True # Threads of idle keep-alive connections must not keep the process alive.
+    request_queue_size = 128 # Listen backlog, an election makes every lower peer connect at once.
+
+    def process_request(self,request,client_address):
+        self.connections().add(request)
+        super().process_request(request,client_address)
 
+    def shutdown_request(self,request):
+        self.connections().discard(request)
+        super().shutdown_request(request)
 
-class LamportClock:
-    initial_value = 0
+    def handle_error(self,request,client_address):
+        if isinstance(sys.exc_info()[1],ConnectionError): # The client went away.
+            return
+        super().handle_error(request,client_address)
 
-    def __init__(self, initial_value=None):
-        if initial_value is None:
-            initial_value = LamportClock.initial_value
-        self.value = initial_value
+    def connections(self):
+        if not hasattr(self,'open_connections'):
+            self.open_connections = set()
+        return self.open_connections
+
+    # stop : Stop serving and drop every open connection, to the other peers it looks like a crash.
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for request in list(self.connections()):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
-    def adjust(self, other):
-        self.value = max(self.value, other)
 
-    def forward(self):
-        self.value += 1
-        return self.value
 
 # The server class
 class peer:
@@ -45,17 +81,76 @@ class peer:
         self.host_addr = host_addr
         self.peer_id = peer_id
         host_ip = socket.gethostbyname(socket.gethostname())
-        self.db_server = host_ip + ':9063'
+        self.db_server = db.get('DBServer',host_ip + ':9063') # See db_server.py.
+        self.journal_dir = db.get('JournalDir','') # Directory of the transaction logs, the current one by default.
         self.neighbors = neighbors
         self.db = db 
         self.trader = []
+        self.num_traders = db.get('Traders',2) # Number of traders to elect, the products are sharded among them.
+        self.shards = ConsistentHashRing() # Sub-shard of a product -> trader, over the traders that are up.
+        # A product is split into "ProductShards" sub-shards and the offers of a seller are in one of them (see
+        # sharding.py), so the few products spread over all the traders. A buyer asks any trader of the product.
+        self.product_shards = db.get('ProductShards',16)
+        self.offers = {} # Seller: product_name -> the seller_info last registered with the product's trader.
        
-        # Here are the flags used for the election algorithm.
-        self.didReceiveOK = False 
-        self.didReceiveWon = False
-        self.didSendWon = False
+        # Here is the state of the election algorithm, guarded by election_condition.
+        self.election_condition = td.Condition()
+        self.election_running = False
+        self.election_state = None   # "asking" the higher peers, "waiting" for the winners.
+        self.election_round_id = 0   # Replies and timers of an earlier round are ignored.
+        self.election_wait = (0,0)   # ("OK" replies needed, higher peers asked) in the current round.
+        self.election_below = None   # Lowest peer id asked in the current election.
+        self.election_fanout = db.get('ElectionFanout',16) # Higher peers asked at a time, see election_ask.
+        self.election_started = 0.0
+        self.election_oks = 0        # "OK" replies from higher peers in the current round.
+        self.election_replies = 0    # Replies, "OK" or none, from higher peers in the current round.
+        self.election_rtt = db.get('ElectionTimeout',0.5) / 4 # Estimate of an election round trip, seconds.
+        self.min_election_timeout = db.get('ElectionTimeout',0.5)
+        self.trading_started = False
         self.trade_list = {} 
+        self.order_book = OrderBook(db.get('Priority','fifo')) # Product index over trade_list, used by lookup.
         self.lamport_clock = LamportClock()
+        # Propagation of the buyers' clocks (see clocks.py): "gossip" (default), "piggyback" on the trades
+        # only, or "broadcast" to every neighbor at every request.
+        self.clock_propagation = db.get('ClockPropagation','gossip')
+        self.clock_gossip = ClockGossip(lambda: self.lamport_clock.value,lambda neighbors,value: self.multicast(neighbors,'adjust_buyer_clock',value),
+                                        lambda: self.neighbors,db.get('ClockGossipInterval',1.0),db.get('ClockGossipFanout',3),db.get('ClockGossipRounds',2),
+                                        db.get('ClockGossipAntiEntropy',10))
+        self.vector_clock = VectorClock(peer_id) if db.get('Clock','lamport') == 'vector' else None # Trader: orders the trades of all the traders.
+        # Pooled keep-alive connections to the other peers, timeouts in seconds.
+        # Transport is "xmlrpc" or "binary" (see wire.py), a binary peer also serves XML-RPC for the others.
+        self.rpc_pool = ConnectionPool(db.get('ConnectTimeout',2.0),db.get('ReadTimeout',10.0),protocol=db.get('Transport','xmlrpc'))
+        # Failure detection of the traders (see failure_detector.py). A trader is suspected within
+        # DetectionSLA seconds of its last sign of life; the RPC outcomes count as heartbeats, and
+        # "SuspectAfterFailures" failed RPCs in a row get it suspected before that.
+        self.failure_detector = FailureDetector(host_addr,self.monitored_traders,self.heartbeat_targets,self.trader_suspected,self.trader_recovered,
+                                                sla=db.get('DetectionSLA',1.0),interval=db.get('HeartbeatInterval'),threshold=db.get('PhiThreshold',8.0),
+                                                failure_limit=db.get('SuspectAfterFailures',3),clock=self.now)
+        self.rpc_pool.on_alive = self.failure_detector.heartbeat
+        self.rpc_pool.on_down = self.failure_detector.report_failure
+        self.failure_detector.on_unknown = self.trader_heard
+        self.retired = set() # Peer ids of the traders that stepped down, see step_down.
+        self.reroute_latencies = [] # Seconds from a suspicion to the products of the trader being routed elsewhere.
+        # Trader: write-behind cache of the DB (see db_cache.py), trades are acknowledged from trade_list.
+        # "DBWriteBehind": false sends every update to the DB before the trade goes on. With "DBMaxPending"
+        # updates the DB has not taken yet, the trader answers the lookups as busy.
+        self.db_cache = WriteBehindCache(self.push_updates,db.get('DBFlushInterval',0.5),db.get('DBFlushBatch',512),synchronous=not db.get('DBWriteBehind',True),
+                                         on_flushed=self.updates_flushed,max_pending=db.get('DBMaxPending',16384))
+        # Seller: a product that sells out is restocked with "RestockUnits" units of a product. The restocks
+        # are sent to the traders as deltas, {'product_name', 'units', 'key'}, in batches of at most
+        # "RestockBatch": one batch at a time per seller, the restocks made while it is on the way go in the
+        # next one, so their traffic does not grow with the turnover of the stock. "RestockInterval" seconds
+        # between the batches instead.
+        self.restock_units = db.get('RestockUnits',3)
+        self.restock_seq = 0
+        self.restocks = WriteBehindCache(self.send_restocks,db.get('RestockInterval',0),db.get('RestockBatch',512))
+        self.cache_check_interval = db.get('CacheCheckInterval',10.0) # Seconds between checks of trade_list against the DB.
+        self.cache_mismatches = {} # seller peer_id -> [product_name, product_count] that differed from the DB at the last check.
+        self.cache_repairs = 0
+        self.cache_stale = 0
+        # Trader: replication of the sellers it owns to the other traders, see replication.py.
+        self.replication = ReplicationChannel(peer_id,self.replication_targets,self.send_replication,lambda: self.lamport_clock.value,
+                                              self.seller_moved,db.get('ReplicationInterval',0.05),vector_clock=self.vector_clock)
        
 
         # This code creates the semaphores used in the program. 
@@ -63,10 +158,15 @@ class peer:
         # in the program. The semaphores are created with a value of 1, which 
         # means they are initially unlocked. 
 
-        self.flag_won_semaphore = td.BoundedSemaphore(1) 
         self.trade_list_semaphore = td.BoundedSemaphore(1)
         self.semaphore = td.BoundedSemaphore(1) 
         self.clock_semaphore = td.BoundedSemaphore(1)     
+        self.idempotency_semaphore = td.BoundedSemaphore(1)
+        self.inventory_semaphore = td.BoundedSemaphore(1) # Buyer & Seller: db['Inv'], shipment_count and the offer.
+        self.applied_keys = OrderedDict() # Buyer & Seller: idempotency keys of the last trades applied, see recovery.py.
+        self.max_applied_keys = db.get('IdempotencyWindow',100000)
+        self.recoveries = [] # Trader: (requests replayed, seconds) of every recovery of a failed trader's log.
+        self.requests_sent = 0 # Buyer: requests that reached a trader.
 
 
         # Add a new variable to track the number of shipments
@@ -75,61 +175,173 @@ class peer:
         # Save the time when the server was started
         self.start_time = time.time()
 
+        # Instrumentation (see metrics.py): the RPCs are timed by name ("rpc.lookup", ...), the buyers'
+        # requests from lookup to reply ("request"), the elections ("election"); the gauges are read at snapshots.
+        self.metrics = Metrics(peer_id)
+        self.metrics.gauge('shipments_per_second',self.get_average_shipments)
+        self.metrics.gauge('match_rate',self.match_rate)
+        self.metrics.gauge('trade_list',lambda: len(self.trade_list))
+        self.metrics.gauge('reserved_units',self.order_book.reserved)
+        self.metrics.gauge('threads',td.active_count)
+        self.metrics.gauge('rpc_pool',self.rpc_pool.stats)
+        self.metrics.gauge('journal',self.journal_stats)
+        self.metrics.gauge('db_cache',self.db_cache.stats)
+        self.metrics.gauge('replication',self.replication.stats)
+        self.metrics.gauge('failure_detector',self.failure_detector.stats)
+        # Tracing of the requests across the peers (see tracing.py), off unless "Tracing" is true: the spans
+        # of the last requests, "TraceBuffer" of them, with the Lamport clock of the peer at their start.
+        self.tracer = Tracer(peer_id,db.get('TraceBuffer',65536),db.get('Tracing',False),db.get('TraceSample',1.0),lambda: self.lamport_clock.value)
+        if self.tracer.enabled:
+            self.rpc_pool.tracer = self.tracer
+            self.metrics.gauge('tracing',self.tracer.stats)
+        # Events of the peer, queued and written by a background thread (see event_log.py): to the log by
+        # default, as JSON lines to "EventLog" ("events_{peer_id}.jsonl"), or not at all with false.
+        # "LogSample" is {event: share kept} for the high-rate ones: "request", "trade", "purchase".
+        event_target = db.get('EventLog')
+        self.events = EventLog(peer_id,lambda: self.lamport_clock.value,event_target.format(peer_id=peer_id) if event_target else None,
+                               EVENTS,db.get('LogSample'),db.get('EventQueue',65536),enabled=event_target is not False)
+        self.metrics.gauge('events',self.events.stats)
+
+        # Trader: the lookups run on "TraderWorkers" threads (0: one per request, without admission control)
+        # after at most "TraderQueueTimeout" seconds in a queue of "TraderQueue" requests, or get a "busy"
+        # reply (see admission.py). Buyer: a busy trader is left alone for about "BusyBackoff" seconds.
+        self.admission = AdmissionQueue(db.get('TraderWorkers',8),db.get('TraderQueue',64),db.get('TraderQueueTimeout',0.5),
+                                        self.metrics.histogram('admission.wait'))
+        self.metrics.gauge('admission',self.admission.stats)
+        self.busy_traders = {} # Buyer: trader host_addr -> now() until which it is not sent requests.
+        self.busy_backoff = db.get('BusyBackoff',0.2)
+        # Buyer: (trader host_addr, product_name) -> now() until which the trader is not asked for the product,
+        # it had none of it and another trader of the product may have some. For about "EmptyBackoff" seconds.
+        self.empty_traders = {}
+        self.empty_backoff = db.get('EmptyBackoff',5.0)
+        # Buyer: pacing of the rounds of requests, see begin_trading.
+        self.batch_size = 1
+        self.request_interval = 3.0
+        self.buy_deadline = None
+        self.next_request = 0.0
+
     def get_average_shipments(self):
         elapsed_time = time.time() - self.start_time
         return self.shipment_count / elapsed_time   
 
-    def print_average_shipments(self):
-        print("Average shipments per second: ", self.get_average_shipments())
-        logging.info("Average shipments per second: " + str(self.get_average_shipments()))
+    # match_rate : Trader: share of the requested products found in the order book.
+    def match_rate(self):
+        lookups = self.metrics.counters.get('lookups',0)
+        return self.metrics.counters.get('matched',0) / lookups if lookups else None
+
+    # journal_file : The transaction log of a trader.
+    def journal_file(self,peer_id):
+        return os.path.join(self.journal_dir,"transactions_" + str(peer_id) + ".csv")
+
+    # journal_stats : Trader: queue and fsync times of its transaction log, None before the first trade.
+    def journal_stats(self):
+        journal = data_ops.journals.get(self.journal_file(self.peer_id))
+        return journal.stats() if journal is not None else None
+
+    # stats : Snapshot of the metrics of the peer, also served as JSON on GET /stats.
+    def stats(self):
+        return self.metrics.snapshot()
 
 
-   # The following method is used to get the proxy for a peer.
+    # The following method is used to get the proxy for a peer.
+    # The proxy is shared and pooled; a peer whose last call failed is reported as not connected
+    # until the pool's retry interval has passed.
     def get_rpc(self,neighbor):
-        a = xmlrpc.client.ServerProxy('http://' + str(neighbor) + '/')
-        try:
-            a.test()   # Call a fictive method.
-        except xmlrpc.client.Fault:
-            # The peer is not available.
-            pass
-        except socket.error:
-            # Not connected to the server. 
+        if not self.rpc_pool.is_alive(neighbor):
             return False, None
-            
-        # connected to the server and the method exists.
-        return True, a
+        return True, self.rpc_pool.proxy(neighbor)
+
+    # rpc_functions : The methods a peer serves, by RPC name.
+    def rpc_functions(self):
+        functions = {
+            'lookup': self.admission.gate(self.tracer.traced('lookup',self.lookup)),
+            'lookup_batch': self.admission.gate(self.tracer.traced('lookup_batch',self.lookup_batch)),
+            'transaction_batch': self.transaction_batch,
+            'transaction': self.transaction,
+            'election_message': self.election_message,
+            'register_products': self.register_products,
+            'restock': self.restock,
+            'adjust_buyer_clock': self.adjust_buyer_clock,
+            'replicate': self.replicate,
+            'get_average_shipments': self.get_average_shipments,
+            'periodic_ping_message': self.periodic_ping_message,
+            'periodic_ping_reply': self.periodic_ping_reply,
+            'trader_status_update': self.trader_status_update,
+            'failover_stats': self.failover_stats,
+            'cache_stats': self.cache_stats,
+            'replication_stats': self.replication_stats,
+            'load_stats': self.load_stats,
+        }
+        functions = {name: self.tracer.traced('rpc.' + name,self.metrics.timed('rpc.' + name,function)) for name,function in functions.items()}
+        functions['stats'] = self.stats
+        functions['trace_dump'] = self.tracer.dump
+        return functions
 
     # The following method is used to start the server process.
     def startServer(self):
         # Start Server and register its functions.
         host_ip = socket.gethostbyname(socket.gethostname())
-        server = AsyncXMLRPCServer((host_ip,int(self.host_addr.split(':')[1])),allow_none=True,logRequests=False)
-        server.register_function(self.lookup,'lookup')
-        server.register_function(self.transaction,'transaction')
-        server.register_function(self.election_message,'election_message')
-        server.register_function(self.register_products,'register_products')
-        server.register_function(self.adjust_buyer_clock,'adjust_buyer_clock')
-        server.register_function(self.election_restart_message,'election_restart_message')
-        server.register_function(self.sync_cache,'sync_cache')
-        server.register_function(self.get_average_shipments,'get_average_shipments')
-        server.register_function(self.periodic_ping_message,'periodic_ping_message')
-        server.register_function(self.periodic_ping_reply,'periodic_ping_reply')
-        server.register_function(self.trader_status_update,"trader_status_update")
+        self.start_services(host_ip)
+        server = AsyncXMLRPCServer((host_ip,int(self.host_addr.split(':')[1])),allow_none=True,logRequests=False,requestHandler=KeepAliveRequestHandler)
+        for name,function in self.rpc_functions().items():
+            server.register_function(function,name)
+        self.server = server
         server.serve_forever()
 
-        timer = td.Timer(1.0, self.print_average_shipments)
+    # start_services : What runs beside the RPC server: the binary server, the failure detector and the
+    # periodic metrics snapshots ("MetricsInterval" seconds, 60 by default, 0 disables them), written to
+    # the log or to "MetricsFile", where "{peer_id}" is replaced, e.g. "metrics_{peer_id}.jsonl".
+    def start_services(self,host_ip):
+        self.start_wire_server(host_ip)
+        self.failure_detector.start(host_ip)
+        metrics_file = self.db.get('MetricsFile')
+        if metrics_file is not None:
+            metrics_file = metrics_file.format(peer_id=self.peer_id)
+        self.metrics.start_reporting(self.db.get('MetricsInterval',60.0),metrics_file)
+
+    # stop : Take the peer off the network.
+    def stop(self):
+        self.server.stop()
+        self.failure_detector.stop()
+        self.rpc_pool.close()
+        self.events.flush()
+
+    # start_wire_server : With the binary transport, serve the RPC functions on the wire port too.
+    def start_wire_server(self,host_ip):
+        if self.rpc_pool.protocol == "binary":
+            _,port = wire_addr(self.host_addr)
+            wire_server = BinaryRPCServer((host_ip,port),self.rpc_functions())
+            td.Thread(target=wire_server.serve_forever,daemon=True).start()
+
+    # multicast : Call an RPC method on several neighbors concurrently, one thread per neighbor.
+    def multicast(self,neighbors,method,*args):
+        for neighbor in neighbors:
+            thread = td.Thread(target=self.send_rpc,args=(neighbor['host_addr'],method) + args)
+            thread.start()
+
+    # spawn : Run function(*args) in a thread of its own. The simulator (see simulator.py) runs it as an event instead.
+    def spawn(self,function,*args,daemon=False):
+        thread = td.Thread(target=function,args=args,daemon=daemon)
+        thread.start()
+
+    # later : Run function(*args) on a timer thread in `delay` seconds. The simulator runs it on its virtual clock.
+    def later(self,delay,function,*args):
+        timer = td.Timer(max(delay,0.0),function,args)
+        timer.daemon = True
         timer.start()
 
+    # now : Seconds on a monotonic clock, for the timeouts and back-offs. Virtual in the simulator.
+    def now(self):
+        return time.monotonic()
+
+    def send_rpc(self,host_addr,method,*args):
+        connected,proxy = self.get_rpc(host_addr)
+        if connected:
+            return getattr(proxy,method)(*args)
+
     # broadcast_lamport_clock : This method broadcasts a peer's clock to all the peers.
     def broadcast_lamport_clock(self):
-        for neighbor in self.neighbors:
-            thread = td.Thread(target=self.send_broadcast_message,args=("I won",neighbor)) # Start Server
-            thread.start()
-            
-    def send_broadcast_message(self,_,neighbor): # Broadcast the clock.
-        connected,proxy = self.get_rpc(neighbor['host_addr'])
-        if connected:
-            proxy.adjust_buyer_clock(self.lamport_clock.value) 
+        self.multicast(self.neighbors,'adjust_buyer_clock',self.lamport_clock.value)
     
     # adjust_buyer_clock: Upon receiving this message, a peer adjusts its clock, only buyer and seller adjust there clock, but not the trader.(This is a design choice.)
     def adjust_buyer_clock(self, other):
@@ -138,370 +350,943 @@ class peer:
             self.lamport_clock.adjust(other) 
             self.clock_semaphore.release()
 
-    # election_restart_message : 
-    # When a peer receives this message, it signals the beginning of a fresh election. 
-    # The next step is to raise the election running flag. 
-    # This banner advises prospective buyers to postpone their purchases until after the election.
-    def election_restart_message(self):
-        self.flag_won_semaphore.acquire()
-        self.didReceiveOK = False
-        self.didReceiveWon = False
-        if self.peer_id == 1:
-            time.sleep(3.0)
-            thread = td.Thread(target=self.start_election,args=()) # Second Election
+    def peer_info(self):
+        return {'peer_id':self.peer_id,'host_addr':self.host_addr,'status':1}
+
+    # request_all : Call an RPC method on several neighbors concurrently. on_reply(neighbor, reply, latency)
+    # is called for every reply, with reply None if the neighbor could not be reached.
+    def request_all(self,neighbors,method,args,on_reply):
+        def request(neighbor):
+            start = time.monotonic()
+            reply = self.send_rpc(neighbor['host_addr'],method,*args)
+            on_reply(neighbor,reply,time.monotonic() - start)
+        for neighbor in neighbors:
+            thread = td.Thread(target=request,args=(neighbor,))
             thread.start()
-        self.flag_won_semaphore.release()
 
-    # This method is used to send the election restart message to all the peers.     
-    def send_restart_election_messages(self,_,neighbor):
-        connected,proxy = self.get_rpc(neighbor['host_addr'])
-        if connected:
-            proxy.election_restart_message() 
+    def active_traders(self):
+        return [trader for trader in self.trader if trader['status']]
 
-     # This method is used to send the election message to a peer on a new thread.                
-    def send_message(self,message,neighbor):
-        connected,proxy = self.get_rpc(neighbor['host_addr'])
-        if connected:
-            proxy.election_message(message,{'peer_id':self.peer_id,'host_addr':self.host_addr,'status':1})
-            
-    # This message is used to send the results of the election to all the peers.
-    def fwd_won_message(self):
-        logging.info("Election completed. I, Peer {}, am the new coordinator.".format(self.peer_id))
-        self.didReceiveWon = True
-        
-        self.trader.append({'peer_id':self.peer_id,'host_addr':self.host_addr,'status' : 1})
-        self.db['Role'] = 'Trader'
-        self.flag_won_semaphore.release()
-        for neighbor in self.neighbors:
-            thread = td.Thread(target=self.send_message,args=("I won",neighbor)) # Start Server
-            thread.start() 
-       
-        if len(self.trader) == 1:
-             time.sleep(3.0)
-             for neighbor in self.neighbors:
-                thread = td.Thread(target = self.send_restart_election_messages,args = (" ",neighbor))
-                thread.start() # Sending Neighbors reelection notification.
+    # election_timeout : Longest wait for the replies of a round, adapted to the observed round trips.
+    def election_timeout(self):
+        return max(self.min_election_timeout,4 * self.election_rtt)
+
+    # start_election : Bully election of all the missing traders in one round.
+    # The peer sends "election" to the higher peers that are not traders. Each of them answers "OK" as the
+    # reply of the call and runs its own election. A peer that gets fewer "OK" than the number of missing
+    # traders is among the highest peers alive and declares itself trader with "I won".
+    # A round ends as soon as the outcome is known, the timers only matter when a peer does not answer.
+    def start_election(self):
+        with self.election_condition:
+            if self.election_running or self.db['Role'] in ('Trader','Retired'):
+                return
+            self.election_running = True
+            self.election_started = self.now()
+        self.events.log('election_started')
+        self.election_round()
+
+    # election_round : Count the "OK" of the higher peers again, from the highest down.
+    def election_round(self):
+        needed = self.num_traders - len(self.active_traders())
+        if needed <= 0:
+            self.election_done()
+            return
+        with self.election_condition:
+            self.election_oks = 0
+        self.election_ask(needed,None)
+
+    # election_ask : Ask the next "ElectionFanout" higher peers, below peer id `below`, the highest first, for
+    # the `needed` "OK" of the round. The batch is decided on their replies or at the timeout; the peers below
+    # are only asked if the batch did not answer with enough "OK", so an election costs messages in the
+    # fanout, not in the number of peers.
+    def election_ask(self,needed,below):
+        higher_peers = self.higher_peers(self.election_fanout,below)
+        with self.election_condition:
+            self.election_round_id += 1
+            round_id = self.election_round_id
+            self.election_replies = 0
+            self.election_state = "asking"
+            self.election_wait = (needed,len(higher_peers))
+            if higher_peers:
+                self.election_below = higher_peers[-1]['peer_id']
+        self.request_all(higher_peers,'election_message',("election",self.peer_info()),functools.partial(self.election_reply,round_id))
+        if higher_peers:
+            self.later(self.election_timeout(),self.election_decide,round_id)
         else:
-            logging.info("Trading begins now!")
-            thread2 = td.Thread(target=peer_local.begin_trading,args=())
-            thread2.start()                 
-            
-    # election_message: This technique supports three different message types:
-    # 1) "election": Upon getting this message, the peer will respond with "OK" to the sender, and if there are any higher peers, it will forward the message and wait for OK messages; if it doesn't, it will be the leader.
-    # 2) "OK": Leaves the election and raises the flag didReceiveOK, preventing it from continuing to forward the election message.
-    # 3) "I won": After receiving this message, the peer assigns the variable trader's leader details and initiates the trading process.
+            self.election_decide(round_id)
+
+    # higher_peers : Up to `count` of the highest peers above this one that are not traders, below peer id
+    # `below` if it is given. The neighbors are in peer id order, as market.py and the launcher make them.
+    def higher_peers(self,count,below=None):
+        trader_ids = set(self.trader_ids())
+        higher_peers = []
+        for neighbor in reversed(self.neighbors):
+            if neighbor['peer_id'] <= self.peer_id or len(higher_peers) == count:
+                break
+            if (below is None or neighbor['peer_id'] < below) and neighbor['peer_id'] not in trader_ids:
+                higher_peers.append(neighbor)
+        return higher_peers
+
+    def election_reply(self,round_id,neighbor,reply,latency):
+        with self.election_condition:
+            if round_id != self.election_round_id:
+                return
+            self.election_replies += 1
+            if reply == "OK":
+                self.election_oks += 1
+                self.election_rtt = 0.8 * self.election_rtt + 0.2 * latency
+            needed,asked = self.election_wait
+            decided = self.election_state == "asking" and (self.election_oks >= needed or self.election_replies == asked)
+        if decided:
+            self.election_decide(round_id)
+
+    # election_decide : End of a batch. With as many "OK" as missing traders the peer drops out and waits for
+    # the winners, and starts again if they do not show up. Otherwise it asks the next higher peers, and once
+    # there are none left, it has won.
+    def election_decide(self,round_id):
+        with self.election_condition:
+            if round_id != self.election_round_id or self.election_state != "asking":
+                return
+            needed,asked = self.election_wait
+            won = self.election_oks < needed and asked == 0
+            wait = self.election_oks >= needed
+            self.election_state = "waiting" if wait else None
+        if won:
+            self.declare_victory()
+            self.election_done()
+        elif wait:
+            self.later(3 * self.election_timeout(),self.election_retry,round_id)
+        else:
+            self.election_ask(needed,self.election_below)
+
+    def election_retry(self,round_id):
+        with self.election_condition:
+            if round_id != self.election_round_id or self.election_state != "waiting":
+                return
+            self.election_state = None
+        self.election_round()
+
+    def election_done(self):
+        with self.election_condition:
+            self.election_state = None
+            self.election_round_id += 1
+            self.election_running = False
+        self.metrics.histogram('election').record(self.now() - self.election_started) # Until this peer won or knows every trader.
+
+    # declare_victory : The peer becomes a trader and sends "I won" to all the peers.
+    def declare_victory(self):
+        self.events.log('elected')
+        self.db['Role'] = 'Trader'
+        self.add_trader(self.peer_info())
+        self.multicast(self.neighbors,'election_message',"I won",self.peer_info())
+        if self.trading_started: # Replacement of a failed trader.
+            self.spawn(self.begin_trading)
+        self.trader_elected()
+
+    # trader_elected : A peer waiting for the winners is done once all the traders are known, and trading starts.
+    def trader_elected(self):
+        with self.election_condition:
+            elected = len(self.active_traders()) >= self.num_traders
+            done = elected and self.election_state == "waiting"
+            if done:
+                self.election_state = None
+            start = elected and not self.trading_started
+            if start:
+                self.trading_started = True
+        if done:
+            self.election_done()
+        if not start:
+            return
+        self.events.log('trading_started')
+        self.spawn(self.begin_trading)
+
+    # election_message: This technique supports two different message types:
+    # 1) "election": The peer replies "OK" to the sender and runs its own election; a trader sends the sender its "I won" again instead.
+    # 2) "I won": After receiving this message, the peer adds the sender to its traders and starts trading once all are elected.
     def election_message(self,message,neighbor):
         if message == "election":
-            # If the peer is the highest peer, it will be the leader.
-            if self.didReceiveOK or self.didReceiveWon:
-                thread = td.Thread(target=self.send_message,args=("OK",neighbor)) # Start Server
-                thread.start()
-            else:
-                thread = td.Thread(target=self.send_message,args=("OK",neighbor)) # Start Server
-                thread.start()
-                peers = [x['peer_id'] for x in self.neighbors]
-                peers = np.array(peers)
-                x = len(peers[peers > self.peer_id])
-
-                if x > 0:
-                    self.flag_won_semaphore.acquire()
-                    self.isElectionRunning = True # Set the flag
-                    self.flag_won_semaphore.release()
-                    self.didReceiveOK = False
-                    for neighbor in self.neighbors:
-                        if neighbor['peer_id'] > self.peer_id:
-                            if self.trader != [] and neighbor['peer_id'] == self.trader[0]['peer_id']:
-                                pass
-                            else:    
-                                thread = td.Thread(target=self.send_message,args=("election",neighbor)) # Start Server
-                                thread.start()
-                                
-                    time.sleep(2.0) # Wait for 2 seconds
-                                            
-                    self.flag_won_semaphore.acquire()
-                    if self.didReceiveOK == False and self.didSendWon == False:
-                        self.didSendWon = True
-                        self.fwd_won_message() # Forward the won message
-                    else:
-                        self.flag_won_semaphore.release()
-                               
-                elif x == 0:
-                    self.flag_won_semaphore.acquire()
-                    if self.didSendWon == False:
-                        self.didSendWon = True
-                        self.fwd_won_message()
-                    else:
-                        self.flag_won_semaphore.release()
-                        
-        elif message == 'OK':
-            # Drop out and wait
-            self.didReceiveOK = True
-                            
+            if self.db['Role'] != 'Trader':
+                self.spawn(self.start_election)
+            else: # The sender missed the "I won" of this trader, it was not listening yet.
+                self.spawn(self.send_rpc,neighbor['host_addr'],'election_message',"I won",self.peer_info())
+            return "OK"
         elif message == 'I won':
-            logging.info("[{}][Peer {}]: Won the election and message has been received".format(datetime.datetime.now(),self.peer_id))
-            self.flag_won_semaphore.acquire()
-            self.didReceiveWon = True
-            self.flag_won_semaphore.release()
-            self.trader.append(neighbor)
-            time.sleep(3.0)
-            if len(self.trader) == 2: # Once Both the traders are elected, start the trading process.
-                thread2 = td.Thread(target=peer_local.begin_trading,args=())
-                thread2.start()
-    
-    # start_election: If there are no higher peers, the leader declares victory and sends a 
-    # "I won" message to the peers, which kicks off the election using this method.   
-    def start_election(self):
-        logging.info("[{}][Peer {}]: Election proceedings have started.".format(datetime.datetime.now(),self.peer_id))
-
-        time.sleep(1)
-        # If there are no peers higher than you, you are the leader.
-        peers = [x['peer_id'] for x in self.neighbors]
-        peers = np.array(peers)
-        x = len(peers[peers > self.peer_id])
-        if x > 0:
-            self.didReceiveOK = False
-            self.didReceiveWon = False
-            for neighbor in self.neighbors:
-                if neighbor['peer_id'] > self.peer_id:
-                    if self.trader != [] and neighbor['peer_id'] == self.trader[0]['peer_id']: # If the peer is already the trader, don't send the message.
-                        pass
-                    else:    
-                        thread = td.Thread(target=self.send_message,args=("election",neighbor)) # Start Server
-                        thread.start()  
-            time.sleep(2.0)
-            self.flag_won_semaphore.acquire()
-            if self.didReceiveOK == False and self.didReceiveWon == False:
-               self.didSendWon = True
-               self.fwd_won_message()
-            else:
-                self.flag_won_semaphore.release()
-        else: # No higher peers
-            self.flag_won_semaphore.acquire()
-            self.didSendWon = True
-            self.fwd_won_message() # Release of semaphore is in fwd_won_message
+            self.events.log('trader_announced',trader=neighbor['peer_id'])
+            owners = self.offer_owners()
+            self.add_trader(neighbor)
+            self.release_offers()
+            self.reregister_offers(owners)
+            self.trader_elected()
+            self.check_surplus()
      
-    # Helper Method : Obtain the current Trader, verify the Trader's status, and return the Active Trader Proxy.
-    def get_active_trader(self):
+    # add_trader : Record an elected trader and give it its share of the products.
+    def add_trader(self,trader):
         self.semaphore.acquire()
-        x = random.randint(0, 1)
-        trader = self.trader[x]
-        if not trader["status"]:
-            z = [0,1]
-            z.remove(x)
-            x = z[0]
-            trader = self.trader[x]
+        self.trader = [known for known in self.trader if known['peer_id'] != trader['peer_id']] + [trader]
+        if trader['status']:
+            self.shards.add(trader)
+        self.empty_traders = {} # The offers move to the new trader.
         self.semaphore.release()
-        return self.get_rpc(self.trader[x]["host_addr"])
+
+    def trader_ids(self):
+        return [trader['peer_id'] for trader in self.trader]
+
+    # get_trader : The Trader in charge of a seller's offer of a product, or any trader that is up without a product.
+    def get_trader(self,product_name=None,seller_peer_id=None):
+        self.semaphore.acquire()
+        if product_name is None:
+            active = [trader for trader in self.trader if trader['status']]
+            trader = random.choice(active) if len(active) > 0 else None
+        else:
+            trader = self.shards.owner(sub_shard(product_name,seller_peer_id,self.product_shards))
+        self.semaphore.release()
+        return trader
+
+    # Helper Method : Obtain the Trader in charge of a seller's offer, verify the Trader's status, and return the Active Trader Proxy.
+    def get_active_trader(self,product_name=None,seller_peer_id=None):
+        trader = self.get_trader(product_name,seller_peer_id)
+        if trader is None:
+            return False, None
+        return self.get_rpc(trader["host_addr"])
          
+    # request_trader : Buyer: the trader to ask for a product, and whether another trader may have it if this
+    # one has none or is busy. A trader of the product is drawn in proportion to its sub-shards, leaving out
+    # the busy ones unless they all are, and the ones that had none of the product lately unless they all had none.
+    def request_trader(self,product_name):
+        self.semaphore.acquire()
+        owners = self.shards.shard_owners(product_name,self.product_shards)
+        self.semaphore.release()
+        now = self.now()
+        free = [owner for owner in owners if self.busy_traders.get(owner['host_addr'],0) <= now] or owners
+        stocked = [owner for owner in free if self.empty_traders.get((owner['host_addr'],product_name),0) <= now]
+        if not stocked:
+            return (random.choice(free) if free else None),False
+        trader = random.choice(stocked)
+        return trader,any(owner['peer_id'] != trader['peer_id'] for owner in stocked)
+
     # begin_trading : For a seller, through this method they register there product at the trader. For buyer, they start lookup process for the products needed, in this lab every lookup process is directed at the trader and he sells those goods on behalf of the sellers.            
     def begin_trading(self):
-        # Delay so that al the election message are replied or election is dropped by peers other than the trader.
-        # Reset the flags.
-        self.didReceiveWon = False
-        self.didReceiveOK = False
-
-        buy_count = 0
-        sell_count = 0
-        for i in self.neighbors:
-            if i["role"] == "Seller":
-                sell_count += 1
-            if i["role"] == "Buyer":
-                buy_count += 1
-
-        # print("The number of sellers and buyers are {} and {}".format(sell_count,buy_count))
-        # if sell_count == len(self.neighbors):
-        #     logging.error("[Peer {}]: All the neighbors are sellers. Please change the role of one of the neighbors to buyer.".format(self.peer_id))
-        #     return
-        # if buy_count == len(self.neighbors):
-        #     logging.error("[Peer {}]: All the neighbors are buyers. Please change the role of one of the neighbors to seller.".format(self.peer_id))
-        #     return
-
-        # If Seller, register the poducts.
+        if self.clock_propagation == 'gossip':
+            self.clock_gossip.start()
+        # If Seller, register the poducts, each one with the trader in charge of it.
         if self.db["Role"] == "Seller":
-            connected,proxy = self.get_active_trader()
-            p_n = None
-            p_c = None
             for product_name, product_count in self.db['Inv'].items():
                 if product_count > 0:
-                    p_n= product_name
-                    p_c = product_count
-            seller_info = {'seller_id': {'peer_id':self.peer_id,'host_addr':self.host_addr},'product_name':p_n,'product_count':p_c} 
-            if connected:
-                proxy.register_products(seller_info)
+                    seller_info = {'seller_id': {'peer_id':self.peer_id,'host_addr':self.host_addr},'product_name':product_name,'product_count':product_count} 
+                    self.offers[product_name] = seller_info
+                    connected,proxy = self.get_active_trader(product_name,self.peer_id)
+                    if connected:
+                        proxy.register_products(seller_info)
         elif self.db["Role"] == "Trader":
             connected,proxy = self.get_rpc(self.db_server)
             if connected: # Register with DB.
                 proxy.register_traders({'peer_id':self.peer_id,'host_addr':self.host_addr})
+            self.spawn(self.cache_check_loop,daemon=True)
 
         # If buyer, wait for 2 sec for seller to register products and then start buying.
         elif self.db["Role"] == "Buyer":
-            time.sleep(3.0 + self.peer_id/10.0) # Allow sellers to register the products.
-
             if len(self.db['shop'])== 0:
                 logging.error("[Peer {}]: No products are registered. Please register the products.".format(self.peer_id))
                 return
+            start_delay = self.db.get('StartDelay',3.0 + self.peer_id/10.0) # Allow sellers to register the products.
+            self.batch_size = max(self.db.get('BatchSize',len(self.db['shop'])),1) # Items per lookup_batch, 1 disables batching.
+            # Pacing: "RequestRate" lookups (or batches) per second, one every 3 s by default. With "Duration"
+            # (seconds), the buyer generates load: the shop list is bought over and over until then.
+            self.request_interval = 1.0 / self.db['RequestRate'] if self.db.get('RequestRate') else 3.0
+            self.buy_deadline = self.now() + start_delay + self.db['Duration'] if self.db.get('Duration') else None
+            self.next_request = self.now() + start_delay
+            self.later(start_delay,self.buy)
 
-            
-            while len(self.db['shop'])!= 0:
-                item = self.db['shop'][0]
-                connected,proxy = self.get_active_trader()
-                if connected:
-                    self.clock_semaphore.acquire()
-                    self.lamport_clock.forward()
-                    request_ts = self.lamport_clock.value
-                    self.broadcast_lamport_clock()
-                    self.clock_semaphore.release()
-                    logging.info("[Peer {}:] Requesting {}".format(self.peer_id,item))
-                    proxy.lookup({'peer_id':self.peer_id,'host_addr':self.host_addr},item,request_ts)       
-                    self.db['shop'].remove(item)                   
-                    time.sleep(3.0)           
-    
-    # register_products: Trader registers the seller goods.
+    # buy : Buyer sends a round of requests, the first items of its shop list.
+    def buy(self):
+        if len(self.db['shop']) == 0 or (self.buy_deadline is not None and self.now() >= self.buy_deadline):
+            return
+        items = self.db['shop'][:self.batch_size]
+        requests = self.stamp_requests(items)
+        self.events.log('request',items=requests)
+        self.send_requests(requests,functools.partial(self.requests_done,items,requests))
+
+    # requests_done : The items served leave the shop list, or go to its end when generating load. The next
+    # round is due one interval after this one, or right away if the replies took longer.
+    def requests_done(self,items,requests,served):
+        for item,request in zip(items,requests):
+            if request in served:
+                self.db['shop'].remove(item)
+                if self.buy_deadline is not None:
+                    self.db['shop'].append(item)
+        self.next_request = max(self.next_request + self.request_interval,self.now()) # Fixed rate, no burst after a stall.
+        self.later(self.next_request - self.now(),self.buy)
+
+    # stamp_requests : Buyer makes a [product_name, quantity, clock] request of every item of the shop
+    # list, a product name for one unit or [product_name, quantity].
+    # With "broadcast" clock propagation, the new clock is sent to every neighbor, after the clock is released.
+    def stamp_requests(self,items):
+        orders = [(item,1) if isinstance(item,str) else tuple(item) for item in items]
+        self.clock_semaphore.acquire()
+        requests = [[product_name,quantity,self.lamport_clock.forward()] for product_name,quantity in orders]
+        self.clock_semaphore.release()
+        if self.clock_propagation == 'broadcast':
+            self.broadcast_lamport_clock()
+        return requests
+
+    # send_requests : Buyer sends each [product_name, quantity, clock] request to a trader of the product
+    # (see request_trader), one lookup_batch per trader. Returns the requests a trader has answered, with the
+    # units it filled or none; the requests turned away as "busy" or that reached no trader (the call
+    # failed, None) stay on the shop list for the next round, by then the trader may have been replaced.
+    # A request a trader had none of or was too busy for, while another trader of the product may have
+    # some, is sent again to another one. on_done(served) is called with the requests answered once every trader has replied.
+    def send_requests(self,requests,on_done=None):
+        buyer_id = {'peer_id':self.peer_id,'host_addr':self.host_addr}
+        shards = {} # trader host_addr -> requests
+        elsewhere = set() # id() of the requests another trader may fill.
+        for request in requests:
+            trader,fallback = self.request_trader(request[0])
+            if trader is not None and self.busy_traders.get(trader['host_addr'],0) <= self.now(): # Backing off, the items wait for the next round.
+                shards.setdefault(trader['host_addr'],[]).append(request)
+                if fallback:
+                    elsewhere.add(id(request))
+        sent = []
+        empty = [] # Requests to send to another trader of the product.
+        waiting = [len(shards)]
+        def answered(host_addr,shard_requests,reply,latency):
+            sent.extend(self.requests_answered(host_addr,shard_requests,reply,latency,elsewhere,empty))
+            waiting[0] -= 1
+            if waiting[0] == 0:
+                done()
+        def done():
+            if empty: # The trader that had none of it or was busy is left out now, see request_trader.
+                self.send_requests(empty,retried)
+            elif on_done is not None:
+                on_done(sent)
+        def retried(served):
+            sent.extend(served)
+            if on_done is not None:
+                on_done(sent)
+        if not shards:
+            done()
+        for host_addr,shard_requests in shards.items():
+            self.send_shard(host_addr,buyer_id,shard_requests,functools.partial(answered,host_addr,shard_requests))
+        return sent
+
+    # send_shard : Send a trader its requests, a lookup or a lookup_batch; on_reply(reply, latency) gets the
+    # reply, None if the call did not get there. The simulator sends them as a message instead.
+    def send_shard(self,host_addr,buyer_id,shard_requests,on_reply):
+        connected,proxy = self.get_rpc(host_addr)
+        if not connected:
+            on_reply(None,0.0)
+            return
+        start = time.perf_counter()
+        with self.tracer.trace('request',"{}:{}".format(self.peer_id,shard_requests[0][2])): # Traced by the clock of its first item.
+            if len(shard_requests) > 1:
+                try:
+                    reply = proxy.lookup_batch(buyer_id,shard_requests)
+                except xmlrpc.client.Fault: # The trader has no lookup_batch, send the items one by one.
+                    reply = [proxy.lookup(buyer_id,item,request_ts,quantity) for item,quantity,request_ts in shard_requests]
+            else:
+                item,quantity,request_ts = shard_requests[0]
+                reply = proxy.lookup(buyer_id,item,request_ts,quantity)
+        on_reply(reply,time.perf_counter() - start)
+
+    # requests_answered : The requests of a trader that it served, from its reply: the units filled per
+    # request for a lookup_batch, of the request for a lookup, or "busy" or None for all of them.
+    # A request it had none of or was busy for goes to `empty`, for another trader of the product, if
+    # `elsewhere` has its id().
+    def requests_answered(self,host_addr,shard_requests,reply,latency,elsewhere=(),empty=None):
+        replies = reply if isinstance(reply,list) else [reply] * len(shard_requests)
+        served = []
+        for request,units in zip(shard_requests,replies):
+            if units is None:
+                continue
+            if units == BUSY:
+                if id(request) in elsewhere:
+                    empty.append(request)
+                continue
+            if units == 0 and id(request) in elsewhere:
+                self.empty_traders[(host_addr,request[0])] = self.now() + self.empty_backoff * random.uniform(0.5,1.5)
+                self.metrics.incr('empty')
+                empty.append(request)
+                continue
+            served.append(request)
+        busy = sum(1 for reply in replies if reply == BUSY)
+        if busy: # The trader is overloaded, leave it alone for a while.
+            self.busy_traders[host_addr] = self.now() + self.busy_backoff * random.uniform(0.5,1.5)
+            self.metrics.incr('busy',busy)
+        unreached = sum(1 for reply in replies if reply is None)
+        if unreached:
+            self.metrics.incr('unreached',unreached)
+        request_latency = self.metrics.histogram('request')
+        for _ in served:
+            request_latency.record(latency)
+        self.requests_sent += len(served)
+        return served
+
+    # register_products: Trader registers the seller goods, the offer of one product of the seller.
     def register_products(self,seller_info): # Trader End.
-        seller_peer_id = seller_info['seller_id']['peer_id'] # Key in trade-list
-        self.trade_list[str(seller_peer_id)] = seller_info # Add the product in local cache and contact DB to update this info.
-        connected,proxy = self.get_rpc(self.db_server)
-        if connected:
-            proxy.register_products(seller_info,{'peer_id':self.peer_id,'host_addr':self.host_addr})
+        self.trade_list_semaphore.acquire()
+        self.trade_list[offer_key(seller_info)] = seller_info # Add the product in local cache and contact DB to update this info.
+        self.order_book.upsert(seller_info)
+        self.replication.publish(seller_info)
+        self.trade_list_semaphore.release()
+        self.db_cache.offer(dict(seller_info)) # A copy, the trades change the cached one.
+
+    # restock : Trader adds the units a seller has restocked, [{'product_name', 'units', 'key'}], to its
+    # offers. A delta is applied once, by its key. The seller gets an offer for a product it had none of here.
+    def restock(self,seller_id,deltas): # Trader End.
+        for delta in deltas:
+            if not self.first_time(delta['key']):
+                continue
+            seller_info = {'seller_id':seller_id,'product_name':delta['product_name'],'product_count':0}
+            self.trade_list_semaphore.acquire()
+            offer = self.trade_list.get(offer_key(seller_info))
+            if offer is None: # Registered empty first, the DB then gets the units like the other restocks.
+                offer = self.trade_list[offer_key(seller_info)] = seller_info
+                self.db_cache.offer(dict(offer))
+            self.order_book.restock(offer,delta['units'])
+            self.replication.publish(offer)
+            self.db_cache.restocked(delta['key'],offer,delta['units'])
+            self.trade_list_semaphore.release()
+        return True
     
-    # lookup : Trader lookups the product that a buyer wants to buy and replies respective seller and buyer.     
-    def lookup(self,buyer_id,product_name,buyer_clock):
-        self.lamport_clock.adjust(buyer_clock)        
-        seller_list = []
-        transaction_file_name =  "transactions_" + str(self.peer_id) + ".csv"
-        for peer_id,seller_info in self.trade_list.items():
-            if seller_info["product_name"] == product_name: # Find all the seller who sells the product
-                seller_list.append(seller_info)
+    # lookup : Trader lookups the product that a buyer wants to buy and replies respective seller and buyer.
+    # An order for several units is filled by lookup_batch, from as many sellers as it takes.
+    # Returns the number of units filled, 0 when no seller has the product, "busy" while the DB is behind.
+    def lookup(self,buyer_id,product_name,buyer_clock,quantity=1):
+        if self.db_cache.full(): # The DB is behind, the buyer backs off as from an overloaded trader.
+            self.metrics.incr('db_full')
+            return BUSY
+        if quantity != 1:
+            return self.lookup_batch(buyer_id,[[product_name,quantity,buyer_clock]])[0]
+        self.clock_semaphore.acquire()
+        self.lamport_clock.adjust(buyer_clock)
+        request_ts = self.lamport_clock.forward() # Unique key of the request in the transaction log.
+        self.clock_semaphore.release()
+        key = "{}:{}".format(self.peer_id,request_ts) # Idempotency key of the trade.
+        transaction_file_name = self.journal_file(self.peer_id)
+        with self.tracer.span('match'):
+            reservation = self.order_book.reserve(product_name,1) # Take one unit from the best seller of the product.
+        fills = reservation.fills
+        self.metrics.incr('lookups')
+        self.metrics.incr('matched' if fills else 'unmatched')
                 
-        if len(seller_list) > 0:
-            # Log the request
-            seller = seller_list[0] # Choose the first seller.
-            transaction_log = {str(self.lamport_clock.value) : {'product_name' : product_name, 'buyer_id' : buyer_id, 'seller_id':seller['seller_id'],'completed':False}}
-            data_ops.log_transaction(transaction_file_name,transaction_log) # Log the transaction.
+        if len(fills) > 0:
+            # Log the request, the unit is sold once the log has it.
+            seller,_ = fills[0]
+            transaction_log = {str(request_ts) : {'product_name' : product_name, 'buyer_id' : buyer_id, 'seller_id':seller['seller_id']}}
+            if self.vector_clock is not None:
+                transaction_log[str(request_ts)]['vclock'] = self.vector_clock.tick()
+            try:
+                with self.tracer.span('journal'):
+                    data_ops.log_transaction(transaction_file_name,transaction_log) # Log the transaction.
+            except Exception:
+                self.order_book.release(reservation) # Not sold, the unit goes back to the seller's offer.
+                raise
+            self.order_book.commit(reservation)
+            self.replication.publish(seller)
+            self.events.log('trade',quantity=1,product=product_name,seller=seller['seller_id']['peer_id'],buyer=buyer_id['peer_id'],ts=request_ts)
             
-            connected, proxy = self.get_rpc(self.db_server)
-            if connected: # Contact DB Server for the transaction to complete.
-                proxy.transaction(product_name,seller)
 
             # Reply to buyer that transaction is succesful. 
             connected,proxy = self.get_rpc(buyer_id["host_addr"])
             if connected: # Pass the message to buyer that transaction is succesful
-                proxy.transaction(product_name,seller['seller_id'],buyer_id,self.peer_id)
+                proxy.transaction(product_name,seller['seller_id'],buyer_id,self.peer_id,1,key,request_ts)
                 
             connected,proxy = self.get_rpc(seller['seller_id']["host_addr"])
             if connected:# Pass the message to seller that its product is sold
-                proxy.transaction(product_name,seller['seller_id'],buyer_id,self.peer_id)
+                proxy.transaction(product_name,seller['seller_id'],buyer_id,self.peer_id,1,key,request_ts)
              
-            # Relog the request as done
-            data_ops.mark_transaction_complete(transaction_file_name,transaction_log,str(buyer_clock))
+            # The DB Server gets the sale from the write-behind cache, the request is relogged as done once it has it.
+            self.tracer.detach(key,'complete')
+            self.db_cache.sold(key,seller,product_name,1)
+        return len(fills)
+
+    # lookup_batch : Trader matches a buyer's whole shopping list in one pass over the order book.
+    # requests is a list of [product_name, quantity, buyer_clock]. The buyer and every seller involved
+    # get a single transaction_batch notification. Returns the number of units filled per request.
+    def lookup_batch(self,buyer_id,requests):
+        if self.db_cache.full():
+            self.metrics.incr('db_full')
+            return BUSY
+        transaction_file_name = self.journal_file(self.peer_id)
+        journal = data_ops.get_journal(transaction_file_name)
+        with self.tracer.span('match'):
+            reservations = self.order_book.reserve_batch([(product_name,quantity) for product_name,quantity,_ in requests])
+        matches = [reservation.fills for reservation in reservations]
+        matched = sum(1 for fills in matches if fills)
+        self.metrics.incr('lookups',len(requests))
+        self.metrics.incr('matched',matched)
+        self.metrics.incr('unmatched',len(requests) - matched)
+
+        self.clock_semaphore.acquire()
+        for _,_,buyer_clock in requests:
+            self.lamport_clock.adjust(buyer_clock)
+        trades = [] # (request_ts, product_name, seller_info, units)
+        for (product_name,_,_),fills in zip(requests,matches):
+            for seller,units in fills:
+                trades.append((self.lamport_clock.forward(),product_name,seller,units))
+        self.clock_semaphore.release()
+        if len(trades) == 0:
+            return [0 for _ in requests]
+
+        try:
+            with self.tracer.span('journal'):
+                for request_ts,product_name,seller,units in trades: # Log the requests, one group commit for the batch.
+                    tx = {'product_name':product_name,'buyer_id':buyer_id,'seller_id':seller['seller_id'],'quantity':units}
+                    if self.vector_clock is not None:
+                        tx['vclock'] = self.vector_clock.tick()
+                    journal.log_opened(request_ts,tx,durable=False)
+                journal.flush()
+        except Exception:
+            for reservation in reservations: # Not sold, the units go back to the sellers' offers.
+                self.order_book.release(reservation)
+            raise
+        for reservation in reservations:
+            self.order_book.commit(reservation)
+        for seller in {id(seller): seller for _,_,seller,_ in trades}.values():
+            self.replication.publish(seller)
+
+
+        purchases = []
+        sales = {} # seller host_addr -> sold items
+        for request_ts,product_name,seller,units in trades:
+            self.events.log('trade',quantity=units,product=product_name,seller=seller['seller_id']['peer_id'],buyer=buyer_id['peer_id'],ts=request_ts)
+            item = {'product_name':product_name,'seller_id':seller['seller_id'],'buyer_id':buyer_id,'quantity':units,
+                    'key':"{}:{}".format(self.peer_id,request_ts),'clock':request_ts}
+            purchases.append(item)
+            sales.setdefault(seller['seller_id']['host_addr'],[]).append(item)
+
+        connected,proxy = self.get_rpc(buyer_id["host_addr"])
+        if connected: # One message to the buyer for all its purchases.
+            proxy.transaction_batch(purchases,self.peer_id)
+        for host_addr,items in sales.items():
+            connected,proxy = self.get_rpc(host_addr)
+            if connected: # One message per seller for all its sold items.
+                proxy.transaction_batch(items,self.peer_id)
+
+        # The DB Server gets the sales from the write-behind cache, the requests are relogged as done once it has them.
+        for request_ts,product_name,seller,units in trades:
+            self.tracer.detach("{}:{}".format(self.peer_id,request_ts),'complete')
+            self.db_cache.sold("{}:{}".format(self.peer_id,request_ts),seller,product_name,units)
+        return [sum(units for _,units in fills) for fills in matches]
+
+    # transaction_batch : Buyer & Seller apply the items of a coalesced notification from lookup_batch or a recovery.
+    def transaction_batch(self,items,trader_peer_id):
+        for item in items:
+            self.transaction(item['product_name'],item['seller_id'],item['buyer_id'],trader_peer_id,item['quantity'],item.get('key'),item.get('clock'))
 
-    # transaction : Seller just deducts the product count, Buyer logging.infos the message.    
-    def transaction(self, product_name, seller_id, buyer_id,trader_peer_id): # Buyer & Seller
+    # transaction : Seller just deducts the product count, Buyer logs the purchase.
+    # A trade with an idempotency key that has already been applied is ignored. The clock of the trade,
+    # piggybacked on the notification, adjusts the clock of the peer.
+    def transaction(self, product_name, seller_id, buyer_id,trader_peer_id,quantity=1,key=None,clock=None): # Buyer & Seller
+        if clock is not None:
+            self.adjust_buyer_clock(clock)
+        if key is not None and not self.first_time(key):
+            return
         if self.db["Role"] == "Buyer":
-            logging.info("[{}][Peer {}] has purchased {} from Peer {} through {}".format(datetime.datetime.now(),self.peer_id, product_name, seller_id["peer_id"], trader_peer_id))
-            self.shipment_count += 1
+            self.events.log('purchase',quantity=quantity,product=product_name,seller=seller_id['peer_id'],trader=trader_peer_id)
+            self.inventory_semaphore.acquire()
+            self.shipment_count += quantity
+            self.inventory_semaphore.release()
         elif self.db["Role"] == "Seller":
-            self.db['Inv'][product_name] = self.db['Inv'][product_name] - 1  
-            if self.db['Inv'][product_name] == 0:
-                # Pickup a random item and register that product with trader.
+            # The count and the restock change together, the restock is queued for the traders (see send_restocks).
+            self.inventory_semaphore.acquire()
+            self.db['Inv'][product_name] = self.db['Inv'][product_name] - quantity  
+            restock = None
+            if self.db['Inv'][product_name] <= 0:
+                # Pickup a random item and add units of it.
                 product_list = ['Fish','Salt','Boar']
                 y = random.randint(0, 2)
                 random_product = product_list[y]
-                self.db['Inv'][random_product] = 3
-                seller_info = {'seller_id': {'peer_id':self.peer_id,'host_addr':self.host_addr},'product_name':random_product,'product_count':3}
-                connected,proxy = self.get_active_trader() 
-                if connected: 
-                    proxy.register_products(seller_info)
+                self.db['Inv'][random_product] = self.db['Inv'].get(random_product,0) + self.restock_units
+                self.restock_seq += 1
+                restock = {'product_name':random_product,'units':self.restock_units,'key':"{}:restock:{}".format(self.peer_id,self.restock_seq)}
+                self.offers.setdefault(random_product,{'seller_id':{'peer_id':self.peer_id,'host_addr':self.host_addr},'product_name':random_product,'product_count':0})
+                self.metrics.incr('restocks')
+            self.inventory_semaphore.release()
+            if restock is not None:
+                self.restocks.add(restock)
+
+    # send_restocks : Seller sends a batch of restocks, one restock RPC per trader in charge of the products.
+    # True once every trader has them; otherwise the batch is sent again, the traders apply each delta once.
+    def send_restocks(self,deltas):
+        seller_id = {'peer_id':self.peer_id,'host_addr':self.host_addr}
+        shards = {} # trader host_addr -> deltas
+        for delta in deltas:
+            trader = self.get_trader(delta['product_name'],self.peer_id)
+            if trader is None:
+                return False
+            shards.setdefault(trader['host_addr'],[]).append(delta)
+        for host_addr,shard_deltas in shards.items():
+            connected,proxy = self.get_rpc(host_addr)
+            if not connected or proxy.restock(seller_id,shard_deltas) is None:
+                return False
+        self.metrics.incr('restock_batches',len(shards))
+        return True
+
+    # first_time : True the first time an idempotency key is seen (see recovery.py), the trade or the restock is applied then.
+    def first_time(self,key):
+        self.idempotency_semaphore.acquire()
+        applied = key in self.applied_keys
+        self.applied_keys[key] = True
+        if len(self.applied_keys) > self.max_applied_keys:
+            self.applied_keys.popitem(last=False)
+        self.idempotency_semaphore.release()
+        return not applied
                     
-    # Sync Cache
-    def sync_cache(self,seller_info):
-        print("Syncing Cache")
+    # replication_targets : The other traders up, a trader replicates its sellers to them.
+    def replication_targets(self):
+        if self.db['Role'] != 'Trader':
+            return []
+        return [trader['host_addr'] for trader in self.active_traders() if trader['peer_id'] != self.peer_id]
+
+    def send_replication(self,host_addr,deltas):
+        connected,proxy = self.get_rpc(host_addr)
+        if not connected:
+            return None
+        try:
+            return proxy.replicate(self.peer_id,deltas)
+        except xmlrpc.client.Fault:
+            return None
+
+    # replicate : Trader applies the deltas of the sellers of another trader. Returns the sellers with a gap.
+    def replicate(self,trader_peer_id,deltas):
+        self.clock_semaphore.acquire()
+        for delta in deltas: # Later changes of this trader are stamped after the ones it has seen.
+            self.lamport_clock.adjust(delta['ts'])
+        self.clock_semaphore.release()
+        return self.replication.receive(deltas)
+
+    # seller_moved : Another trader has taken over an offer, stop selling its units here.
+    def seller_moved(self,key):
         self.trade_list_semaphore.acquire()
-        seller_peer_id = seller_info['seller_id']['peer_id']
-        self.trade_list[str(seller_peer_id)] = seller_info 
-        self.trade_list_semaphore.release()   
-        
-    def create(self):
-        #"create looping call to send ping request"
-        thr = td.Thread(target=self.periodic_ping_timer) # thread for the heartbeat protocol.
-        return thr
-        
-    # Heart Beat Protocol.
-    def periodic_ping_timer(self):
-        other_trader = [trader for trader in self.trader if not trader['peer_id'] == self.peer_id][0]
-        stop_condition = False # Intial Stop condition.
-        while(stop_condition == False):
-            self.heartbeat_reply = False # Set the reply flag as false
-            connected,proxy = self.get_rpc(other_trader["host_addr"])
-            if connected:
-                proxy.periodic_ping_message({'peer_id':self.peer_id,'host_addr':self.host_addr,'status':1})            
-            time.sleep(2.0)  # Time-out.
-            self.heartbeat_reply_semaphore.acquire()
-            if not self.heartbeat_reply: # Check whether the reply is received.
-                self.heartbeat_reply_semaphore.release()
-                stop_condition = True
-            else:
-                self.heartbeat_reply_semaphore.release()
-                time.sleep(5.0)
-                
-        for neighbor in self.neighbors:# Trader is down. Broadcast to all the peers.
-            connected,proxy = self.get_rpc(neighbor['host_addr'])
-            if connected:
-                proxy.trader_status_update(False,other_trader) # Trader is down.
-                
-        # Read the log of other trader and return un resolved requests.
-        file_name = "transactions_" + str(other_trader['peer_id']) + ".csv"
-        if os.path.isfile(file_name):
-            unserved_requests = data_ops.get_unserved_requests(file_name)
-            if unserved_requests is None:
-                print("None")
-                pass
-            else:
-                for unserved_request in unserved_requests:
-                    k,v  = list(unserved_request.items())[0]
-                    self.lookup(v['buyer_id'],v['product_name'],int(k))    
-                         
-    def trader_status_update(self,status,trader):
+        seller_info = self.trade_list.pop(key,None)
+        if seller_info is not None:
+            self.order_book.remove(seller_info)
+        self.trade_list_semaphore.release()
+
+    # adopt_sellers : Trader takes over the replicated offers of a failed trader whose products are now its own.
+    def adopt_sellers(self,trader):
+        adopted = 0
+        for key in self.replication.replicas_of(trader['peer_id']):
+            replica = self.replication.replicas.get(key)
+            if replica is None:
+                continue
+            owner = self.get_trader(replica['seller_info']['product_name'],replica['seller_info']['seller_id']['peer_id'])
+            if owner is None or owner['peer_id'] != self.peer_id:
+                continue
+            self.trade_list_semaphore.acquire()
+            seller_info = self.replication.adopt(key)
+            if seller_info is not None:
+                self.trade_list[key] = seller_info
+                self.order_book.upsert(seller_info)
+                adopted += 1
+            self.trade_list_semaphore.release()
+            if seller_info is not None:
+                self.db_cache.offer(dict(seller_info))
+        logging.info("[Peer {}]: Took over {} offers of trader {}".format(self.peer_id,adopted,trader['peer_id']))
+
+    # release_offers : Trader drops the offers of the products that are now another trader's, their sellers
+    # register them with it. Kept here, they would be replicated to it as newer than its own, see replication.py.
+    def release_offers(self):
+        if self.db['Role'] != 'Trader':
+            return
+        self.trade_list_semaphore.acquire()
+        offers = list(self.trade_list.items())
+        self.trade_list_semaphore.release()
+        for key,seller_info in offers:
+            owner = self.get_trader(seller_info['product_name'],seller_info['seller_id']['peer_id'])
+            if owner is None or owner['peer_id'] == self.peer_id:
+                continue
+            self.trade_list_semaphore.acquire()
+            if self.trade_list.get(key) is seller_info:
+                del self.trade_list[key]
+                self.order_book.remove(seller_info)
+                self.replication.disown(key)
+            self.trade_list_semaphore.release()
+
+    # replication_stats : Replication lag and volume of a trader.
+    def replication_stats(self):
+        return self.replication.stats()
+
+    # Failure detection. Every peer watches the traders, the traders also watch each other.
+    def monitored_traders(self):
+        return [trader for trader in self.trader if trader['peer_id'] != self.peer_id]
+
+    # heartbeat_targets : A trader sends its heartbeats to every peer.
+    def heartbeat_targets(self):
+        if self.db['Role'] != 'Trader':
+            return []
+        return [neighbor['host_addr'] for neighbor in self.neighbors]
+
+    # trader_suspected : Called by the failure detector. The peer stops routing to the trader at once;
+    # the next trader by peer id also tells the others and serves the unfinished requests of the log.
+    def trader_suspected(self,trader):
+        start = time.monotonic()
+        self.trader_status_update(False,trader)
+        self.reroute_latencies.append(time.monotonic() - start)
+        successor = self.successor(trader)
+        if successor is not None and successor['peer_id'] == self.peer_id:
+            self.multicast(self.neighbors,'trader_status_update',False,trader) # For the peers that have not noticed yet.
+            self.spawn(self.recover_trader,trader)
+
+    # trader_heard : Called by the failure detector for a heartbeat of a peer that is not a known trader. Only the
+    # traders send heartbeats, so this peer missed its "I won" and takes it as one.
+    def trader_heard(self,host_addr):
+        if any(trader['host_addr'] == host_addr for trader in self.trader):
+            return # Known, its detector is not set up yet.
+        neighbor = next((neighbor for neighbor in self.neighbors if neighbor['host_addr'] == host_addr),None)
+        if neighbor is not None:
+            self.spawn(self.election_message,"I won",{'peer_id':neighbor['peer_id'],'host_addr':host_addr,'status':1})
+
+    # trader_recovered : Called by the failure detector when a suspected trader shows signs of life again.
+    def trader_recovered(self,trader):
+        if trader['peer_id'] in self.retired: # Still answers as a buyer or seller.
+            return
+        self.trader_status_update(True,trader)
+
+    # check_surplus : Trader: a suspected trader that comes back after its replacement was elected makes one
+    # trader too many. The traders up beyond "Traders", the lowest peer ids as in the bully election, step down.
+    def check_surplus(self):
+        if self.db['Role'] != 'Trader':
+            return
+        self.semaphore.acquire()
+        kept = sorted(trader['peer_id'] for trader in self.active_traders())[-self.num_traders:]
+        self.semaphore.release()
+        if self.peer_id not in kept:
+            self.spawn(self.step_down)
+
+    # step_down : The trader drops its offers, they are served by the traders now in charge, and retires: the
+    # others take it as down without electing a replacement, and it does not run for election again.
+    def step_down(self):
+        self.semaphore.acquire()
+        retire = self.db['Role'] == 'Trader' and self.peer_id in self.shards
+        if retire:
+            for known in self.trader:
+                if known['peer_id'] == self.peer_id:
+                    known['status'] = False
+            self.shards.remove(self.peer_id)
+            self.empty_traders = {}
+        self.semaphore.release()
+        if not retire:
+            return
+        self.release_offers()
+        self.db['Role'] = 'Retired'
+        self.multicast(self.neighbors,'trader_status_update',False,self.peer_info(),False)
+        self.events.log('stepped_down')
+
+    # successor : The first trader up after the given one, in peer id order.
+    def successor(self,trader):
+        traders = sorted(self.trader,key=lambda known: known['peer_id'])
+        position = [known['peer_id'] for known in traders].index(trader['peer_id'])
+        for candidate in traders[position + 1:] + traders[:position]:
+            if candidate['status']:
+                return candidate
+        return None
+
+    # recover_trader : Serve again the unresolved requests of a failed trader's log, see recovery.py.
+    # The replayed trades are logged in this trader's own journal, with their keys, first, so a failure
+    # during the recovery is recovered in turn.
+    def recover_trader(self,trader):
+        file_name = self.journal_file(trader['peer_id'])
+        if not os.path.isfile(file_name):
+            return
+        start = time.perf_counter()
+        trades = recovery.pending_trades(file_name,trader['peer_id'])
+        journal = data_ops.get_journal(self.journal_file(self.peer_id))
+        self.clock_semaphore.acquire()
+        replay_ts = []
+        for ts,_,_ in trades:
+            self.lamport_clock.adjust(ts)
+            replay_ts.append(self.lamport_clock.forward())
+        self.clock_semaphore.release()
+        for request_ts,(_,key,tx) in zip(replay_ts,trades):
+            journal.log_opened(request_ts,dict(tx,key=key),durable=False)
+        journal.flush()
+        recovery.replay(trades,self.deliver_replay,self.db.get('RecoveryWorkers',16),extra_hosts=(self.db_server,))
+        for request_ts in replay_ts:
+            journal.log_completed(request_ts)
+        elapsed = time.perf_counter() - start
+        self.recoveries.append((len(trades),elapsed))
+        logging.info("Recovered {} unserved requests of trader {} in {:.3f}s".format(len(trades),trader['peer_id'],elapsed))
+
+    # deliver_replay : Send replayed trades to a buyer, a seller or the DB server.
+    def deliver_replay(self,host_addr,items):
+        connected,proxy = self.get_rpc(host_addr)
+        if connected:
+            proxy.transaction_batch(items,self.peer_id)
+
+    # failover_stats : Failure detector and rerouting metrics of the peer.
+    def failover_stats(self):
+        stats = self.failure_detector.stats()
+        stats['reroute_latency_max'] = max(self.reroute_latencies) if self.reroute_latencies else None
+        stats['recovered_requests'] = sum(count for count,_ in self.recoveries)
+        stats['recovery_seconds_last'] = self.recoveries[-1][1] if self.recoveries else None
+        return stats
+
+    # load_stats : Load generation metrics of the peer, the launcher aggregates them over the cluster.
+    def load_stats(self):
+        return {
+            'role': self.db['Role'],
+            'traders': [trader['peer_id'] for trader in self.active_traders()],
+            'requests': self.requests_sent,
+            'shipments': self.shipment_count,
+            'lookups': self.metrics.counters.get('lookups',0), # Trader: requests it has looked up.
+            'latency': self.metrics.histogram('request').export(),
+        }
+
+    # push_updates : Send a batch of the write-behind cache to the DB server. True once the DB has it.
+    def push_updates(self,updates):
+        connected,proxy = self.get_rpc(self.db_server)
+        if not connected:
+            return False
+        return proxy.apply_updates(updates,self.peer_info()) is not None
+
+    # updates_flushed : The DB Server has these updates, the sales in them are completed.
+    def updates_flushed(self,updates):
+        journal = data_ops.get_journal(self.journal_file(self.peer_id))
+        for update in updates:
+            if update['op'] == 'sold':
+                journal.log_completed(update['key'].split(':')[1])
+                self.tracer.finish(update['key'])
+
+    def cache_check_loop(self):
+        while True:
+            time.sleep(self.cache_check_interval)
+            self.check_cache()
+
+    # check_cache : Trader compares its trade_list with the DB once the pending updates are flushed.
+    # A seller that has registered with the other trader since is dropped from the cache. A count that
+    # differs from the DB twice in a row, with no sale in between, was lost on the way and is sent again.
+    def check_cache(self):
+        if not self.db_cache.flush():
+            return
+        self.trade_list_semaphore.acquire()
+        cache = {key: [seller_info['product_name'],seller_info['product_count']] for key,seller_info in self.trade_list.items()}
+        self.trade_list_semaphore.release()
+        connected,proxy = self.get_rpc(self.db_server)
+        if not connected:
+            return
+        report = proxy.check_cache(self.peer_info(),cache)
+        if report is None:
+            return
+        for key in report['stale']:
+            self.trade_list_semaphore.acquire()
+            seller_info = self.trade_list.pop(key,None)
+            if seller_info is not None:
+                self.order_book.remove(seller_info)
+            self.trade_list_semaphore.release()
+            self.replication.disown(key)
+            self.cache_stale += 1
+            logging.warning("[Peer {}]: Offer {} has moved to another trader, dropped from the cache".format(self.peer_id,key))
+        mismatches = {}
+        for key in report['mismatched']:
+            product_name,product_count = cache[key]
+            if self.cache_mismatches.get(key) != cache[key]:
+                mismatches[key] = cache[key] # Maybe a sale made during the check, look again next time.
+                continue
+            self.db_cache.add({'op':'count','seller_peer_id':int(key.split(':')[0]),'product_name':product_name,'product_count':product_count})
+            self.cache_repairs += 1
+            logging.warning("[Peer {}]: DB count of offer {} differs from the cache, repaired".format(self.peer_id,key))
+        self.cache_mismatches = mismatches
+
+    # cache_stats : Write-behind cache and consistency check metrics of a trader.
+    def cache_stats(self):
+        stats = self.db_cache.stats()
+        stats['repairs'] = self.cache_repairs
+        stats['stale'] = self.cache_stale
+        return stats
+
+    # trader_status_update : A trader went down or came back. Its products are rebalanced over the
+    # traders that are up, and a seller whose product changed hands registers its offer with the new owner.
+    def trader_status_update(self,status,trader,elect=True):
+        if trader['peer_id'] == self.peer_id: # A trader suspected by mistake goes on, the others will hear from it again.
+            return
+        if not status and elect:
+            self.failure_detector.down(trader['host_addr']) # Also when another peer found it, so its heartbeats bring it back.
+        elif not status:
+            self.retired.add(trader['peer_id'])
+        owners = self.offer_owners()
         self.semaphore.acquire()
         for x in range(len(self.trader)):
             if self.trader[x]['peer_id'] == trader['peer_id']:
-                self.trader[x]['status'] = False # Update the status of the trader as false.
+                self.trader[x]['status'] = status # Update the status of the trader.
+                if status:
+                    self.shards.add(self.trader[x])
+                else:
+                    self.shards.remove(trader['peer_id'])
+        self.empty_traders = {} # The offers move with the sub-shards.
         self.semaphore.release()
         logging.info("Status of {} is {}".format(trader['peer_id'],status))
+        if not status and self.db['Role'] == 'Trader':
+            self.adopt_sellers(trader)
+        elif status:
+            self.release_offers()
+        self.reregister_offers(owners)
+        if not status and elect and self.db['Role'] != 'Trader': # Elect a replacement.
+            self.spawn(self.start_election)
+        elif status:
+            self.check_surplus()
+
+    # offer_owners : Seller: the trader in charge of each of its offers, by product.
+    def offer_owners(self):
+        if self.db["Role"] != "Seller":
+            return {}
+        return {product_name: self.get_trader(product_name,self.peer_id) for product_name in list(self.offers)}
+
+    # reregister_offers : Seller: register the offers whose owner changed with their new owner.
+    def reregister_offers(self,owners):
+        for product_name,owner in owners.items():
+            if owner is None or self.get_trader(product_name,self.peer_id) == owner:
+                continue
+            self.inventory_semaphore.acquire()
+            offer = self.offers[product_name]
+            offer['product_count'] = self.db['Inv'].get(product_name,0) # Units left, not the units first offered.
+            offer = dict(offer)
+            self.inventory_semaphore.release()
+            connected,proxy = self.get_active_trader(product_name,self.peer_id)
+            if connected:
+                proxy.register_products(offer)
 
-    # Helper Method: Sends the ping to the other trader.                        
+    # periodic_ping_message : The trader ping of the peers of earlier versions, kept for the mixed clusters.
+    # The failure detector's heartbeats replaced it: the ping is answered, nothing is kept of it.
     def periodic_ping_message(self,trader_info):
         connected,proxy = self.get_rpc(trader_info["host_addr"])
         if connected:
-            proxy.periodic_ping_reply({'peer_id':self.peer_id,'host_addr':self.host_addr,'status':1})
-        
+            proxy.periodic_ping_reply(self.peer_info())
+
+    # periodic_ping_reply : The answer to a ping, a sign of life of the trader like any other RPC.
     def periodic_ping_reply(self,trader_info):
-        self.heartbeat_reply_semaphore.acquire()
-        self.heartbeat_reply = True # Heartbeat reply
-        self.heartbeat_reply_semaphore.release()
-        
+        self.failure_detector.heartbeat(trader_info['host_addr'])
+
+
 if __name__ == "__main__":
+    # market.py <peer_id> <port> <db> <num_peers> [<roles> [<base_port>]]
+    # The peers are numbered 1..num_peers on ports base_port (20090) and up, roles is the JSON list of
+    # their roles in that order. launcher.py starts whole clusters this way.
     host_ip = socket.gethostbyname(socket.gethostname())
     host_addr = host_ip + ":" + sys.argv[2]
     peer_id = int(sys.argv[1])
     db = json.loads(sys.argv[3])
     num_peers = int(sys.argv[4])
+    roles = json.loads(sys.argv[5]) if len(sys.argv) > 5 else [None] * num_peers # Unknown without the list.
+    base_port = int(sys.argv[6]) if len(sys.argv) > 6 else 20090
+    configure_logging(db.get('LogLevel','INFO')) # Written by a thread of its own, "DEBUG" for every message.
+    logging.info("Starting Bazaar")
 
     # Computing the neigbors and updating the db.
     peer_ids = [x for x in range(1,num_peers+1)]
-    roles = [db["Role"] for x in range(1,num_peers+1)]
-    host_ports = [(20090 + x) for x in range(0,num_peers)]
+    host_ports = [(base_port + x) for x in range(0,num_peers)]
     host_addrs = [(host_ip + ':' + str(port)) for port in host_ports]
-    neighbors = [{'peer_id':p,'host_addr':h,'role':g} for p,h,g in zip(peer_ids,host_addrs, roles)]
-    # print("the neighbors are {}".format(neighbors))
-    neighbors.remove({'peer_id':peer_id,'host_addr':host_addr, 'role': db['Role']})
+    neighbors = [{'peer_id':p,'host_addr':h,'role':g} for p,h,g in zip(peer_ids,host_addrs, roles) if p != peer_id]
 
     # Initializing the peer and starting the peer.
-    peer_local = peer(host_addr,peer_id,neighbors,db)
+    if db.get('Runtime') == 'asyncio':
+        from async_runtime import AsyncPeer
+        peer_local = AsyncPeer(host_addr,peer_id,neighbors,db)
+    else:
+        peer_local = peer(host_addr,peer_id,neighbors,db)
     thread1 = td.Thread(target=peer_local.startServer,args=()) # Start Server
     thread1.start()    
     # Initiating the election.
     if peer_id <= 2:
         thread1 = td.Thread(target=peer_local.start_election,args=()) # Start Server
         thread1.start()
-
@@ -0,0 +1,142 @@
+import math
+import json
+import time
+import logging
+import threading as td
+
+# Instrumentation of a peer: latency histograms, counters and gauges.
+# The peer serves a snapshot with the "stats" RPC, and as JSON on GET /stats of its XML-RPC port, and
+# writes one every "MetricsInterval" seconds, to the log or as a JSON line to "MetricsFile".
+# Histograms have log-scale buckets, SUB_BUCKETS per power of two from MIN_VALUE up, so a percentile
+# is within 9% of the exact value. Recording is a log2 and a dict increment under a lock, cheap
+# enough for every RPC. Gauges are functions, called only when a snapshot is taken.
+
+
+# Histogram : Distribution of a duration in seconds, or of any positive value.
+class Histogram:
+    SUB_BUCKETS = 8
+    MIN_VALUE = 1e-6
+
+    def __init__(self):
+        self.lock = td.Lock()
+        self.counts = {} # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        index = 0 if value <= self.MIN_VALUE else int(math.log2(value / self.MIN_VALUE) * self.SUB_BUCKETS) + 1
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    # percentile : Upper bound of the bucket holding the q-th value, 0 <= q <= 1. None if empty.
+    def percentile(self, q):
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = max(math.ceil(q * self.count), 1)
+            seen = 0
+            for index in sorted(self.counts):
+                seen += self.counts[index]
+                if seen >= rank:
+                    return min(self.MIN_VALUE * 2 ** (index / self.SUB_BUCKETS), self.max)
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(0.50),
+            'p90': self.percentile(0.90),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+    # export : The whole histogram, for merge() in another process. Keys are strings for XML-RPC.
+    def export(self):
+        with self.lock:
+            return {'counts': {str(index): count for index, count in self.counts.items()},
+                    'count': self.count, 'sum': self.total, 'max': self.max}
+
+    def merge(self, exported):
+        with self.lock:
+            for index, count in exported['counts'].items():
+                self.counts[int(index)] = self.counts.get(int(index), 0) + count
+            self.count += exported['count']
+            self.total += exported['sum']
+            self.max = max(self.max, exported['max'])
+
+
+# Metrics : The histograms, counters and gauges of a peer, by name. source identifies the peer in the snapshots.
+class Metrics:
+    def __init__(self, source=None):
+        self.source = source
+        self.lock = td.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.reporter = None
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    # gauge : function() is the current value, a number or a dict of numbers.
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    # timed : function, with the duration of every call recorded in the histogram `name`.
+    def timed(self, name, function):
+        histogram = self.histogram(name)
+        def timed_function(*args):
+            start = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                histogram.record(time.perf_counter() - start)
+        return timed_function
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        gauges = {}
+        for name, function in list(self.gauges.items()):
+            try:
+                gauges[name] = function()
+            except Exception as e: # A broken gauge must not hide the others.
+                gauges[name] = None
+                logging.debug("Gauge {} failed: {}".format(name, e))
+        return {
+            'source': self.source,
+            'time': time.time(),
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': {name: histogram.snapshot() for name, histogram in histograms.items() if histogram.count},
+        }
+
+    # start_reporting : Write a snapshot every `interval` seconds, to `filename` as JSON lines or to the log.
+    def start_reporting(self, interval, filename=None):
+        if self.reporter is None and interval:
+            self.reporter = td.Thread(target=self.report_loop, args=(interval, filename), daemon=True)
+            self.reporter.start()
+
+    def report_loop(self, interval, filename):
+        while True:
+            time.sleep(interval)
+            line = json.dumps(self.snapshot(), separators=(',', ':'))
+            if filename is None:
+                logging.info("Metrics: " + line)
+            else:
+                with open(filename, 'a') as f:
+                    f.write(line + '\n')
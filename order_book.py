@@ -0,0 +1,191 @@
+import heapq
+import itertools
+import threading as td
+from collections import OrderedDict
+
+
+# offer_key : Key of an offer, "<seller peer_id>:<product_name>". A seller has an offer per product it
+# sells, each with the trader in charge of the product; the key is the same in trade_list, in the
+# replicas of the other traders and in the DB.
+def offer_key(seller_info):
+    return "{}:{}".format(seller_info['seller_id']['peer_id'], seller_info['product_name'])
+
+
+# OrderBook : The trader's index of seller offers, one queue per product.
+# Every offer is the seller_info dict that the trader also keeps in trade_list, so
+# decrementing 'product_count' here keeps both views in sync. An order for several units is
+# filled from as many offers as it takes.
+# Two priorities are supported:
+# 1) "fifo": Sellers are served in the order they registered. The queue is an OrderedDict so
+#    the head, an insert and a removal are all O(1).
+# 2) "price": Price-time priority. The queue is a heap of (price, seq, key) with lazy deletion,
+#    so a match and an insert are O(log n).
+# Locking: every product has its own queue and lock, so the lookups of different products do not
+# wait for each other. The book's lock only guards the index of the queues and of the offers, it is
+# taken by the registrations (upsert, remove), always before a product lock and never after one.
+# A match is a reservation: the units leave the offer at once, so no other buyer can take them,
+# and are then either committed, once the trade is logged, or released back to the offer.
+class OrderBook:
+    def __init__(self, priority="fifo"):
+        if priority not in ("fifo", "price"):
+            raise ValueError("Unknown order book priority: {}".format(priority))
+        self.priority = priority
+        self.queues = {}  # product_name -> ProductQueue
+        self.keys = {}    # key -> product_name of the offer, left as is when the offer sells out
+        self.seq = itertools.count()
+        self.lock = td.Lock()
+
+    offer_key = staticmethod(offer_key)
+
+    def __len__(self):
+        return sum(len(queue.offers) for queue in list(self.queues.values()))
+
+    # Queue of a product, created under the book's lock.
+    def _queue(self, product_name):
+        queue = self.queues.get(product_name)
+        if queue is None:
+            queue = self.queues[product_name] = ProductQueue(self.priority)
+        return queue
+
+    # upsert : Add an offer, or replace the one the seller already has for the product.
+    # The offer goes to the back of the queue as it is a new registration.
+    def upsert(self, seller_info):
+        key = self.offer_key(seller_info)
+        with self.lock:
+            self._remove(key)
+            if seller_info.get('product_name') is None or seller_info.get('product_count', 0) <= 0:
+                return
+            product_name = seller_info['product_name']
+            self.keys[key] = product_name
+            queue = self._queue(product_name)
+            with queue.lock:
+                queue.add(key, next(self.seq), seller_info)
+
+    # remove : Drop an offer, if it is in the book.
+    def remove(self, seller_info):
+        with self.lock:
+            self._remove(self.offer_key(seller_info))
+
+    def _remove(self, key):
+        product_name = self.keys.pop(key, None)
+        if product_name is None:
+            return
+        queue = self.queues[product_name]
+        with queue.lock:
+            queue.remove(key)
+
+    # reserve : Take up to quantity units of a product from the best offers.
+    # Returns a Reservation, with no fills if nobody sells the product. Sellers whose count reaches
+    # zero leave the book. The reservation must be committed or released.
+    def reserve(self, product_name, quantity=1):
+        queue = self.queues.get(product_name)
+        if queue is None:
+            return Reservation(product_name, [])
+        with queue.lock:
+            fills = queue.take(quantity)
+            queue.reserved += sum(units for _, units in fills)
+        return Reservation(product_name, fills)
+
+    # reserve_batch : Reserve a list of (product_name, quantity) orders, one Reservation per order.
+    def reserve_batch(self, orders):
+        return [self.reserve(product_name, quantity) for product_name, quantity in orders]
+
+    # commit : The units of the reservation are sold.
+    def commit(self, reservation):
+        queue = self.queues.get(reservation.product_name)
+        if queue is None or not reservation.fills:
+            return
+        with queue.lock:
+            queue.reserved -= reservation.units()
+
+    # release : The trade did not happen, the units go back to their offers. An offer that sold out
+    # is queued again, at the back, unless it has been removed from the book since.
+    def release(self, reservation):
+        queue = self.queues.get(reservation.product_name)
+        if queue is None or not reservation.fills:
+            return
+        with queue.lock:
+            queue.reserved -= reservation.units()
+            for seller_info, units in reservation.fills:
+                self._add_units(queue, seller_info, units)
+
+    # restock : Add units to an offer, queued again at the back if it had sold out, or added to the book.
+    def restock(self, seller_info, units):
+        key = self.offer_key(seller_info)
+        with self.lock:
+            self.keys[key] = seller_info['product_name']
+            queue = self._queue(seller_info['product_name'])
+            with queue.lock:
+                self._add_units(queue, seller_info, units)
+
+    # Product lock must be held.
+    def _add_units(self, queue, seller_info, units):
+        key = self.offer_key(seller_info)
+        seller_info['product_count'] += units
+        if key not in queue.offers and self.keys.get(key) == seller_info['product_name'] and seller_info['product_count'] > 0:
+            queue.add(key, next(self.seq), seller_info)
+
+    # reserved : Number of units reserved and neither committed nor released yet.
+    def reserved(self):
+        return sum(queue.reserved for queue in list(self.queues.values()))
+
+
+# Reservation : Units taken from the book for one order, as a list of (seller_info, units) fills.
+class Reservation:
+    def __init__(self, product_name, fills):
+        self.product_name = product_name
+        self.fills = fills
+
+    def units(self):
+        return sum(units for _, units in self.fills)
+
+
+# ProductQueue : The offers of one product, guarded by its lock.
+class ProductQueue:
+    def __init__(self, priority):
+        self.priority = priority
+        self.lock = td.Lock()
+        self.queue = OrderedDict() if priority == "fifo" else [] # fifo: key -> seller_info, price: heap
+        self.offers = {}  # key -> (seq, seller_info)
+        self.reserved = 0 # Units reserved, not committed or released yet.
+
+    def add(self, key, seq, seller_info):
+        self.offers[key] = (seq, seller_info)
+        if self.priority == "fifo":
+            self.queue[key] = seller_info
+        else:
+            heapq.heappush(self.queue, (seller_info.get('price', 0), seq, key))
+
+    def remove(self, key):
+        if self.offers.pop(key, None) is not None and self.priority == "fifo":
+            self.queue.pop(key, None)
+        # Price queues are cleaned lazily in head.
+
+    # Return the key and seller_info of the best offer, or None.
+    def head(self):
+        if self.priority == "fifo":
+            if not self.queue:
+                return None
+            return next(iter(self.queue.items()))
+        while self.queue:
+            _, seq, key = self.queue[0]
+            entry = self.offers.get(key)
+            if entry is not None and entry[0] == seq:
+                return key, entry[1]
+            heapq.heappop(self.queue)  # Stale entry of a replaced or removed offer.
+        return None
+
+    def take(self, quantity):
+        fills = []
+        while quantity > 0:
+            head = self.head()
+            if head is None:
+                break
+            key, seller_info = head
+            units = min(quantity, seller_info['product_count'])
+            seller_info['product_count'] -= units
+            quantity -= units
+            fills.append((seller_info, units))
+            if seller_info['product_count'] <= 0:
+                self.remove(key)
+        return fills
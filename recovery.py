@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+import data_ops
+
+# Recovery of the unserved requests of a failed trader.
+# An unserved request has been matched and logged by the trader, which then failed before it was
+# done notifying the DB, the buyer and the seller. Recovery delivers the trade again to all of them.
+# Every trade carries an idempotency key, "<trader peer_id>:<lamport ts>", and the receivers apply
+# a key once, so the parties that had already been notified are not served twice.
+# The log is scanned once, the trades are sorted by Lamport timestamp and split by receiver: each
+# receiver gets its trades in timestamp order, in batches, and the receivers are served in parallel.
+
+
+# pending_trades : The unserved trades of a trader's log as (ts, key, tx), in Lamport order.
+# A trade that was itself a replay keeps the key it was first given.
+def pending_trades(filename, trader_peer_id):
+    _, tail = data_ops.read_journal_tail(filename)
+    trades = []
+    for ts, (_, tx) in tail.items():
+        trades.append((int(ts), tx.get('key', "{}:{}".format(trader_peer_id, ts)), tx))
+    trades.sort(key=lambda trade: trade[0])
+    return trades
+
+
+# replay : Deliver the trades to their buyers and sellers, and to every host of extra_hosts.
+# deliver(host_addr, items) sends a list of transaction_batch items to one host; it is called from
+# `workers` threads, with at most `batch_size` items, and the items of a host are delivered in order.
+# Returns the number of items delivered per host.
+def replay(trades, deliver, workers=16, batch_size=256, extra_hosts=()):
+    receivers = {} # host_addr -> items in Lamport order
+    for ts, key, tx in trades:
+        item = {'product_name': tx['product_name'], 'seller_id': tx['seller_id'], 'buyer_id': tx['buyer_id'],
+                'quantity': tx.get('quantity', 1), 'key': key, 'clock': ts}
+        for host_addr in (tx['buyer_id']['host_addr'], tx['seller_id']['host_addr']) + tuple(extra_hosts):
+            receivers.setdefault(host_addr, []).append(item)
+
+    def deliver_all(host_addr, items):
+        for i in range(0, len(items), batch_size):
+            deliver(host_addr, items[i:i + batch_size])
+        return len(items)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {host_addr: executor.submit(deliver_all, host_addr, items) for host_addr, items in receivers.items()}
+    return {host_addr: future.result() for host_addr, future in futures.items()}
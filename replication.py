@@ -0,0 +1,208 @@
+import time
+import threading as td
+import wire
+from clocks import compare_vectors
+from order_book import offer_key
+
+# Replication of the traders' caches.
+# An offer, one product of a seller, is owned by one trader at a time, the owner of its product's shard,
+# and only the owner sells its units, so the traders serve lookups at once without oversells and without
+# asking the DB. The owner streams the state of its offers to the other traders, which keep it as a
+# replica and take the offers over if the owner fails.
+# Every change of an offer bumps its sequence number and is stamped with the owner's Lamport clock.
+# A delta carries the new state, its sequence number and the one it applies on top of ("base"):
+#   {'offer': offer key, 'owner': peer_id, 'base': seq or None, 'seq': seq, 'ts': lamport ts,
+#    'time': wall clock of the change, 'seller_info': {...}, 'vclock': vector clock (see clocks.py) or None}
+# Changes are coalesced per offer until the next flush: a replica gets the latest state only, based
+# on the last one it acknowledged. A replica that does not hold the base has missed an update and
+# reports a gap, the owner then sends the full state of the offer ("base" None) as a snapshot.
+# When two traders claim an offer, after a shard move, the state with the higher Lamport stamp wins.
+# With vector clocks ("Clock": "vector") the claim whose state happened after the other's wins, even with
+# a lower Lamport stamp; only the concurrent claims, made without knowing of each other, fall back to the
+# Lamport stamps, and they are counted.
+
+
+# ReplicationChannel : Both ends of the replication for one trader.
+# subscribers() returns the host_addrs of the other traders, send(host_addr, deltas) delivers a batch
+# and returns the offers with a gap, or None if the trader could not be reached. clock() is the
+# Lamport clock of the trader. on_moved(key) is called when another trader has taken over an offer
+# of this one, which must stop selling its units. With a vector_clock, every change ticks it
+# and the replicas merge the clocks of the deltas they apply.
+class ReplicationChannel:
+    def __init__(self, peer_id, subscribers, send, clock, on_moved, interval=0.05, max_batch=1024, vector_clock=None):
+        self.peer_id = peer_id
+        self.subscribers = subscribers
+        self.send = send
+        self.clock = clock
+        self.on_moved = on_moved
+        self.vector_clock = vector_clock
+        self.interval = interval
+        self.max_batch = max_batch
+        self.lock = td.Lock()
+        self.owned = {}     # offer key -> (seq, ts, time, seller_info, vclock) of the offers this trader owns
+        self.acked = {}     # subscriber -> {offer key: seq acknowledged, None if it needs a snapshot}
+        self.dirty = {}     # subscriber -> offer keys changed since the last batch
+        self.replicas = {}  # offer key -> delta last applied, for the offers of the other traders
+        self.flusher = None
+        # Metrics
+        self.changes = 0
+        self.deltas_sent = 0
+        self.batches_sent = 0
+        self.payload_bytes = 0  # Size of the batches sent, in the binary wire encoding.
+        self.snapshots_sent = 0
+        self.gaps = 0
+        self.concurrent = 0 # Claims of an offer by two traders that did not know of each other's state.
+        self.deltas_applied = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    # publish : Record a change of an offer owned by this trader.
+    def publish(self, seller_info):
+        key = offer_key(seller_info)
+        vclock = self.vector_clock.tick() if self.vector_clock is not None else None
+        with self.lock:
+            seq = self.owned[key][0] + 1 if key in self.owned else 1
+            self.owned[key] = (seq, self.clock(), time.time(), dict(seller_info), vclock)
+            self.replicas.pop(key, None)
+            for dirty in self.dirty.values():
+                dirty.add(key)
+            self.changes += 1
+            if self.flusher is None:
+                self.flusher = td.Thread(target=self.flush_loop, daemon=True)
+                self.flusher.start()
+
+    # adopt : Take over a replicated offer, its sequence numbers go on from the replica's.
+    def adopt(self, key):
+        with self.lock:
+            replica = self.replicas.pop(key, None)
+            if replica is None:
+                return None
+            self.owned[key] = (replica['seq'], replica['ts'], replica['time'], replica['seller_info'], replica.get('vclock'))
+        self.publish(replica['seller_info'])
+        return replica['seller_info']
+
+    def disown(self, key):
+        with self.lock:
+            self.owned.pop(key, None)
+
+    # replicas_of : The replicated offers owned by a trader.
+    def replicas_of(self, owner):
+        with self.lock:
+            return [key for key, replica in self.replicas.items() if replica['owner'] == owner]
+
+    # batch : The deltas due to a subscriber, at most max_batch of them. Lock must be held.
+    def batch(self, subscriber):
+        if subscriber not in self.dirty: # New subscriber, snapshot of every offer.
+            self.dirty[subscriber] = set(self.owned)
+            self.acked[subscriber] = {}
+        dirty = self.dirty[subscriber]
+        acked = self.acked[subscriber]
+        deltas = []
+        while dirty and len(deltas) < self.max_batch:
+            key = dirty.pop()
+            if key not in self.owned:
+                continue
+            seq, ts, changed_at, seller_info, vclock = self.owned[key]
+            base = acked.get(key)
+            if base is None:
+                self.snapshots_sent += 1
+            deltas.append({'offer': key, 'owner': self.peer_id, 'base': base, 'seq': seq, 'ts': ts,
+                           'time': changed_at, 'seller_info': seller_info, 'vclock': vclock})
+        return deltas
+
+    # flush : Send the pending deltas to every subscriber.
+    def flush(self):
+        subscribers = self.subscribers()
+        with self.lock:
+            for subscriber in list(self.dirty):
+                if subscriber not in subscribers: # The trader left, start over with a snapshot if it comes back.
+                    del self.dirty[subscriber]
+                    del self.acked[subscriber]
+        for subscriber in subscribers:
+            while True:
+                with self.lock:
+                    deltas = self.batch(subscriber)
+                if not deltas:
+                    break
+                gaps = self.send(subscriber, deltas)
+                size = len(wire.encode(deltas)) if gaps is not None else 0 # Not under the lock, the publishers wait on it.
+                with self.lock:
+                    if gaps is None: # Not reached, send them again next time.
+                        self.dirty[subscriber].update(delta['offer'] for delta in deltas)
+                        break
+                    acked = self.acked[subscriber]
+                    for delta in deltas:
+                        acked[delta['offer']] = delta['seq']
+                    for key in gaps:
+                        acked[key] = None
+                        self.dirty[subscriber].add(key)
+                    self.deltas_sent += len(deltas)
+                    self.batches_sent += 1
+                    self.payload_bytes += size
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    # receive : Apply a batch of deltas from another trader. Returns the offers with a gap.
+    def receive(self, deltas):
+        gaps = []
+        moved = []
+        now = time.time()
+        with self.lock:
+            for delta in deltas:
+                key = delta['offer']
+                if key in self.owned:
+                    _, ts, _, _, vclock = self.owned[key]
+                    if not self.newer(delta, ts, self.peer_id, vclock):
+                        continue # This trader's state is newer, the sender will get it from us.
+                    del self.owned[key]
+                    moved.append(key)
+                replica = self.replicas.get(key)
+                if replica is not None and replica['owner'] != delta['owner']:
+                    if not self.newer(delta, replica['ts'], replica['owner'], replica.get('vclock')):
+                        continue # Older state from a former owner.
+                elif replica is not None and delta['seq'] <= replica['seq']:
+                    continue # Already applied.
+                elif delta['base'] is not None and (replica is None or replica['seq'] != delta['base']):
+                    gaps.append(key)
+                    self.gaps += 1
+                    continue
+                self.replicas[key] = delta
+                if self.vector_clock is not None and delta.get('vclock'):
+                    self.vector_clock.merge(delta['vclock'])
+                self.deltas_applied += 1
+                lag = max(now - delta['time'], 0.0)
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+        for key in moved:
+            self.on_moved(key)
+        return gaps
+
+    # newer : Whether the delta of another owner replaces the state (ts, owner, vclock) of the offer. Lock must be held.
+    def newer(self, delta, ts, owner, vclock):
+        if delta.get('vclock') and vclock:
+            order = compare_vectors(delta['vclock'], vclock)
+            if order is not None:
+                return order > 0
+            self.concurrent += 1
+        return (delta['ts'], delta['owner']) > (ts, owner)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'owned': len(self.owned),
+                'replicas': len(self.replicas),
+                'changes': self.changes,
+                'deltas_sent': self.deltas_sent,
+                'coalesced': max(self.changes * len(self.acked) - self.deltas_sent, 0),
+                'batches_sent': self.batches_sent,
+                'payload_bytes': self.payload_bytes,
+                'snapshots_sent': self.snapshots_sent,
+                'gaps': self.gaps,
+                'concurrent': self.concurrent,
+                'deltas_applied': self.deltas_applied,
+                'lag_mean': self.lag_total / self.deltas_applied if self.deltas_applied else None,
+                'lag_max': self.lag_max,
+            }
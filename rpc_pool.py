@@ -0,0 +1,237 @@
+import time
+import json
+import socket
+import logging
+import http.client
+import xmlrpc.client
+import threading as td
+from xmlrpc.server import SimpleXMLRPCRequestHandler
+from wire import BinaryServerProxy
+from metrics import Histogram
+import tracing
+
+# Persistent, pooled XML-RPC connections between peers.
+# Each peer address has a pool of idle ServerProxy objects (or BinaryServerProxy, see wire.py); a call
+# checks one out, runs on its keep-alive connection and gives it back. Liveness of a peer is tracked from the outcome
+# of the real calls, so no probe call is needed before a message.
+
+
+# Server side: HTTP/1.1 lets the client keep the connection open between calls.
+# Idle connections are closed by the server after `timeout` seconds.
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = 30.0
+    disable_nagle_algorithm = True # The headers and the body are sent apart, the body must not wait for an ACK.
+
+    # do_POST : A call runs in the trace context of its caller, if it has one (see tracing.py).
+    def do_POST(self):
+        context = tracing.decode(self.headers.get(tracing.HEADER))
+        if context is None:
+            return super().do_POST()
+        with tracing.activate(context):
+            return super().do_POST()
+
+    # do_GET : GET /stats answers with the server's "stats" function as JSON, for monitoring tools.
+    def do_GET(self):
+        stats = self.server.funcs.get('stats')
+        if self.path != '/stats' or stats is None:
+            self.report_404()
+            return
+        body = json.dumps(stats()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# HTTP connection with separate connect and read timeouts.
+class TimeoutHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, host, connect_timeout, read_timeout):
+        super().__init__(host, timeout=connect_timeout)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(self.read_timeout)
+
+
+# Transport that keeps its connection open between requests.
+class KeepAliveTransport(xmlrpc.client.Transport):
+    def __init__(self, connect_timeout, read_timeout):
+        super().__init__()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, _ = self.get_host_info(host)
+        self._connection = host, TimeoutHTTPConnection(chost, self.connect_timeout, self.read_timeout)
+        return self._connection[1]
+
+    # send_headers : The trace context of the calling thread goes with the call.
+    def send_headers(self, connection, headers):
+        context = tracing.current()
+        if context is not None:
+            headers = list(headers) + [(tracing.HEADER, tracing.encode(context))]
+        super().send_headers(connection, headers)
+
+
+# Errors that mean the peer could not be reached, as opposed to a Fault raised by the remote method.
+CONNECTION_ERRORS = (OSError, http.client.HTTPException, xmlrpc.client.ProtocolError)
+
+
+# ConnectionPool : Idle proxies per peer address and the liveness state of every peer.
+# protocol is "xmlrpc" or "binary"; with "binary", peers that have no binary server are reached over XML-RPC.
+# A refused binary connection may only mean the peer's binary server is not up yet: the binary port is tried
+# again after binary_retry seconds, the delay doubling at every refusal up to max_binary_retry.
+class ConnectionPool:
+    def __init__(self, connect_timeout=2.0, read_timeout=10.0, max_idle=8, retry_interval=1.0, protocol="xmlrpc",
+                 binary_retry=5.0, max_binary_retry=300.0):
+        if protocol not in ("xmlrpc", "binary"):
+            raise ValueError("Unknown transport protocol: {}".format(protocol))
+        self.protocol = protocol
+        self.binary_retry = binary_retry
+        self.max_binary_retry = max_binary_retry
+        self.xmlrpc_only = {} # host_addr -> (time the binary port is tried again, delay) of the peers that refused it.
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.retry_interval = retry_interval # A peer marked down is not contacted again before this delay.
+        self.idle = {}      # host_addr -> list of idle ServerProxy
+        self.down = {}      # host_addr -> time of the last failed call
+        self.proxies = {}   # host_addr -> PooledProxy
+        self.lock = td.Lock()
+        self.created = 0    # Connections opened since start.
+        self.calls = 0
+        self.failures = 0   # Calls that could not reach the peer.
+        self.latency = Histogram() # Seconds per call, from checkout to reply.
+        self.tracer = None # With a tracing.Tracer, a call made in a trace gets a "call.<method>" span.
+        # Optional callbacks with the host_addr of every successful or failed call, for the failure detector.
+        self.on_alive = None
+        self.on_down = None
+
+    # is_alive : False if the last call to the peer failed less than retry_interval ago.
+    def is_alive(self, host_addr):
+        failed_at = self.down.get(host_addr)
+        return failed_at is None or time.monotonic() - failed_at >= self.retry_interval
+
+    # proxy : The pooled proxy of a peer, shared by all the threads of the process.
+    def proxy(self, host_addr):
+        proxy = self.proxies.get(host_addr)
+        if proxy is None:
+            with self.lock:
+                proxy = self.proxies.setdefault(host_addr, PooledProxy(self, host_addr))
+        return proxy
+
+    def checkout(self, host_addr):
+        fallback = self.xmlrpc_only.get(host_addr)
+        try_binary = self.protocol == "binary" and (fallback is None or time.monotonic() >= fallback[0])
+        with self.lock:
+            idle = self.idle.get(host_addr)
+            if idle and (fallback is None or not try_binary):
+                return idle.pop()
+            self.created += 1
+        if try_binary:
+            try:
+                server_proxy = BinaryServerProxy(host_addr, self.connect_timeout, self.read_timeout)
+            except ConnectionRefusedError: # Fall back to XML-RPC for this peer for a while.
+                delay = self.binary_retry if fallback is None else min(2 * fallback[1], self.max_binary_retry)
+                self.xmlrpc_only[host_addr] = (time.monotonic() + delay, delay)
+            else:
+                if fallback is not None: # The binary server is up now, the idle XML-RPC connections are dropped.
+                    self.xmlrpc_only.pop(host_addr, None)
+                    with self.lock:
+                        idle = self.idle.pop(host_addr, [])
+                    for stale in idle:
+                        stale('close')()
+                return server_proxy
+        transport = KeepAliveTransport(self.connect_timeout, self.read_timeout)
+        return xmlrpc.client.ServerProxy('http://' + str(host_addr) + '/', transport=transport, allow_none=True)
+
+    def checkin(self, host_addr, server_proxy):
+        with self.lock:
+            idle = self.idle.setdefault(host_addr, [])
+            if len(idle) < self.max_idle:
+                idle.append(server_proxy)
+                return
+        server_proxy('close')()
+
+    def mark_alive(self, host_addr):
+        if self.on_alive is not None:
+            self.on_alive(host_addr)
+        if host_addr in self.down:
+            self.down.pop(host_addr, None)
+            logging.info("Peer at {} is reachable again".format(host_addr))
+
+    # mark_down : Record a failed call and drop the idle connections of the peer, they are stale.
+    def mark_down(self, host_addr):
+        self.down[host_addr] = time.monotonic()
+        with self.lock:
+            idle = self.idle.pop(host_addr, [])
+        for server_proxy in idle:
+            server_proxy('close')()
+        if self.on_down is not None:
+            self.on_down(host_addr)
+
+    def stats(self):
+        with self.lock:
+            idle = sum(len(server_proxies) for server_proxies in self.idle.values())
+        stats = self.latency.snapshot()
+        stats.update({'calls': self.calls, 'failures': self.failures, 'created': self.created, 'idle': idle,
+                      'down': sum(1 for host_addr in list(self.down) if not self.is_alive(host_addr))})
+        return stats
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for server_proxies in idle.values():
+            for server_proxy in server_proxies:
+                server_proxy('close')()
+
+
+# PooledProxy : Stands in for a ServerProxy. Every remote call checks a connection out of the pool.
+# A call that cannot reach the peer marks it down, logs a warning and returns None, the same
+# outcome as skipping the message when the peer is not connected.
+class PooledProxy:
+    def __init__(self, pool, host_addr):
+        self.pool = pool
+        self.host_addr = host_addr
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        def call(*args):
+            return self.call(name, *args)
+        return call
+
+    def call(self, name, *args):
+        if self.pool.tracer is not None and tracing.current() is not None:
+            with self.pool.tracer.span('call.' + name):
+                return self.invoke(name, *args)
+        return self.invoke(name, *args)
+
+    def invoke(self, name, *args):
+        server_proxy = None
+        start = time.perf_counter()
+        self.pool.calls += 1
+        try:
+            server_proxy = self.pool.checkout(self.host_addr) # Connects right away with the binary protocol.
+            result = getattr(server_proxy, name)(*args)
+        except xmlrpc.client.Fault:
+            self.pool.checkin(self.host_addr, server_proxy) # The peer answered.
+            self.pool.mark_alive(self.host_addr)
+            raise
+        except CONNECTION_ERRORS as e:
+            if server_proxy is not None:
+                server_proxy('close')()
+            self.pool.failures += 1
+            self.pool.mark_down(self.host_addr)
+            logging.warning("Call {} to {} failed: {}".format(name, self.host_addr, e))
+            return None
+        self.pool.checkin(self.host_addr, server_proxy)
+        self.pool.mark_alive(self.host_addr)
+        self.pool.latency.record(time.perf_counter() - start)
+        return result
@@ -1,39 +1,2 @@
-python3 market.py 1 20090 '{"Role": "Buyer","Inv":{},"shop":["Fish","Boar","Salt"]}'  6 &
-python3 market.py 2 20091 '{"Role": "Seller","Inv":{"Fish":0,"Boar":3,"Salt":0},"shop":[]}' 6 &
-python3 market.py 3 20092 '{"Role": "Buyer","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-python3 market.py 4 20093 '{"Role": "Seller","Inv":{"Fish":3,"Boar":0,"Salt":0},"shop":[]}' 6 &  
-python3 market.py 5 20094 '{"Role": "Buyer","Inv":{},"shop":["Boar","Salt","Fish"]}' 6 &
-python3 market.py 6 20095 '{"Role": "Seller","Inv":{"Fish":0,"Boar":0,"Salt":3},"shop":[]}' 6 &
-
-# python3 market.py 1 20090 '{"Role": "Buyer","Inv":{},"shop":["Fish","Boar","Salt","Fish","Boar","Salt","Fish","Boar","Salt"]}'  12 &
-# python3 market.py 2 20091 '{"Role": "Seller","Inv":{"Fish":0,"Boar":30,"Salt":0},"shop":[]}' 12 &
-# python3 market.py 3 20092 '{"Role": "Buyer","Inv":{},"shop":["Salt","Fish","Boar","Fish","Boar","Salt","Fish","Boar","Salt"]}' 12 & 
-# python3 market.py 4 20093 '{"Role": "Seller","Inv":{"Fish":35,"Boar":0,"Salt":0},"shop":[]}' 12 &  
-# python3 market.py 5 20094 '{"Role": "Buyer","Inv":{},"shop":["Boar","Salt","Fish","Fish","Boar","Salt","Fish","Boar","Salt"]}' 12 &
-# python3 market.py 6 20095 '{"Role": "Seller","Inv":{"Fish":0,"Boar":0,"Salt":300},"shop":[]}' 12 &
-# python3 market.py 7 20096 '{"Role": "Buyer","Inv":{},"shop":["Boar","Salt","Fish","Boar","Salt","Fish","Boar","Salt"]}' 12 &
-# python3 market.py 8 20097 '{"Role": "Seller","Inv":{"Fish":0,"Boar":0,"Salt":3},"shop":[]}' 12 &
-# python3 market.py 9 20098 '{"Role": "Buyer","Inv":{},"shop":["Boar","Salt","Fish","Fish","Boar","Salt","Fish","Boar","Salt"]}' 12 &
-# python3 market.py 10 20099 '{"Role": "Seller","Inv":{"Fish":0,"Boar":0,"Salt":300},"shop":[]}' 12 &
-
-
-# python3 market.py 1 20090 '{"Role": "Buyer","Inv":{},"shop":["Fish","Boar","Salt"]}'  6 &
-# python3 market.py 2 20091 '{"Role": "Buyer","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-# python3 market.py 3 20092 '{"Role": "Buyer","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-# python3 market.py 4 20093 '{"Role": "Buyer","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-# python3 market.py 5 20094 '{"Role": "Buyer","Inv":{},"shop":["Boar","Salt","Fish"]}' 6 &
-# python3 market.py 6 20095 '{"Role": "Buyer","Inv":{},"shop":["Boar","Salt", "Fish"]}' 6 &
-
-# python3 market.py 1 20090 '{"Role": "Seller","Inv":{},"shop":["Fish","Boar","Salt"]}'  6 &
-# python3 market.py 2 20091 '{"Role": "Seller","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-# python3 market.py 3 20092 '{"Role": "Seller","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-# python3 market.py 4 20093 '{"Role": "Seller","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-# python3 market.py 5 20094 '{"Role": "Seller","Inv":{},"shop":["Boar","Salt","Fish"]}' 6 &
-# python3 market.py 6 20095 '{"Role": "Seller","Inv":{},"shop":["Boar","Salt", "Fish"]}' 6 &
-
-# python3 market.py 1 20090 '{"Role": "Buyer","Inv":{},"shop":[]}'  6 &
-# python3 market.py 2 20091 '{"Role": "Seller","Inv":{"Fish":0,"Boar":0,"Salt":3},"shop":[]}' 6 & 
-# python3 market.py 3 20092 '{"Role": "Buyer","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-# python3 market.py 4 20093 '{"Role": "Buyer","Inv":{},"shop":["Salt","Fish","Boar"]}' 6 & 
-# python3 market.py 5 20094 '{"Role": "Buyer","Inv":{},"shop":["Boar","Salt","Fish"]}' 6 &
-# python3 market.py 6 20095 '{"Role": "Buyer","Inv":{},"shop":["Boar","Salt", "Fish"]}' 6 &
\ No newline at end of file
+# Starts the DB server and a market of 3 buyers, 3 sellers and 2 traders on ports 20090 and up, see launcher.py.
+python3 launcher.py run --buyers 3 --sellers 3 "$@"
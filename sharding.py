@@ -0,0 +1,67 @@
+import bisect
+import hashlib
+import functools
+
+
+@functools.lru_cache(maxsize=4096) # The product names and the points of the traders come back at every lookup and rebalance.
+def stable_hash(key):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+# sub_shard : The key on the ring of a seller's offer of a product. A product is split into `shards`
+# sub-shards and the offers of a seller are in one of them, so the offers of a product spread over the
+# traders even though there are only a few products.
+def sub_shard(product_name, seller_peer_id, shards):
+    return "{}#{}".format(product_name, stable_hash(seller_peer_id) % shards)
+
+
+# ConsistentHashRing : Assigns products, or sub-shards of products, to traders.
+# Every trader has `replicas` points on the ring and a key belongs to the trader of the first
+# point at or after its hash. When a trader leaves, only its keys move, and they
+# spread over the remaining traders.
+class ConsistentHashRing:
+    def __init__(self, replicas=160):
+        self.replicas = replicas
+        self.points = []   # Sorted hashes.
+        self.owners = {}   # hash -> trader peer_id
+        self.traders = {}  # peer_id -> trader info
+
+    def __len__(self):
+        return len(self.traders)
+
+    def __contains__(self, peer_id):
+        return peer_id in self.traders
+
+    def add(self, trader):
+        peer_id = trader['peer_id']
+        self.traders[peer_id] = trader
+        if peer_id in self.owners.values():
+            return
+        for replica in range(self.replicas):
+            point = stable_hash("{}#{}".format(peer_id, replica))
+            if point in self.owners:
+                continue # Collision, the trader already holding the point keeps it.
+            bisect.insort(self.points, point)
+            self.owners[point] = peer_id
+
+    def remove(self, peer_id):
+        if self.traders.pop(peer_id, None) is None:
+            return
+        self.points = [point for point in self.points if self.owners[point] != peer_id]
+        self.owners = {point: self.owners[point] for point in self.points}
+
+    # owner : The trader in charge of a key, None if the ring is empty.
+    def owner(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect_left(self.points, stable_hash(key))
+        if i == len(self.points):
+            i = 0
+        return self.traders[self.owners[self.points[i]]]
+
+    # shard_owners : The traders in charge of the sub-shards of a product, one per sub-shard, so a trader
+    # comes up as many times as it has sub-shards.
+    def shard_owners(self, product_name, shards):
+        if not self.points:
+            return []
+        return [self.owner("{}#{}".format(product_name, shard)) for shard in range(shards)]
@@ -0,0 +1,479 @@
+import os
+import json
+import heapq
+import random
+import logging
+import argparse
+import tempfile
+import itertools
+import functools
+import time
+import xmlrpc.client
+from collections.abc import Sequence
+import data_ops
+from market import peer
+from admission import BUSY
+from metrics import Histogram
+from launcher import cluster_spec, format_result
+
+# Deterministic simulation of a whole market in one process.
+# The peers are market.py peers with the transport and the timers replaced: the RPCs are messages on
+# an in-memory network and the sleeps, timeouts and periodic loops are events on a virtual clock. One
+# thread runs the events in time order, so a run with the same spec and seed takes the same course,
+# and thousands of peers run in seconds whatever the virtual duration.
+#   python3 simulator.py --buyers 5000 --sellers 5000 --duration 10 --fail-at 4
+# The network delays every message by `latency` seconds (uniform between the bounds) and loses it with
+# probability `drop`. The peers talk over TCP, so a lost message is sent again, `retransmit` seconds
+# later, then twice that, and so on. A peer handles its messages one at a time, `service_time` seconds
+# each. A message to a crashed peer gets no reply, its sender sees it fail after `timeout` seconds.
+# The heartbeats of the traders are datagrams on the same network, lost with probability `drop` and not
+# sent again, and the failure detectors judge them on the virtual clock: a crashed trader stops sending.
+# The calls a peer makes while it handles a message (a trader notifying the buyer and the seller of a
+# trade, a seller registering its offer) are made at once, their cost is part of the service time.
+# There is no DB server: the write-behind caches keep their updates and the traders do not check them.
+
+UNREACHABLE = "unreachable" # Outcome of a message that got no reply.
+ADMITTED = ('lookup', 'lookup_batch') # Methods behind a trader's admission queue, see admission.py.
+
+
+# VirtualClock : Events run in time order, in the order they were scheduled at equal times.
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+        self.events = [] # Heap of (time, seq, function, args).
+        self.seq = itertools.count()
+        self.processed = 0
+
+    def call_at(self, when, function, *args):
+        heapq.heappush(self.events, (when, next(self.seq), function, args))
+
+    def call_later(self, delay, function, *args):
+        self.call_at(self.now + delay, function, *args)
+
+    # run : Run the events up to time `until`, then move the clock there.
+    def run(self, until):
+        events = self.events
+        while events and events[0][0] <= until:
+            when, _, function, args = heapq.heappop(events)
+            self.now = when
+            function(*args)
+            self.processed += 1
+        self.now = max(self.now, until)
+
+    # run_until : Run until condition() holds, checked every `poll` seconds. The time it held, None after `timeout` seconds.
+    def run_until(self, condition, timeout, poll=0.005):
+        deadline = self.now + timeout
+        while not condition():
+            if self.now >= deadline or not self.events:
+                return None
+            self.run(min(self.now + poll, deadline))
+        return self.now
+
+
+# SimNetwork : The peers by host_addr, and the messages between them.
+class SimNetwork:
+    def __init__(self, clock, seed=0, latency=(0.0005, 0.002), drop=0.0, service_time=0.0, timeout=2.0, retransmit=0.2):
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.drop = drop
+        self.retransmit = retransmit
+        self.service_time = service_time
+        self.timeout = timeout
+        self.peers = {}      # host_addr -> SimPeer
+        self.busy_until = {} # host_addr -> time the peer is done with the messages it has
+        # Metrics
+        self.messages = 0
+        self.datagrams = 0
+        self.dropped = 0
+        self.busy = 0
+
+    def register(self, sim_peer):
+        self.peers[sim_peer.host_addr] = sim_peer
+
+    def reachable(self, host_addr):
+        receiver = self.peers.get(host_addr)
+        return receiver is not None and not receiver.crashed
+
+    # delay : Seconds a message takes, with its retransmissions.
+    def delay(self):
+        delay = self.rng.uniform(*self.latency)
+        retransmit = self.retransmit
+        while self.drop and self.rng.random() < self.drop:
+            self.dropped += 1
+            delay += retransmit
+            retransmit *= 2
+        return delay
+
+    # send : Message from the sender to host_addr. The reply goes to on_reply(reply, latency), UNREACHABLE
+    # if there is none; the sender is also told with unreachable(host_addr), as the connection pool does.
+    def send(self, sender, host_addr, method, args, on_reply=None):
+        self.messages += 1
+        start = self.clock.now
+        if not self.reachable(host_addr):
+            self.clock.call_at(start + self.timeout, self.fail, sender, host_addr, on_reply, start)
+            return
+        self.clock.call_later(self.delay(), self.arrive, sender, host_addr, method, args, on_reply, start)
+
+    def arrive(self, sender, host_addr, method, args, on_reply, start):
+        receiver = self.peers[host_addr]
+        if receiver.crashed:
+            self.clock.call_at(start + self.timeout, self.fail, sender, host_addr, on_reply, start)
+            return
+        if not self.service_time:
+            self.serve(sender, receiver, method, args, on_reply, start)
+            return
+        now = self.clock.now
+        begin = max(now, self.busy_until.get(host_addr, 0.0))
+        if method in ADMITTED and receiver.admission.max_wait is not None and begin - now > receiver.admission.max_wait:
+            self.busy += 1 # Would have waited too long in the admission queue.
+            self.respond(sender, on_reply, BUSY, start)
+            return
+        self.busy_until[host_addr] = begin + self.service_time
+        self.clock.call_at(begin + self.service_time, self.serve, sender, receiver, method, args, on_reply, start)
+
+    def serve(self, sender, receiver, method, args, on_reply, start):
+        if receiver.crashed:
+            self.clock.call_at(max(start + self.timeout, self.clock.now), self.fail, sender, receiver.host_addr, on_reply, start)
+            return
+        try:
+            result = receiver.functions[method](*args)
+        except Exception as e: # The caller's thread would have died on the Fault.
+            logging.debug("[Peer {}]: {} failed: {}".format(receiver.peer_id, method, e))
+            return
+        if on_reply is not None:
+            self.respond(sender, on_reply, result, start)
+
+    def respond(self, sender, on_reply, result, start):
+        self.clock.call_later(self.delay(), self.reply, sender, on_reply, result, start)
+
+    def reply(self, sender, on_reply, result, start):
+        if not sender.crashed:
+            on_reply(result, self.clock.now - start)
+
+    def fail(self, sender, host_addr, on_reply, start):
+        if sender.crashed:
+            return
+        sender.unreachable(host_addr)
+        if on_reply is not None:
+            on_reply(UNREACHABLE, self.clock.now - start)
+
+    # datagram : A heartbeat from the sender to host_addr, delivered once or lost.
+    def datagram(self, sender, host_addr, data):
+        self.datagrams += 1
+        if not self.reachable(host_addr) or (self.drop and self.rng.random() < self.drop):
+            return
+        self.clock.call_later(self.rng.uniform(*self.latency), self.peers[host_addr].run, self.peers[host_addr].failure_detector.receive, data)
+
+    # call : Call made while handling a message, it runs at once. UNREACHABLE if the peer is down, a
+    # Fault if the method raises, as with XML-RPC.
+    def call(self, host_addr, method, args):
+        self.messages += 1
+        if not self.reachable(host_addr):
+            return UNREACHABLE
+        try:
+            return self.peers[host_addr].functions[method](*args)
+        except Exception as e:
+            raise xmlrpc.client.Fault(1, "{}:{}".format(type(e), e))
+
+
+# SimProxy : Stands in for a PooledProxy, a call that does not get there returns None and reports the failure.
+class SimProxy:
+    def __init__(self, sim_peer, host_addr):
+        self.peer = sim_peer
+        self.host_addr = host_addr
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        def call(*args):
+            result = self.peer.network.call(self.host_addr, name, args)
+            if result is UNREACHABLE:
+                self.peer.unreachable(self.host_addr)
+                return None
+            return result
+        return call
+
+
+# NeighborView : The peers of the simulation but one, as a list that is not copied for every peer.
+class NeighborView(Sequence):
+    def __init__(self, everyone, index):
+        self.everyone = everyone
+        self.index = index
+
+    def __len__(self):
+        return len(self.everyone) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.everyone[i + 1 if i >= self.index else i]
+
+    def __iter__(self):
+        return itertools.chain(itertools.islice(self.everyone, 0, self.index), itertools.islice(self.everyone, self.index + 1, None))
+
+
+# SimPeer : A peer on the simulated network. The protocol is the peer's own, the election and the buyer's
+# rounds included; the methods below only replace its sockets, threads and timers.
+class SimPeer(peer):
+    def __init__(self, network, host_addr, peer_id, neighbors, db):
+        super().__init__(host_addr, peer_id, neighbors, db)
+        self.network = network
+        self.clock = network.clock
+        self.crashed = False
+        self.functions = {}
+        # The flushes and the gossip run on the clock, see begin_trading and transaction.
+        self.db_cache.flusher = self.restocks.flusher = self.replication.flusher = self.clock_gossip.thread = "simulated"
+        self.restock_scheduled = False
+        self.failure_detector.send = self.send_heartbeat
+
+    def startServer(self):
+        self.functions = self.rpc_functions()
+        self.network.register(self)
+        self.every(self.failure_detector.interval, self.failure_detector.tick)
+
+    def send_heartbeat(self, data, host_addr):
+        self.network.datagram(self, host_addr, data)
+        self.failure_detector.heartbeats_sent += 1
+
+    def stop(self):
+        self.crashed = True
+
+    # run : Run function(*args) unless the peer has crashed, for the events of the peer.
+    def run(self, function, *args):
+        if not self.crashed:
+            function(*args)
+
+    def later(self, delay, function, *args):
+        self.clock.call_later(delay, self.run, function, *args)
+
+    def every(self, interval, function):
+        def tick():
+            function()
+            self.later(interval, tick)
+        self.later(interval, tick)
+
+    def spawn(self, function, *args, daemon=False):
+        self.later(0.0, function, *args)
+
+    def now(self):
+        return self.clock.now
+
+    def get_rpc(self, neighbor):
+        if neighbor not in self.network.peers:
+            return False, None
+        return True, SimProxy(self, neighbor)
+
+    # unreachable : A message got no reply, reported to the failure detector like a failed RPC.
+    def unreachable(self, host_addr):
+        self.failure_detector.report_failure(host_addr)
+
+    def send(self, host_addr, method, args, on_reply=None):
+        self.network.send(self, host_addr, method, args, on_reply)
+
+    def multicast(self, neighbors, method, *args):
+        for neighbor in neighbors:
+            self.send(neighbor['host_addr'], method, args)
+
+    def request_all(self, neighbors, method, args, on_reply):
+        for neighbor in neighbors:
+            self.send(neighbor['host_addr'], method, args, functools.partial(self.neighbor_reply, on_reply, neighbor))
+
+    def neighbor_reply(self, on_reply, neighbor, reply, latency):
+        on_reply(neighbor, None if reply is UNREACHABLE else reply, latency)
+
+    # send_shard : The requests to a trader go as one message, the reply comes back as one.
+    def send_shard(self, host_addr, buyer_id, shard_requests, on_reply):
+        if len(shard_requests) > 1:
+            self.send(host_addr, 'lookup_batch', (buyer_id, shard_requests), functools.partial(self.shard_reply, on_reply))
+        else:
+            product_name, quantity, request_ts = shard_requests[0]
+            self.send(host_addr, 'lookup', (buyer_id, product_name, request_ts, quantity), functools.partial(self.shard_reply, on_reply))
+
+    def shard_reply(self, on_reply, reply, latency):
+        on_reply(None if reply is UNREACHABLE else reply, latency)
+
+    # begin_trading : The periodic loops of the peer, the gossip and a trader's replication, run on the clock.
+    def begin_trading(self):
+        if self.clock_propagation == 'gossip' and self.db['Role'] != 'Trader':
+            self.every(self.clock_gossip.interval, self.clock_gossip.tick)
+        if self.db['Role'] == 'Trader':
+            self.every(self.replication.interval, self.replication.flush)
+        super().begin_trading()
+
+    # transaction : A seller's restocks leave one round trip later, with the restocks made in between.
+    def transaction(self, *args):
+        super().transaction(*args)
+        if self.restocks.pending and not self.restock_scheduled:
+            self.restock_scheduled = True
+            self.later(self.restocks.flush_interval or 2 * self.network.delay(), self.flush_restocks)
+
+    def flush_restocks(self):
+        self.restock_scheduled = False
+        if not self.restocks.flush() and self.restocks.pending:
+            self.restock_scheduled = True
+            self.later(max(self.restocks.flush_interval, 0.1), self.flush_restocks)
+
+    def cache_check_loop(self):
+        if self.network.reachable(self.db_server):
+            self.every(self.cache_check_interval, self.check_cache)
+
+
+# SimCluster : The simulated counterpart of launcher.Cluster, on a spec of launcher.cluster_spec.
+# The traders write their transaction logs to work_dir (a temporary directory, in memory if it can, by default),
+# their "JournalDir". Seeds the `random` module the peers use.
+class SimCluster:
+    def __init__(self, spec, seed=0, latency=(0.0005, 0.002), drop=0.0, service_time=0.0, timeout=2.0, work_dir=None):
+        self.spec = spec
+        self.seed = seed
+        self.clock = VirtualClock()
+        self.network = SimNetwork(self.clock, seed, latency, drop, service_time, timeout)
+        self.tmp_dir = None
+        if work_dir is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix='simulation_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None) # The fsyncs cost no virtual time.
+            work_dir = self.tmp_dir.name
+        self.work_dir = work_dir
+        self.peers = {} # peer_id -> SimPeer
+
+    def host_addr(self, peer_id):
+        return "sim:" + str(peer_id)
+
+    # start : Create the peers; with elect=True, peers 1 and 2 start the election as in market.py,
+    # otherwise the `Traders` highest peers declare themselves the traders the election would make.
+    def start(self, elect=True):
+        random.seed(self.seed)
+        everyone = [{'peer_id': i + 1, 'host_addr': self.host_addr(i + 1), 'role': peer_db['Role']} for i, peer_db in enumerate(self.spec)]
+        for i, peer_db in enumerate(self.spec):
+            peer_db = dict(peer_db, Inv=dict(peer_db.get('Inv', {})), shop=list(peer_db.get('shop', [])))
+            peer_db.setdefault('TraderWorkers', 0) # The network queues the messages of a busy peer instead.
+            peer_db.setdefault('RecoveryWorkers', 1)
+            peer_db.setdefault('JournalDir', self.work_dir)
+            sim_peer = SimPeer(self.network, self.host_addr(i + 1), i + 1, NeighborView(everyone, i), peer_db)
+            sim_peer.startServer()
+            self.peers[i + 1] = sim_peer
+        if elect:
+            for peer_id in sorted(self.peers)[:2]:
+                self.peers[peer_id].spawn(self.peers[peer_id].start_election)
+        else:
+            for peer_id in sorted(self.peers)[-self.peers[1].num_traders:]:
+                self.peers[peer_id].spawn(self.peers[peer_id].declare_victory)
+
+    def alive(self):
+        return [peer_id for peer_id, sim_peer in self.peers.items() if not sim_peer.crashed]
+
+    def stats(self):
+        return {peer_id: self.peers[peer_id].load_stats() for peer_id in self.alive()}
+
+    # traders : The traders every peer alive agrees on, None while they disagree.
+    def traders(self):
+        views = set()
+        for peer_id in self.alive():
+            views.add(tuple(sorted(trader['peer_id'] for trader in self.peers[peer_id].active_traders())))
+            if len(views) > 1:
+                return None
+        return list(views.pop()) if views else None
+
+    def run(self, seconds):
+        self.clock.run(self.clock.now + seconds)
+
+    def wait_for_traders(self, count, timeout=60.0):
+        if self.clock.run_until(lambda: len(self.traders() or ()) == count, timeout) is None:
+            raise RuntimeError("no agreement on {} traders after {:.0f} s".format(count, timeout))
+        return self.traders()
+
+    # kill : Crash a peer. Its heartbeats stop, the peers that watch it suspect it when their detectors say so.
+    def kill(self, peer_id):
+        self.peers[peer_id].crashed = True
+
+    def stop(self):
+        for peer_id, sim_peer in self.peers.items():
+            journal = data_ops.journals.pop(sim_peer.journal_file(peer_id), None)
+            if journal is not None:
+                journal.close()
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
+
+
+# simulate_load : run_load of launcher.py on a simulated cluster, the durations are in virtual seconds.
+# Also returns the time to elect the traders ("elected", None with elect=False), the requests each trader
+# looked up ("lookups", by peer id), the messages and the wall-clock seconds of the run.
+def simulate_load(buyers=3, sellers=3, traders=2, rate=10.0, duration=10.0, fail_at=None, seed=0, units=None, spares=1, quantity=1,
+                  elect=True, latency=(0.0005, 0.002), drop=0.0, service_time=0.0, timeout=2.0, work_dir=None, **db):
+    wall_start = time.perf_counter()
+    start_delay = 1.0
+    if units is None:
+        units = int(rate * buyers * duration * quantity) + 1
+    spec = cluster_spec(buyers, sellers, traders, spares, units=units, quantity=quantity, seed=seed,
+                        RequestRate=rate, Duration=duration, StartDelay=start_delay, BatchSize=1, **db)
+    cluster = SimCluster(spec, seed, latency, drop, service_time, timeout, work_dir)
+    result = {'peers': len(spec), 'rate': rate * buyers, 'elected': None, 'rerouted': None, 'replaced': None}
+    try:
+        cluster.start(elect)
+        elected = cluster.wait_for_traders(traders)
+        if elect:
+            result['elected'] = cluster.clock.now
+        cluster.run(start_delay)
+        start = cluster.clock.now
+        if fail_at is not None:
+            cluster.run(fail_at)
+            crashed = max(elected)
+            crash_time = cluster.clock.now
+            cluster.kill(crashed)
+            def views():
+                return [[trader['peer_id'] for trader in cluster.peers[peer_id].active_traders()] for peer_id in cluster.alive()]
+            rerouted = cluster.clock.run_until(lambda: all(crashed not in view for view in views()), duration)
+            if rerouted is not None:
+                result['rerouted'] = rerouted - crash_time
+                replaced = cluster.clock.run_until(lambda: all(len(view) == traders for view in views()), start + duration - cluster.clock.now)
+                if replaced is not None:
+                    result['replaced'] = replaced - crash_time
+        cluster.run(max(duration - (cluster.clock.now - start), 0) + 1.0) # The last replies.
+        stats_by_peer = cluster.stats()
+        stats = list(stats_by_peer.values())
+        result['concurrent'] = sum(cluster.peers[peer_id].replication.stats()['concurrent'] for peer_id in cluster.alive()) # With "Clock": "vector".
+    finally:
+        cluster.stop()
+    latency_histogram = Histogram()
+    for peer_stats in stats:
+        latency_histogram.merge(peer_stats['latency'])
+    result['requests'] = sum(peer_stats['requests'] for peer_stats in stats)
+    result['throughput'] = sum(peer_stats['shipments'] for peer_stats in stats) / duration
+    result['p50'] = latency_histogram.percentile(0.50)
+    result['p99'] = latency_histogram.percentile(0.99)
+    result['lookups'] = {peer_id: stats_by_peer[peer_id]['lookups'] for peer_id in sorted(stats_by_peer) if stats_by_peer[peer_id]['role'] == 'Trader'}
+    result['messages'] = cluster.network.messages
+    result['events'] = cluster.clock.processed
+    result['wall'] = time.perf_counter() - wall_start
+    return result
+
+
+def format_simulation(name, result):
+    elected = "{:6.0f} ms".format(result['elected'] * 1e3) if result['elected'] is not None else "     -   "
+    return format_result(name, result) + ", elected {}, {} messages, {:.1f} s wall".format(elected, result['messages'], result['wall'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a market cluster in one process, on virtual time.")
+    parser.add_argument('--buyers', type=int, default=3)
+    parser.add_argument('--sellers', type=int, default=3)
+    parser.add_argument('--traders', type=int, default=2)
+    parser.add_argument('--spares', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=1.0, help="lookups per second per buyer")
+    parser.add_argument('--duration', type=float, default=10.0, help="virtual seconds of load")
+    parser.add_argument('--fail-at', type=float, default=None, help="crash a trader after this many virtual seconds of load")
+    parser.add_argument('--no-election', action='store_true', help="start with the traders the election would make")
+    parser.add_argument('--latency', type=float, nargs=2, default=(0.0005, 0.002), help="bounds of the message delay, seconds")
+    parser.add_argument('--drop', type=float, default=0.0, help="probability a message is lost")
+    parser.add_argument('--service-time', type=float, default=0.0, help="seconds a peer takes per message")
+    parser.add_argument('--db', default='{}', help="JSON settings added to the db of every peer")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    result = simulate_load(args.buyers, args.sellers, args.traders, args.rate, args.duration, args.fail_at, args.seed, spares=args.spares,
+                           elect=not args.no_election, latency=tuple(args.latency), drop=args.drop, service_time=args.service_time,
+                           **json.loads(args.db))
+    print(format_simulation("simulation", result))
@@ -0,0 +1,318 @@
+import sys
+import json
+import time
+import argparse
+import itertools
+import xmlrpc.client
+import threading as td
+from collections import deque, OrderedDict
+
+# Request tracing across the peers, opt-in with "Tracing": true in the db of the peers.
+# A trace is one request of a buyer to a trader, with the id "<buyer peer_id>:<Lamport clock of the request>",
+# so a trace lines up with the trade in the trader's log. A span is one hop, timed by the peer that runs it:
+# "request" on the buyer, "call.<method>" around every outgoing RPC, "rpc.<method>" on the peer that serves it,
+# and steps of the trader ("lookup" once a worker runs it, "match", "journal", "complete" until the DB has
+# the sale and the trade is completed in the log). The context of a call, the trace id and the caller's span id,
+# goes with the call beside the Lamport clock in its arguments: in the X-Trace header of XML-RPC and as a third
+# field of the request of the binary protocol (see wire.py). Peers without tracing ignore it.
+# Every peer keeps its last spans in a ring buffer, served by the `trace_dump` RPC:
+#   python3 tracing.py collect 10.0.0.1:20090 10.0.0.1:20091 ... --out traces.jsonl
+#   python3 tracing.py report traces.jsonl [--slowest 5] [--trace 3:1042]
+# "TraceBuffer" is the size of the ring buffer (65536 spans), "TraceSample" the share of the buyer's requests traced.
+
+HEADER = 'X-Trace'
+SLACK = 1e-4 # Seconds a child span may seem to stick out of its parent, the clocks of the peers differ a little.
+FIELDS = ('trace', 'span', 'parent', 'peer', 'name', 'start', 'duration', 'clock')
+
+_local = td.local()
+
+
+# current : (trace id, span id) of the span the thread runs in, None outside of a trace.
+def current():
+    return getattr(_local, 'context', None)
+
+
+# activate : Context manager running the thread in a context received with a call, or in none.
+class activate:
+    def __init__(self, context):
+        self.context = context
+
+    def __enter__(self):
+        self.previous = current()
+        _local.context = self.context
+
+    def __exit__(self, *exc_info):
+        _local.context = self.previous
+
+
+def encode(context):
+    return context[0] + '/' + context[1]
+
+
+# decode : The context of an X-Trace header, None if there is none.
+def decode(value):
+    if not value:
+        return None
+    trace_id, _, span_id = value.rpartition('/')
+    return (trace_id, span_id) if trace_id else None
+
+
+# run_in : function(*args) in the context, for the calls handed to another thread.
+def run_in(context, function, *args):
+    with activate(context):
+        return function(*args)
+
+
+class Span:
+    __slots__ = ('tracer', 'trace', 'span', 'parent', 'name', 'start', 'perf_start', 'clock', 'previous')
+
+    def __init__(self, tracer, trace_id, parent, name):
+        self.tracer = tracer
+        self.trace = trace_id
+        self.span = tracer.new_id()
+        self.parent = parent
+        self.name = name
+
+    def __enter__(self):
+        self.previous = current()
+        _local.context = (self.trace, self.span)
+        self.clock = self.tracer.clock()
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.trace, self.span, self.parent, self.name, self.start, time.perf_counter() - self.perf_start, self.clock)
+        _local.context = self.previous
+
+
+# The span of the untraced work, it does nothing.
+class NoSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_SPAN = NoSpan()
+
+
+# Tracer : The spans of a peer, the last `capacity` ones in a ring buffer. A disabled tracer records nothing.
+# clock returns the peer's Lamport clock, recorded at the start of every span.
+class Tracer:
+    def __init__(self, peer_id, capacity=65536, enabled=True, sample=1.0, clock=None):
+        self.peer_id = peer_id
+        self.enabled = enabled
+        self.sample = sample
+        self.clock = clock or (lambda: 0)
+        self.spans = deque(maxlen=capacity) # Appending drops the oldest span, without a lock.
+        self.ids = itertools.count(1)
+        self.credit = 0.0
+        self.detached = OrderedDict() # key -> (context, name, start, perf_start, clock) of the spans still open.
+        self.capacity = capacity
+        self.recorded = 0
+
+    def new_id(self):
+        return "{}.{}".format(self.peer_id, next(self.ids))
+
+    # trace : The root span of a new trace, or NO_SPAN for the requests left out by sampling.
+    def trace(self, name, trace_id):
+        if not self.enabled:
+            return NO_SPAN
+        self.credit += self.sample
+        if self.credit < 1.0:
+            return NO_SPAN
+        self.credit -= 1.0
+        return Span(self, trace_id, '', name)
+
+    # span : A span in the current context, NO_SPAN outside of a trace.
+    def span(self, name):
+        context = current()
+        if context is None or not self.enabled:
+            return NO_SPAN
+        return Span(self, context[0], context[1], name)
+
+    # traced : function in a span of its own, when it is called in a trace.
+    def traced(self, name, function):
+        if not self.enabled:
+            return function
+        def traced_function(*args):
+            context = current()
+            if context is None:
+                return function(*args)
+            with Span(self, context[0], context[1], name):
+                return function(*args)
+        return traced_function
+
+    # detach : Open a span in the current context that is closed by finish(key), from another thread.
+    def detach(self, key, name):
+        context = current()
+        if context is None or not self.enabled:
+            return
+        self.detached[key] = (context, name, time.time(), time.perf_counter(), self.clock())
+        while len(self.detached) > self.capacity: # Never finished.
+            self.detached.popitem(last=False)
+
+    def finish(self, key):
+        opened = self.detached.pop(key, None)
+        if opened is None:
+            return
+        (trace_id, parent), name, start, perf_start, clock = opened
+        self.record(trace_id, self.new_id(), parent, name, start, time.perf_counter() - perf_start, clock)
+
+    def record(self, trace_id, span_id, parent, name, start, duration, clock):
+        self.spans.append((trace_id, span_id, parent, self.peer_id, name, start, duration, clock))
+        self.recorded += 1
+
+    # dump : The spans in the buffer, as lists of FIELDS.
+    def dump(self):
+        return [list(span) for span in self.spans.copy()] # copy() does not let the other threads in.
+
+    def stats(self):
+        return {'recorded': self.recorded, 'buffered': len(self.spans), 'open': len(self.detached)}
+
+
+# collect : The spans of the peers (and DB server) at these addresses, as dicts. Peers that do not answer are skipped.
+def collect(host_addrs):
+    spans = []
+    for host_addr in host_addrs:
+        try:
+            dump = xmlrpc.client.ServerProxy('http://' + host_addr + '/', allow_none=True).trace_dump()
+        except (OSError, xmlrpc.client.Error) as e:
+            print("{}: {}".format(host_addr, e), file=sys.stderr)
+            continue
+        spans.extend(dict(zip(FIELDS, span)) for span in dump)
+    return spans
+
+
+def write_spans(filename, spans):
+    with open(filename, 'w') as f:
+        for span in spans:
+            f.write(json.dumps(span) + '\n')
+
+
+def read_spans(filenames):
+    spans = []
+    for filename in filenames:
+        with open(filename) as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+
+# merge : The spans of all the peers grouped by trace, in start order.
+def merge(spans):
+    traces = {}
+    for span in spans:
+        traces.setdefault(span['trace'], []).append(span)
+    for trace_spans in traces.values():
+        trace_spans.sort(key=lambda span: (span['start'], span['clock']))
+    return traces
+
+
+# tree : The roots of a trace, spans whose parent is not in the dumps, and the children of every span.
+def tree(trace_spans):
+    ids = {span['span'] for span in trace_spans}
+    children = {}
+    roots = []
+    for span in trace_spans:
+        if span['parent'] in ids:
+            children.setdefault(span['parent'], []).append(span)
+        else:
+            roots.append(span)
+    return roots, children
+
+
+def end(span):
+    return span['start'] + span['duration']
+
+
+# critical_path : [(span, seconds)] of the spans the end of the trace waited on, from the root down, with the
+# time spent in each span itself. Going back from the end of a span, the child that ends last is on
+# the path, then the child that ends last before that one started, and so on.
+def critical_path(trace_spans):
+    roots, children = tree(trace_spans)
+    if not roots:
+        return []
+    path = []
+    def walk(span):
+        entry = [span, span['duration']]
+        path.append(entry)
+        limit = end(span)
+        for child in sorted(children.get(span['span'], []), key=end, reverse=True):
+            if end(child) <= limit + SLACK and child['start'] >= span['start'] - SLACK:
+                entry[1] -= child['duration']
+                walk(child)
+                limit = child['start']
+    walk(max(roots, key=lambda span: span['duration']))
+    return [(span, max(seconds, 0.0)) for span, seconds in path]
+
+
+# hot_spots : [(span name, seconds, share)] of the time on the critical paths of the traces, most first.
+def hot_spots(traces):
+    totals = {}
+    for trace_spans in traces.values():
+        for span, seconds in critical_path(trace_spans):
+            totals[span['name']] = totals.get(span['name'], 0.0) + seconds
+    total = sum(totals.values()) or 1.0
+    return [(name, seconds, seconds / total) for name, seconds in sorted(totals.items(), key=lambda item: -item[1])]
+
+
+# trace_duration : Seconds from the first start to the last end of a trace, completion included.
+def trace_duration(trace_spans):
+    return max(end(span) for span in trace_spans) - min(span['start'] for span in trace_spans)
+
+
+# latency : Seconds of the request, the longest root span of the trace.
+def latency(trace_spans):
+    roots, _ = tree(trace_spans)
+    return max(span['duration'] for span in roots)
+
+
+# format_trace : The timeline of a trace, one span per line indented under its parent, the spans of the
+# critical path marked with *.
+def format_trace(trace_id, trace_spans):
+    roots, children = tree(trace_spans)
+    origin = min(span['start'] for span in trace_spans)
+    on_path = {span['span'] for span, _ in critical_path(trace_spans)}
+    lines = ["trace {}: {:.2f} ms, {:.2f} ms until completed, {} spans".format(
+        trace_id, latency(trace_spans) * 1e3, trace_duration(trace_spans) * 1e3, len(trace_spans))]
+    def show(span, depth):
+        lines.append("{} {:9.2f} ms {:9.2f} ms  {}{} @{} clock {}".format(
+            '*' if span['span'] in on_path else ' ', (span['start'] - origin) * 1e3, span['duration'] * 1e3,
+            '  ' * depth, span['name'], span['peer'], span['clock']))
+        for child in children.get(span['span'], []):
+            show(child, depth + 1)
+    for root in roots:
+        show(root, 0)
+    return "\n".join(lines)
+
+
+def report(traces, slowest=3):
+    lines = ["{} traces, {} spans".format(len(traces), sum(len(trace_spans) for trace_spans in traces.values())),
+             "Critical path time by span:"]
+    for name, seconds, share in hot_spots(traces):
+        lines.append("  {:28} {:10.1f} ms {:6.1%}".format(name, seconds * 1e3, share))
+    for trace_id in sorted(traces, key=lambda trace_id: -latency(traces[trace_id]))[:slowest]:
+        lines.append("")
+        lines.append(format_trace(trace_id, traces[trace_id]))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect the peers' traces and rebuild the timelines of the requests.")
+    parser.add_argument('command', choices=['collect', 'report'])
+    parser.add_argument('sources', nargs='+', help="host:port of the peers (collect) or files of spans (report)")
+    parser.add_argument('--out', default='traces.jsonl', help="file of the collected spans")
+    parser.add_argument('--slowest', type=int, default=3, help="timelines of the slowest traces to show")
+    parser.add_argument('--trace', default=None, help="show the timeline of this trace only")
+    args = parser.parse_args()
+    if args.command == 'collect':
+        spans = collect(args.sources)
+        write_spans(args.out, spans)
+        print("{} spans of {} traces written to {}".format(len(spans), len(merge(spans)), args.out))
+    else:
+        traces = merge(read_spans(args.sources))
+        if args.trace is not None:
+            print(format_trace(args.trace, traces[args.trace]) if args.trace in traces else "No trace {}".format(args.trace))
+        else:
+            print(report(traces, args.slowest))
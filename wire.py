@@ -0,0 +1,233 @@
+import socket
+import struct
+import logging
+import socketserver
+import xmlrpc.client
+import tracing
+
+# Compact binary wire protocol, an alternative to XML-RPC between peers.
+# A message is a frame: a 4-byte big-endian length followed by a struct-packed value.
+# Values are tagged: N None, T True, F False, i int64, d float64, s str, b bytes, l list, m dict.
+# A request is the value [method, [args...]], or [method, [args...], trace context] in a trace (see tracing.py), a response is [0, result] or [1, fault_code, fault_string].
+# The binary server of a peer listens on its XML-RPC port + WIRE_PORT_OFFSET.
+
+WIRE_PORT_OFFSET = 10000
+MAX_FRAME = 64 * 1024 * 1024
+
+INT64 = struct.Struct('>q')
+FLOAT64 = struct.Struct('>d')
+UINT32 = struct.Struct('>I')
+
+
+def encode(value):
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+def _encode(value, out):
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif isinstance(value, int):
+        out += b'i'
+        out += INT64.pack(value)
+    elif isinstance(value, float):
+        out += b'd'
+        out += FLOAT64.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out += b's'
+        out += UINT32.pack(len(data))
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        out += b'b'
+        out += UINT32.pack(len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += b'l'
+        out += UINT32.pack(len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += b'm'
+        out += UINT32.pack(len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError("Cannot encode {} on the wire".format(type(value).__name__))
+
+
+def decode(data):
+    value, offset = _decode(memoryview(data), 0)
+    if offset != len(data):
+        raise ValueError("Trailing bytes after the wire value")
+    return value
+
+def _decode(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == 0x4e: # N
+        return None, offset
+    if tag == 0x54: # T
+        return True, offset
+    if tag == 0x46: # F
+        return False, offset
+    if tag == 0x69: # i
+        return INT64.unpack_from(data, offset)[0], offset + 8
+    if tag == 0x64: # d
+        return FLOAT64.unpack_from(data, offset)[0], offset + 8
+    if tag in (0x73, 0x62): # s, b
+        size = UINT32.unpack_from(data, offset)[0]
+        offset += 4
+        raw = bytes(data[offset:offset + size])
+        return (raw.decode() if tag == 0x73 else raw), offset + size
+    if tag == 0x6c: # l
+        size = UINT32.unpack_from(data, offset)[0]
+        offset += 4
+        items = []
+        for _ in range(size):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == 0x6d: # m
+        size = UINT32.unpack_from(data, offset)[0]
+        offset += 4
+        items = {}
+        for _ in range(size):
+            key, offset = _decode(data, offset)
+            items[key], offset = _decode(data, offset)
+        return items, offset
+    raise ValueError("Unknown wire tag {!r}".format(chr(tag)))
+
+
+def send_frame(sock, value):
+    payload = encode(value)
+    sock.sendall(UINT32.pack(len(payload)) + payload)
+
+# Read a frame, None if the connection was closed before it started.
+def recv_frame(rfile):
+    header = rfile.read(4)
+    if not header:
+        return None
+    if len(header) < 4:
+        raise ConnectionResetError("Connection closed inside a frame")
+    size = UINT32.unpack(header)[0]
+    if size > MAX_FRAME:
+        raise ValueError("Frame of {} bytes is too large".format(size))
+    payload = rfile.read(size)
+    if len(payload) < size:
+        raise ConnectionResetError("Connection closed inside a frame")
+    return decode(payload)
+
+
+def wire_addr(host_addr):
+    host, port = host_addr.split(':')
+    return host, int(port) + WIRE_PORT_OFFSET
+
+
+class BinaryRequestHandler(socketserver.StreamRequestHandler):
+    timeout = 30.0 # Idle connections are closed after this many seconds.
+
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            try:
+                request = recv_frame(self.rfile)
+            except (OSError, ValueError):
+                return
+            if request is None:
+                return
+            method, args = request[0], request[1]
+            function = self.server.functions.get(method)
+            try:
+                if function is None:
+                    raise Exception('method "{}" is not supported'.format(method))
+                if len(request) > 2:
+                    response = [0, tracing.run_in(tracing.decode(request[2]), function, *args)]
+                else:
+                    response = [0, function(*args)]
+            except Exception as e: # Reported to the caller as a Fault, like SimpleXMLRPCServer does.
+                response = [1, 1, "{}:{}".format(type(e), e)]
+            try:
+                send_frame(self.request, response)
+            except OSError:
+                return
+
+
+# BinaryRPCServer : Threaded server of the binary protocol, one thread per connection.
+class BinaryRPCServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, functions):
+        super().__init__(server_address, BinaryRequestHandler)
+        self.functions = dict(functions)
+
+
+# BinaryServerProxy : Client of the binary protocol over one persistent connection.
+# Like xmlrpc.client.ServerProxy, a remote error raises xmlrpc.client.Fault and proxy('close')() closes it.
+# It is not thread-safe, the connection pool hands it to one caller at a time.
+class BinaryServerProxy:
+    def __init__(self, host_addr, connect_timeout=2.0, read_timeout=10.0):
+        self.host_addr = host_addr
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connect()
+
+    def connect(self):
+        self.sock = socket.create_connection(wire_addr(self.host_addr), timeout=self.connect_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(self.read_timeout)
+        self.rfile = self.sock.makefile('rb')
+        self.reused = False
+
+    def __call__(self, attr):
+        if attr == 'close':
+            return self.close
+        raise AttributeError("Attribute {} not found".format(attr))
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        def call(*args):
+            return self.call(name, *args)
+        return call
+
+    def call(self, method, *args):
+        request = [method, list(args)]
+        context = tracing.current()
+        if context is not None:
+            request.append(tracing.encode(context))
+        try:
+            send_frame(self.sock, request)
+            response = recv_frame(self.rfile)
+            if response is None:
+                raise ConnectionResetError("Connection closed by {}".format(self.host_addr))
+        except (ConnectionResetError, BrokenPipeError):
+            if not self.reused:
+                raise
+            # The server closed the idle connection, retry once on a new one like xmlrpc.client does.
+            self.close()
+            self.connect()
+            send_frame(self.sock, request)
+            response = recv_frame(self.rfile)
+            if response is None:
+                raise ConnectionResetError("Connection closed by {}".format(self.host_addr))
+        self.reused = True
+        if response[0] == 0:
+            return response[1]
+        raise xmlrpc.client.Fault(response[1], response[2])
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except OSError:
+            logging.debug("Error closing the connection to {}".format(self.host_addr))